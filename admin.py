@@ -1,12 +1,30 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file
+from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file, current_app, jsonify, Response, stream_with_context
 from flask_login import login_required, current_user
 from werkzeug.security import generate_password_hash
 from werkzeug.utils import secure_filename
-from models import User, Question, Paper, Notification, Setting, DownloadFile, GalleryImage
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+from models import User, Question, Paper, PaperQuestion, Notification, Setting, DownloadFile, GalleryImage, Job
 from app import db
+from pagination import keyset_paginate
+from settings_cache import invalidate_settings
+from jobs import enqueue
+from question_import import FORMATS as IMPORT_FORMATS, QuestionError, validate_question
+import roster_import  # registers the import_roster job handler
+from exports import FORMATS as EXPORT_FORMATS, ExportError, export_table
+from instrumentation import endpoint_stats, reset_stats
+from stats import dashboard_stats
+import user_cache
+import pdf_cache
+import question_bank
+import paper_assembly
+import media
+import storage  # registers the collect_storage job handler
 from datetime import datetime, date
+from io import BytesIO
 import os
 import json
+import secrets
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -20,28 +38,22 @@ def admin_required(f):
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+def _page_size():
+    """Rows per page for list views, from ?per_page= or the configured default"""
+    return request.args.get('per_page', current_app.config['ADMIN_PAGE_SIZE'], type=int)
+
 @admin_bp.route('/dashboard')
 @login_required
 @admin_required
 def dashboard():
-    # Get statistics
-    total_teachers = User.query.filter_by(role='teacher').count()
-    total_students = User.query.filter_by(role='student').count()
-    total_questions = Question.query.count()
-    total_papers = Paper.query.count()
+    # Get statistics, with per-subject and per-class breakdowns
+    stats = dashboard_stats()
     
     # Get recent notifications
     notifications = Notification.query.order_by(Notification.created_at.desc()).limit(5).all()
     
-    # Get recent papers
-    recent_papers = Paper.query.order_by(Paper.created_at.desc()).limit(5).all()
-    
-    stats = {
-        'teachers': total_teachers,
-        'students': total_students,
-        'questions': total_questions,
-        'papers': total_papers
-    }
+    # Get recent papers, with their teachers for the listing
+    recent_papers = Paper.query.options(joinedload(Paper.teacher)).order_by(Paper.created_at.desc()).limit(5).all()
     
     return render_template('admin/dashboard.html', stats=stats, notifications=notifications, recent_papers=recent_papers)
 
@@ -49,8 +61,22 @@ def dashboard():
 @login_required
 @admin_required
 def manage_teachers():
-    teachers = User.query.filter_by(role='teacher').all()
-    return render_template('admin/manage_teachers.html', teachers=teachers)
+    query = User.query.filter_by(role='teacher')
+    
+    subject = request.args.get('subject')
+    if subject:
+        query = query.filter_by(subject=subject)
+    
+    page = keyset_paginate(query, [(User.name, False), (User.id, False)],
+                           cursor=request.args.get('cursor'), page_size=_page_size())
+    
+    # Paper counts for the page in one query, instead of loading each teacher's papers_created
+    paper_counts = dict(db.session.query(Paper.teacher_id, func.count(Paper.id))
+                        .filter(Paper.teacher_id.in_([t.id for t in page.items]))
+                        .group_by(Paper.teacher_id).all())
+    
+    return render_template('admin/manage_teachers.html', teachers=page.items, page=page,
+                           paper_counts=paper_counts, filters={'subject': subject})
 
 @admin_bp.route('/teachers/add', methods=['GET', 'POST'])
 @login_required
@@ -66,12 +92,12 @@ def add_teacher():
         
         if not all([name, email, password, subject]):
             flash('Name, email, password, and subject are required.', 'error')
-            return render_template('admin/manage_teachers.html', teachers=User.query.filter_by(role='teacher').all())
+            return redirect(url_for('admin.manage_teachers'))
         
         # Check if email already exists
         if User.query.filter_by(email=email).first():
             flash('Email already exists.', 'error')
-            return render_template('admin/manage_teachers.html', teachers=User.query.filter_by(role='teacher').all())
+            return redirect(url_for('admin.manage_teachers'))
         
         # Convert expiry date
         exp_date = None
@@ -80,7 +106,7 @@ def add_teacher():
                 exp_date = datetime.strptime(expiry_date, '%Y-%m-%d').date()
             except ValueError:
                 flash('Invalid date format.', 'error')
-                return render_template('admin/manage_teachers.html', teachers=User.query.filter_by(role='teacher').all())
+                return redirect(url_for('admin.manage_teachers'))
         
         teacher = User(
             name=name,
@@ -99,7 +125,7 @@ def add_teacher():
         flash(f'Teacher {name} added successfully.', 'success')
         return redirect(url_for('admin.manage_teachers'))
     
-    return render_template('admin/manage_teachers.html', teachers=User.query.filter_by(role='teacher').all())
+    return redirect(url_for('admin.manage_teachers'))
 
 @admin_bp.route('/teachers/edit/<int:teacher_id>', methods=['POST'])
 @login_required
@@ -170,8 +196,17 @@ def delete_teacher(teacher_id):
 @login_required
 @admin_required
 def manage_students():
-    students = User.query.filter_by(role='student').all()
-    return render_template('admin/manage_students.html', students=students)
+    query = User.query.filter_by(role='student')
+    
+    class_assigned = request.args.get('class_assigned')
+    if class_assigned:
+        query = query.filter_by(class_assigned=class_assigned)
+    
+    page = keyset_paginate(query, [(User.name, False), (User.id, False)],
+                           cursor=request.args.get('cursor'), page_size=_page_size())
+    
+    return render_template('admin/manage_students.html', students=page.items, page=page,
+                           filters={'class_assigned': class_assigned})
 
 @admin_bp.route('/students/add', methods=['POST'])
 @login_required
@@ -228,99 +263,215 @@ def delete_student(student_id):
 @login_required
 @admin_required
 def manage_questions():
-    questions = Question.query.order_by(Question.created_at.desc()).all()
-    return render_template('admin/manage_questions.html', questions=questions)
+    query = Question.query
+    
+    filters = {
+        'subject': request.args.get('subject'),
+        'class_level': request.args.get('class_level'),
+        'chapter_number': request.args.get('chapter_number', type=int),
+        'question_type': request.args.get('question_type'),
+    }
+    for column, value in filters.items():
+        if value:
+            query = query.filter(getattr(Question, column) == value)
+    
+    page = keyset_paginate(query, [(Question.created_at, True), (Question.id, True)],
+                           cursor=request.args.get('cursor'), page_size=_page_size())
+    questions = page.items
+    
+    # Number of papers each question on this page appears in
+    usage = dict(db.session.query(PaperQuestion.question_id, func.count(PaperQuestion.paper_id))
+                 .filter(PaperQuestion.question_id.in_([q.id for q in questions]))
+                 .group_by(PaperQuestion.question_id).all())
+    
+    return render_template('admin/manage_questions.html', questions=questions, usage=usage,
+                           page=page, filters=filters)
 
 @admin_bp.route('/questions/add', methods=['POST'])
 @login_required
 @admin_required
 def add_question():
-    subject = request.form.get('subject')
-    class_level = request.form.get('class_level')
-    chapter_name = request.form.get('chapter_name')
-    chapter_number = request.form.get('chapter_number', type=int)
-    question_type = request.form.get('question_type')
     has_parts = request.form.get('has_parts') == 'true'
+    fields = {
+        'subject': request.form.get('subject'),
+        'class_level': request.form.get('class_level'),
+        'chapter_name': request.form.get('chapter_name'),
+        'chapter_number': request.form.get('chapter_number', type=int),
+        'question_type': request.form.get('question_type'),
+        'has_parts': has_parts,
+        # Two-part questions have their own text field on the form
+        'question_text': request.form.get('question_text_parts' if has_parts else 'question_text'),
+        'marks': request.form.get('marks', 1, type=int),
+        'part_a_text': request.form.get('part_a_text'),
+        'part_a_marks': request.form.get('part_a_marks', type=int),
+        'part_b_text': request.form.get('part_b_text'),
+        'part_b_marks': request.form.get('part_b_marks', type=int),
+        'options': [request.form.get(f'option_{i}') for i in range(1, 5)],  # 4 options
+    }
     
-    if not all([subject, class_level, chapter_name, chapter_number, question_type]):
-        flash('All required fields must be filled.', 'error')
+    try:
+        values = validate_question(fields)
+    except QuestionError as e:
+        flash(str(e), 'error')
         return redirect(url_for('admin.manage_questions'))
     
-    if has_parts:
-        # Handle two-part question
-        question_text = request.form.get('question_text_parts')
-        part_a_text = request.form.get('part_a_text')
-        part_a_marks = request.form.get('part_a_marks', type=int)
-        part_b_text = request.form.get('part_b_text')
-        part_b_marks = request.form.get('part_b_marks', type=int)
-        
-        if not all([question_text, part_a_text, part_a_marks, part_b_text, part_b_marks]):
-            flash('All parts (A and B) must be completed with their marks.', 'error')
-            return redirect(url_for('admin.manage_questions'))
-        
-        total_marks = part_a_marks + part_b_marks
-        
-        question = Question(
-            subject=subject,
-            class_level=class_level,
-            chapter_name=chapter_name,
-            chapter_number=chapter_number,
-            question_type=question_type,
-            question_text=question_text,
-            marks=total_marks,
-            has_parts=True,
-            part_a_text=part_a_text,
-            part_a_marks=part_a_marks,
-            part_b_text=part_b_text,
-            part_b_marks=part_b_marks,
-            created_by=current_user.id
-        )
-    else:
-        # Handle single question
-        question_text = request.form.get('question_text')
-        marks = request.form.get('marks', 1, type=int)
-        
-        if not question_text:
-            flash('Question text is required.', 'error')
-            return redirect(url_for('admin.manage_questions'))
-        
-        question = Question(
-            subject=subject,
-            class_level=class_level,
-            chapter_name=chapter_name,
-            chapter_number=chapter_number,
-            question_type=question_type,
-            question_text=question_text,
-            marks=marks,
-            has_parts=False,
-            created_by=current_user.id
-        )
-    
-    # Handle MCQ options (no correct answer required)
-    if question_type == 'MCQ' and not has_parts:
-        options = []
-        for i in range(1, 5):  # 4 options
-            option = request.form.get(f'option_{i}')
-            if option:
-                options.append(option)
-        
-        if options:
-            question.set_options(options)
-        else:
-            flash('MCQ questions must have options.', 'error')
-            return redirect(url_for('admin.manage_questions'))
-    
+    question = Question(created_by=current_user.id, **values)
     db.session.add(question)
     db.session.commit()
     
     flash('Question added successfully.', 'success')
     return redirect(url_for('admin.manage_questions'))
 
+@admin_bp.route('/questions/import', methods=['POST'])
+@login_required
+@admin_required
+def import_questions():
+    """Queue a bulk import of questions from a CSV, JSON, JSON Lines or XLSX file"""
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('Choose a file to import.', 'error')
+        return redirect(url_for('admin.manage_questions'))
+    
+    ext = os.path.splitext(secure_filename(upload.filename))[1].lower()
+    if ext not in IMPORT_FORMATS:
+        flash('Import files must be CSV, JSON, JSON Lines or XLSX.', 'error')
+        return redirect(url_for('admin.manage_questions'))
+    
+    path = os.path.join('uploads/imports', f'questions_{secrets.token_hex(8)}{ext}')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    upload.save(path)
+    
+    job = enqueue('import_questions', path=path, file_format=IMPORT_FORMATS[ext], created_by=current_user.id)
+    
+    flash(f'Import started. Progress and any row errors are at {url_for("admin.job_status", job_id=job.id)}.', 'success')
+    return redirect(url_for('admin.manage_questions'))
+
+@admin_bp.route('/roster/import', methods=['POST'])
+@login_required
+@admin_required
+def import_roster():
+    """Queue creation of student or teacher accounts from a roster file"""
+    upload = request.files.get('file')
+    role = request.form.get('role', 'student')
+    if not upload or not upload.filename:
+        flash('Choose a roster file to import.', 'error')
+        return redirect(url_for('admin.manage_students'))
+    
+    ext = os.path.splitext(secure_filename(upload.filename))[1].lower()
+    if ext not in IMPORT_FORMATS:
+        flash('Roster files must be CSV, JSON, JSON Lines or XLSX.', 'error')
+        return redirect(url_for('admin.manage_students'))
+    
+    path = os.path.join('uploads/imports', f'roster_{secrets.token_hex(8)}{ext}')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    upload.save(path)
+    
+    job = enqueue('import_roster', path=path, file_format=IMPORT_FORMATS[ext], default_role=role)
+    
+    flash(f'Roster import started. Progress, row errors and the credentials sheet are at '
+          f'{url_for("admin.job_status", job_id=job.id)}.', 'success')
+    return redirect(url_for('admin.manage_students'))
+
+@admin_bp.route('/roster/credentials/<int:job_id>')
+@login_required
+@admin_required
+def download_roster_credentials(job_id):
+    """Credentials sheet (names, emails and passwords) from a roster import"""
+    job = Job.query.get_or_404(job_id)
+    result = job.get_result() or {}
+    roster_import.remove_expired_credentials()
+    
+    if job.kind != 'import_roster' or not result.get('credentials_path') \
+            or not os.path.exists(result['credentials_path']):
+        flash('No credentials sheet is available for that import. It is deleted once downloaded '
+              'or when it expires.', 'error')
+        return redirect(url_for('admin.manage_students'))
+    
+    path = result['credentials_path']
+    with open(path, 'rb') as f:
+        data = f.read()
+    # The sheet holds plaintext passwords, so only one copy is handed out
+    os.remove(path)
+    return send_file(BytesIO(data), as_attachment=True,
+                     download_name=f'credentials_{job.id}.csv', mimetype='text/csv')
+
+@admin_bp.route('/export/<table>.<file_format>')
+@login_required
+@admin_required
+def export_data(table, file_format):
+    """Stream a whole table as CSV, JSON Lines or Parquet"""
+    try:
+        chunks = export_table(table, file_format)
+    except ExportError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('admin.dashboard'))
+    
+    mimetype, extension = EXPORT_FORMATS[file_format]
+    filename = f'{table}_{date.today().isoformat()}.{extension}'
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@admin_bp.route('/diagnostics')
+@login_required
+@admin_required
+def diagnostics():
+    """Per-endpoint request and SQL statistics plus cache hit rates for this worker"""
+    endpoints = endpoint_stats()
+    caches = {
+        'users': user_cache.cache_stats(),
+        'pdfs': pdf_cache.cache_stats(),
+        'question_tree': question_bank.cache_stats(),
+        'assembly_index': paper_assembly.cache_stats(),
+    }
+    
+    if request.args.get('format') == 'json':
+        return jsonify({'endpoints': endpoints, 'caches': caches})
+    return render_template('admin/diagnostics.html', endpoints=endpoints, caches=caches)
+
+@admin_bp.route('/diagnostics/reset', methods=['POST'])
+@login_required
+@admin_required
+def reset_diagnostics():
+    """Clear the diagnostics counters for this worker"""
+    reset_stats()
+    flash('Diagnostics counters reset.', 'success')
+    return redirect(url_for('admin.diagnostics'))
+
+@admin_bp.route('/jobs/<int:job_id>')
+@login_required
+@admin_required
+def job_status(job_id):
+    """Status and result of a background job such as an import"""
+    job = Job.query.get_or_404(job_id)
+    
+    credentials_url = None
+    if job.kind == 'import_roster' and (job.get_result() or {}).get('credentials_path'):
+        credentials_url = url_for('admin.download_roster_credentials', job_id=job.id)
+    
+    return jsonify({
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'error': job.error,
+        'result': job.get_result(),
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'credentials_url': credentials_url,
+    })
+
 @admin_bp.route('/questions/delete/<int:question_id>')
 @login_required
 @admin_required
 def delete_question(question_id):
     question = Question.query.get_or_404(question_id)
+    
+    # Papers keep their questions, so a question in use can't be removed
+    paper_count = PaperQuestion.query.filter_by(question_id=question.id).count()
+    if paper_count:
+        flash(f'This question is used in {paper_count} paper(s) and cannot be deleted.', 'error')
+        return redirect(url_for('admin.manage_questions'))
+    
     db.session.delete(question)
     db.session.commit()
     
@@ -331,8 +482,17 @@ def delete_question(question_id):
 @login_required
 @admin_required
 def manage_notifications():
-    notifications = Notification.query.order_by(Notification.created_at.desc()).all()
-    return render_template('admin/notifications.html', notifications=notifications)
+    query = Notification.query
+    
+    target_role = request.args.get('target_role')
+    if target_role:
+        query = query.filter_by(target_role=target_role)
+    
+    page = keyset_paginate(query, [(Notification.created_at, True), (Notification.id, True)],
+                           cursor=request.args.get('cursor'), page_size=_page_size())
+    
+    return render_template('admin/notifications.html', notifications=page.items, page=page,
+                           filters={'target_role': target_role})
 
 @admin_bp.route('/notifications/add', methods=['POST'])
 @login_required
@@ -384,6 +544,17 @@ def settings():
 def update_settings():
     academy_name = request.form.get('academy_name')
     
+    # Store the uploaded images first, so a file that isn't an image changes nothing
+    images = {}
+    for field, key, label in (('logo', 'academy_logo', 'Logo'), ('background', 'background_image', 'Background')):
+        upload = request.files.get(field)
+        if upload and upload.filename:
+            try:
+                images[key] = media.save_image(upload)
+            except media.MediaError as e:
+                flash(f'{label} not saved: {e}', 'error')
+                return redirect(url_for('admin.settings'))
+    
     if academy_name:
         setting = Setting.query.filter_by(key='academy_name').first()
         if setting:
@@ -392,38 +563,18 @@ def update_settings():
             setting = Setting(key='academy_name', value=academy_name)
             db.session.add(setting)
     
-    # Handle logo upload
-    if 'logo' in request.files:
-        logo_file = request.files['logo']
-        if logo_file and logo_file.filename:
-            filename = secure_filename(logo_file.filename)
-            logo_path = os.path.join('uploads/logos', filename)
-            os.makedirs(os.path.dirname(logo_path), exist_ok=True)
-            logo_file.save(logo_path)
-            
-            setting = Setting.query.filter_by(key='academy_logo').first()
-            if setting:
-                setting.value = logo_path
-            else:
-                setting = Setting(key='academy_logo', value=logo_path)
-                db.session.add(setting)
-    
-    # Handle background upload
-    if 'background' in request.files:
-        bg_file = request.files['background']
-        if bg_file and bg_file.filename:
-            filename = secure_filename(bg_file.filename)
-            bg_path = os.path.join('uploads/backgrounds', filename)
-            os.makedirs(os.path.dirname(bg_path), exist_ok=True)
-            bg_file.save(bg_path)
-            
-            setting = Setting.query.filter_by(key='background_image').first()
-            if setting:
-                setting.value = bg_path
-            else:
-                setting = Setting(key='background_image', value=bg_path)
-                db.session.add(setting)
+    for key, path in images.items():
+        setting = Setting.query.filter_by(key=key).first()
+        if setting:
+            setting.value = path
+        else:
+            setting = Setting(key=key, value=path)
+            db.session.add(setting)
     
+    invalidate_settings()
     db.session.commit()
+    if images:
+        # Clear out images replaced earlier than the grace period
+        enqueue('collect_storage')
     flash('Settings updated successfully.', 'success')
     return redirect(url_for('admin.settings'))
@@ -28,6 +28,40 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 }
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['JOB_WORKERS'] = int(os.environ.get("JOB_WORKERS", 2))  # background threads per process
+app.config['JOB_STALE_AFTER'] = 600  # seconds before a running job is assumed lost
+app.config['CLASS_SET_WORKERS'] = int(os.environ.get("CLASS_SET_WORKERS", os.cpu_count() or 2))
+app.config['SETTINGS_CHECK_INTERVAL'] = 5  # seconds between checks for settings saved by other workers
+app.config['USER_CACHE_TTL'] = 30  # seconds a logged-in user is served from memory
+app.config['USER_CACHE_SIZE'] = 1000  # users cached per process
+app.config['SEARCH_LANGUAGE'] = os.environ.get("SEARCH_LANGUAGE", "english")  # PostgreSQL text search config
+app.config['QUESTION_TREE_TTL'] = 60  # seconds the question picker's chapter tree is cached
+app.config['ASSEMBLY_INDEX_TTL'] = 300  # seconds the paper assembly question index is kept per subject and class
+app.config['ASSEMBLY_MAX_MARKS'] = 1000  # largest total_marks a blueprint may ask for
+app.config['ASSEMBLY_MAX_QUESTIONS'] = 200  # most questions (all types together) a blueprint may ask for
+app.config['ADMIN_PAGE_SIZE'] = 50  # rows per page on admin list views
+app.config['IMPORT_BATCH_SIZE'] = 1000  # rows per INSERT batch for bulk imports
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 2))
+app.config['ROSTER_CREDENTIALS_TTL'] = int(os.environ.get("ROSTER_CREDENTIALS_TTL", 86400))  # seconds an undownloaded credentials sheet is kept
+app.config['PDF_CACHE_MAX_BYTES'] = int(os.environ.get("PDF_CACHE_MAX_BYTES", 500 * 1024 * 1024))
+app.config['PREVIEW_MAX_QUESTIONS'] = 200  # largest paper rendered inline as a preview
+app.config['SECTIONED_RENDER_MIN_QUESTIONS'] = 150  # larger papers are laid out a section at a time
+app.config['PDF_RENDER_MAX_ATTEMPTS'] = 3  # failed renders of a paper before downloads stop retrying it
+app.config['PDF_RENDER_WORKERS'] = int(os.environ.get("PDF_RENDER_WORKERS", os.cpu_count() or 2))
+app.config['SQL_INSTRUMENTATION'] = os.environ.get("SQL_INSTRUMENTATION", "1") == "1"  # per-request query stats; read once at startup
+app.config['SLOW_QUERY_MS'] = int(os.environ.get("SLOW_QUERY_MS", 100))  # log statements slower than this
+app.config['N_PLUS_ONE_THRESHOLD'] = 5  # same statement this many times in one request is reported
+app.config['STATS_RECONCILE_INTERVAL'] = int(os.environ.get("STATS_RECONCILE_INTERVAL", 3600))  # seconds between dashboard counter recounts
+app.config['STORAGE_BACKEND'] = os.environ.get("STORAGE_BACKEND", "local")  # 'local' or 's3'
+app.config['STORAGE_ROOT'] = os.environ.get("STORAGE_ROOT", "uploads/store")  # stored uploads, or local copies of the S3 ones
+app.config['STORAGE_S3_BUCKET'] = os.environ.get("STORAGE_S3_BUCKET")
+app.config['STORAGE_S3_PREFIX'] = os.environ.get("STORAGE_S3_PREFIX", "")
+app.config['STORAGE_S3_ENDPOINT_URL'] = os.environ.get("STORAGE_S3_ENDPOINT_URL")  # e.g. a MinIO server; AWS when unset
+app.config['STORAGE_GC_GRACE'] = int(os.environ.get("STORAGE_GC_GRACE", 3600))  # seconds an unreferenced upload is kept
+app.config['DOWNLOAD_OFFLOAD'] = os.environ.get("DOWNLOAD_OFFLOAD", "")  # '', 'nginx' (X-Accel-Redirect) or 'sendfile' (X-Sendfile)
+app.config['DOWNLOAD_ACCEL_PREFIX'] = os.environ.get("DOWNLOAD_ACCEL_PREFIX", "/protected/")  # nginx internal location for the app directory
+app.config['USE_X_SENDFILE'] = app.config['DOWNLOAD_OFFLOAD'] == 'sendfile'
+app.config['DOWNLOAD_FLUSH_INTERVAL'] = 10  # seconds download counts are kept in memory before being written
 
 # Initialize extensions
 db.init_app(app)
@@ -37,8 +71,8 @@ login_manager.login_view = 'auth.login'
 
 @login_manager.user_loader
 def load_user(user_id):
-    from models import User
-    return User.query.get(int(user_id))
+    from user_cache import load_user as load_cached_user
+    return load_cached_user(int(user_id))
 
 # Import blueprints
 from auth import auth_bp
@@ -52,6 +86,13 @@ app.register_blueprint(admin_bp, url_prefix='/admin')
 app.register_blueprint(teacher_bp, url_prefix='/teacher')
 app.register_blueprint(student_bp, url_prefix='/student')
 
+# Per-request SQL timing (Server-Timing header, logs, admin diagnostics)
+import instrumentation
+instrumentation.init_app(app)
+
+# Register CLI commands
+import commands
+
 @app.route('/')
 def index():
     """Home page - redirect to appropriate dashboard based on user role"""
@@ -67,22 +108,11 @@ def index():
 @app.context_processor
 def inject_settings():
     """Inject global settings into all templates"""
-    from models import Setting
-    settings = {}
+    from settings_cache import get_settings, DEFAULTS
     try:
-        setting_records = Setting.query.all()
-        for setting in setting_records:
-            settings[setting.key] = setting.value
+        settings = get_settings()
     except:
-        pass
-    
-    # Default values
-    if 'academy_name' not in settings:
-        settings['academy_name'] = 'Bright Star Academy'
-    if 'academy_logo' not in settings:
-        settings['academy_logo'] = ''
-    if 'background_image' not in settings:
-        settings['background_image'] = ''
+        settings = dict(DEFAULTS)
     
     return dict(settings=settings)
 
@@ -91,6 +121,16 @@ with app.app_context():
     from models import User, Question, Paper, Notification, Setting
     db.create_all()
     
+    import migrations
+    migrations.upgrade()
+    
+    from search import ensure_search_index
+    ensure_search_index()
+    
+    # Dashboard counters (importing stats also registers their update hooks)
+    from stats import ensure_counters
+    ensure_counters()
+    
     # Create default admin user if none exists
     admin = User.query.filter_by(role='admin').first()
     if not admin:
@@ -115,6 +155,10 @@ with app.app_context():
         
         db.session.commit()
         print("Default admin user created: admin@brightstar.edu / admin123")
+    
+    # Pick up any paper renders that were queued before a restart
+    from jobs import resume_pending
+    resume_pending()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
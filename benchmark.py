@@ -0,0 +1,519 @@
+"""Benchmark the request hot paths and PDF rendering.
+
+Seeds a synthetic school into a fresh SQLite database, drives the app with
+the Flask test client and writes the results as JSON:
+
+    python benchmark.py --scale small --output bench.json
+    python benchmark.py --scale medium --output new.json --compare bench.json
+
+The render_paper scenarios are a micro-benchmark of PDF layout alone (no
+database or cache): "cold" rebuilds the shared render context (styles,
+decoded logo, header paragraphs) before every render, as each render used
+to, so the two show what the context saves. The "large" scenarios render a
+revision paper of a whole subject in one pass, a section at a time, and a
+section at a time from the section cache.
+
+Each scenario reports requests/sec, p50/p95/p99 latency in milliseconds,
+database queries per request and the HTTP status codes seen. Peak RSS of
+the whole run is recorded too. The run exits non-zero if any request
+makes more queries than its QUERY_BUDGETS entry, at any --scale, or if a
+budgeted scenario gets a 5xx response. tests/test_query_budgets.py checks
+the same budgets with templates that read each page's relationships.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+
+SCALES = {
+    'small': dict(teachers=20, students=500, questions=5000, papers=500, notifications=100, files=50),
+    'medium': dict(teachers=100, students=5000, questions=50000, papers=5000, notifications=500, files=200),
+    'large': dict(teachers=300, students=20000, questions=200000, papers=20000, notifications=2000, files=1000),
+}
+
+SUBJECTS = ['Mathematics', 'Physics', 'Chemistry', 'Biology', 'English', 'History']
+CLASSES = ['6', '7', '8', '9', '10']
+QUESTION_TYPES = ['MCQ', 'Short', 'Long']
+WORDS = ('energy force motion cell atom reaction equation triangle poem empire river '
+         'climate fraction angle velocity molecule organism story treaty graph').split()
+# Most queries a single request may make, whatever the scale. Pages that
+# list rows must load related objects up front (joinedload / selectinload or
+# grouped count queries), so a page of 500 rows costs what a page of 5 does.
+QUERY_BUDGETS = {
+    'admin.dashboard': 4,
+    'admin.manage_questions': 4,
+    'admin.manage_teachers': 4,
+    'teacher.dashboard': 6,
+    'student.dashboard': 5,
+    'student.dashboard subject': 5,
+    'teacher.generate_paper GET': 3,
+    'teacher.generate_paper POST': 8,
+    'teacher.preview_paper': 4,
+    'student.download_file': 3,
+    'student.download_file 304': 3,
+    'student.download_file range': 3,
+    'generate_paper_pdf': 2,
+    'generate_paper_pdf cached': 2,
+}
+
+PASSWORD = 'benchmark'
+QUESTIONS_PER_PAPER = 20
+INSERT_BATCH = 5000
+DOWNLOAD_SIZE = 2 * 1024 * 1024  # bytes in the shared file the download scenarios fetch
+
+def _insert(db, model, rows):
+    for start in range(0, len(rows), INSERT_BATCH):
+        db.session.execute(db.insert(model), rows[start:start + INSERT_BATCH])
+    db.session.commit()
+
+def _write_logo():
+    from PIL import Image
+    path = os.path.join('uploads', 'logos', 'benchmark_logo.png')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.radial_gradient('L').resize((600, 600)).convert('RGB').save(path)
+    return path
+
+def seed(counts, rng):
+    """Fill an empty database with a synthetic school of the given size"""
+    from werkzeug.security import generate_password_hash
+    from app import db
+    from models import User, Question, Paper, PaperQuestion, Notification, DownloadFile
+    from question_bank import invalidate_question_tree
+    from stats import reconcile_counters
+
+    now = datetime.utcnow()
+    password_hash = generate_password_hash(PASSWORD)
+    logo_path = _write_logo()
+    first_user = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+
+    admin = dict(id=first_user, name='Benchmark Admin', email='admin@bench.local',
+                 password_hash=password_hash, role='admin', is_active=True, created_at=now)
+    teachers = [dict(id=first_user + 1 + i, name=f'Teacher {i}', email=f'teacher{i}@bench.local',
+                     password_hash=password_hash, role='teacher', is_active=True,
+                     subject=rng.choice(SUBJECTS), class_assigned=rng.choice(CLASSES),
+                     created_at=now - timedelta(days=rng.randint(0, 365)))
+                for i in range(counts['teachers'])]
+    first_student = first_user + 1 + len(teachers)
+    students = [dict(id=first_student + i, name=f'Student {i}', email=f'student{i}@bench.local',
+                     password_hash=password_hash, role='student', is_active=True,
+                     class_assigned=rng.choice(CLASSES), roll_no=str(i),
+                     created_at=now - timedelta(days=rng.randint(0, 365)))
+                 for i in range(counts['students'])]
+    _insert(db, User, [admin] + teachers + students)
+
+    questions = []
+    bank = {}  # (subject, class) -> [(id, marks)]
+    for i in range(1, counts['questions'] + 1):
+        subject, class_level = rng.choice(SUBJECTS), rng.choice(CLASSES)
+        question_type = rng.choice(QUESTION_TYPES)
+        has_parts = question_type == 'Long' and rng.random() < 0.3
+        marks = {'MCQ': 1, 'Short': rng.choice([2, 3]), 'Long': rng.choice([4, 5, 6])}[question_type]
+        questions.append(dict(
+            id=i, subject=subject, class_level=class_level,
+            chapter_number=rng.randint(1, 15), chapter_name=f'Chapter on {rng.choice(WORDS)}',
+            question_type=question_type, question_text=' '.join(rng.choices(WORDS, k=12)) + '?',
+            options=json.dumps(rng.sample(WORDS, 4)) if question_type == 'MCQ' else None,
+            marks=marks, has_parts=has_parts,
+            part_a_text='Part A: ' + ' '.join(rng.choices(WORDS, k=8)) if has_parts else None,
+            part_a_marks=2 if has_parts else None,
+            part_b_text='Part B: ' + ' '.join(rng.choices(WORDS, k=8)) if has_parts else None,
+            part_b_marks=marks - 2 if has_parts else None,
+            created_by=rng.choice(teachers)['id'] if teachers else admin['id'],
+            created_at=now - timedelta(minutes=rng.randint(0, 500000)),
+        ))
+        bank.setdefault((subject, class_level), []).append((i, marks))
+    _insert(db, Question, questions)
+    invalidate_question_tree()
+
+    papers, links = [], []
+    for i in range(1, counts['papers'] + 1):
+        teacher = rng.choice(teachers)
+        subject, class_level = rng.choice(list(bank))
+        chosen = rng.sample(bank[(subject, class_level)], min(QUESTIONS_PER_PAPER, len(bank[(subject, class_level)])))
+        papers.append(dict(
+            id=i, title=f'{subject} test {i}', subject=subject, class_level=class_level,
+            total_marks=sum(m for _, m in chosen), time_allowed=rng.choice([60, 90, 180]),
+            teacher_id=teacher['id'], question_ids=json.dumps([q for q, _ in chosen]),
+            pdf_status='done', logo_path=logo_path,
+            created_at=now - timedelta(minutes=rng.randint(0, 500000)),
+        ))
+        links.extend(dict(paper_id=i, question_id=q, position=n) for n, (q, _) in enumerate(chosen))
+    _insert(db, Paper, papers)
+    _insert(db, PaperQuestion, links)
+
+    _insert(db, Notification, [
+        dict(title=f'Notice {i}', message=' '.join(rng.choices(WORDS, k=30)),
+             target_role=rng.choice(['teacher', 'student', 'all']), is_active=rng.random() < 0.8,
+             created_by=admin['id'], created_at=now - timedelta(hours=rng.randint(0, 5000)))
+        for i in range(counts['notifications'])
+    ])
+    _insert(db, DownloadFile, [
+        dict(title=f'Resource {i}', file_path=f'uploads/downloads/file{i}.pdf', file_type='pdf',
+             target_role=rng.choice(['teacher', 'student', 'all']), class_level=rng.choice(CLASSES + [None]),
+             is_active=True, download_count=0, created_by=admin['id'],
+             created_at=now - timedelta(hours=rng.randint(0, 5000)))
+        for i in range(counts['files'])
+    ])
+    # Core inserts skip the dashboard counter hooks
+    reconcile_counters()
+
+    return {'admin': admin, 'teacher': teachers[0], 'student': students[0], 'bank': bank}
+
+class QueryCounter:
+    """Counts statements sent to the database from this thread (not job workers)"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        self.thread = threading.get_ident()
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        if threading.get_ident() == self.thread:
+            self.count += 1
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def measure(name, action, counter, iterations, warmup):
+    """Run action repeatedly and summarise latency and queries per call"""
+    for _ in range(warmup):
+        action()
+
+    latencies, queries, statuses = [], [], {}
+    started = time.perf_counter()
+    for _ in range(iterations):
+        before = counter.count
+        t = time.perf_counter()
+        status = action()
+        latencies.append((time.perf_counter() - t) * 1000)
+        queries.append(counter.count - before)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    result = {
+        'iterations': iterations,
+        'requests_per_sec': round(iterations / elapsed, 2) if elapsed else None,
+        'p50_ms': round(_percentile(latencies, 0.50), 3),
+        'p95_ms': round(_percentile(latencies, 0.95), 3),
+        'p99_ms': round(_percentile(latencies, 0.99), 3),
+        'queries_per_request': round(sum(queries) / len(queries), 2),
+        'max_queries': max(queries),
+        'statuses': statuses,
+    }
+    print(f'{name:40} {result["requests_per_sec"]:>9} req/s  p50 {result["p50_ms"]:>8} ms  '
+          f'p95 {result["p95_ms"]:>8} ms  {result["queries_per_request"]:>6} queries  {statuses}',
+          file=sys.stderr)
+    return result
+
+def _login(client, email):
+    response = client.post('/auth/login', data={'email': email, 'password': PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError(f'Could not log in as {email}')
+
+def _wait_for_jobs(db, Job, timeout=600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pending = db.session.query(Job.id).filter(Job.status.in_(['queued', 'running'])).count()
+        db.session.rollback()
+        if not pending:
+            return
+        time.sleep(0.1)
+
+def run_scenarios(people, iterations, warmup, rng):
+    from app import app, db
+    from models import Paper, Job, DownloadFile
+    from pdf_generator import (generate_paper_pdf, get_academy_name, get_paper_questions, render_paper,
+                               render_answer_key, render_sections)
+    from pdf_layout import reset_render_context
+    from models import Question
+    from downloads import flush_download_counts
+    import pdf_cache
+
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+    results = {}
+
+    admin_client = app.test_client()
+    _login(admin_client, people['admin']['email'])
+    teacher_client = app.test_client()
+    _login(teacher_client, people['teacher']['email'])
+    student_client = app.test_client()
+    _login(student_client, people['student']['email'])
+
+    def get(client, url):
+        return lambda: client.get(url).status_code
+
+    results['admin.dashboard'] = measure('admin.dashboard', get(admin_client, '/admin/dashboard'),
+                                         counter, iterations, warmup)
+    results['admin.manage_questions'] = measure('admin.manage_questions', get(admin_client, '/admin/questions'),
+                                                counter, iterations, warmup)
+    results['admin.manage_teachers'] = measure('admin.manage_teachers', get(admin_client, '/admin/teachers'),
+                                               counter, iterations, warmup)
+    results['teacher.dashboard'] = measure('teacher.dashboard', get(teacher_client, '/teacher/dashboard'),
+                                           counter, iterations, warmup)
+    results['student.dashboard'] = measure('student.dashboard', get(student_client, '/student/dashboard'),
+                                           counter, iterations, warmup)
+    results['student.dashboard subject'] = measure('student.dashboard subject',
+                                                   get(student_client, f'/student/dashboard?subject={SUBJECTS[0]}'),
+                                                   counter, iterations, warmup)
+    # A shared file the student may download, fetched whole, revalidated
+    # against its ETag, and resumed halfway through
+    with app.app_context():
+        shared = DownloadFile.query.filter(DownloadFile.target_role.in_(['student', 'all']),
+                                           DownloadFile.class_level.is_(None)).first()
+        file_url = f'/student/downloads/file/{shared.id}'
+        os.makedirs(os.path.dirname(shared.file_path), exist_ok=True)
+        with open(shared.file_path, 'wb') as f:
+            f.write(rng.randbytes(DOWNLOAD_SIZE))
+    etag = student_client.get(file_url).headers.get('ETag')
+
+    def download(headers=None):
+        def action():
+            response = student_client.get(file_url, headers=headers)
+            response.get_data()
+            return response.status_code
+        return action
+
+    results['student.download_file'] = measure('student.download_file', download(), counter, iterations, warmup)
+    results['student.download_file 304'] = measure('student.download_file 304', download({'If-None-Match': etag}),
+                                                   counter, iterations, warmup)
+    results['student.download_file range'] = measure('student.download_file range',
+                                                     download({'Range': f'bytes={DOWNLOAD_SIZE // 2}-'}),
+                                                     counter, iterations, warmup)
+    with app.app_context():
+        # Write the batched counts now, while the scratch database still exists
+        flush_download_counts()
+        downloads = db.session.get(DownloadFile, shared.id).download_count
+        db.session.rollback()
+    if downloads != iterations + warmup + 1:
+        print(f'student.download_file counted {downloads} downloads', file=sys.stderr)
+    results['teacher.generate_paper GET'] = measure('teacher.generate_paper GET',
+                                                    get(teacher_client, '/teacher/generate-paper'),
+                                                    counter, iterations, warmup)
+
+    # A valid selection: some questions of one subject and class, marks matching the total
+    (subject, class_level), candidates = max(people['bank'].items(), key=lambda item: len(item[1]))
+    chosen = rng.sample(candidates, min(QUESTIONS_PER_PAPER, len(candidates)))
+    form = {
+        'title': 'Benchmark paper', 'subject': subject, 'class_level': class_level,
+        'total_marks': str(sum(m for _, m in chosen)), 'time_allowed': '90',
+        'questions': [str(q) for q, _ in chosen],
+    }
+    results['teacher.generate_paper POST'] = measure(
+        'teacher.generate_paper POST',
+        lambda: teacher_client.post('/teacher/generate-paper', data=form).status_code,
+        counter, iterations, warmup)
+    results['teacher.preview_paper'] = measure(
+        'teacher.preview_paper',
+        lambda: teacher_client.post('/teacher/papers/preview', data=form).status_code,
+        counter, max(1, iterations // 5), min(warmup, 1))
+    # Let the queued renders finish so they don't slow the scenarios after this one
+    with app.app_context():
+        _wait_for_jobs(db, Job)
+
+    with app.app_context():
+        paper = Paper.query.order_by(Paper.id).first()
+
+        def render():
+            for path in generate_paper_pdf(paper):
+                if path:
+                    os.remove(path)  # Force a full render every time
+            return 'rendered'
+
+        results['generate_paper_pdf'] = measure('generate_paper_pdf', render, counter,
+                                                max(1, iterations // 5), min(warmup, 1))
+        results['generate_paper_pdf cached'] = measure('generate_paper_pdf cached',
+                                                       lambda: generate_paper_pdf(paper) and 'cached',
+                                                       counter, iterations, warmup)
+
+        questions = get_paper_questions(paper)
+        academy_name = get_academy_name()
+
+        def render_to_memory():
+            render_paper(BytesIO(), paper, questions, academy_name)
+            return 'rendered'
+
+        def render_answer_key_to_memory():
+            render_answer_key(BytesIO(), paper, questions, academy_name)
+            return 'rendered'
+
+        def render_cold():
+            reset_render_context()
+            return render_to_memory()
+
+        results['render_paper cold'] = measure('render_paper cold', render_cold, counter,
+                                               max(1, iterations // 5), min(warmup, 1))
+        results['render_paper'] = measure('render_paper', render_to_memory, counter,
+                                          max(1, iterations // 5), min(warmup, 1))
+        results['render_answer_key'] = measure('render_answer_key', render_answer_key_to_memory, counter,
+                                               max(1, iterations // 5), min(warmup, 1))
+
+        # A revision paper: every question of the biggest subject and class,
+        # laid out in one pass and a section at a time
+        ids = [q for q, _ in candidates]
+        large = Question.query.filter(Question.id.in_(ids)).order_by(Question.question_type, Question.id).all()
+
+        def render_large():
+            render_paper(BytesIO(), paper, large, academy_name)
+            return 'rendered'
+
+        def render_large_sections():
+            for entry in os.scandir(pdf_cache.CACHE_DIR):
+                if entry.name.startswith('section_'):
+                    os.remove(entry.path)
+            render_sections(BytesIO(), paper, large, academy_name)
+            return 'rendered'
+
+        results['render_paper large'] = measure('render_paper large', render_large, counter,
+                                                max(1, iterations // 10), min(warmup, 1))
+        results['render_sections large'] = measure('render_sections large', render_large_sections, counter,
+                                                   max(1, iterations // 10), min(warmup, 1))
+        results['render_sections large cached'] = measure(
+            'render_sections large cached',
+            lambda: render_sections(BytesIO(), paper, large, academy_name) or 'cached',
+            counter, max(1, iterations // 10), min(warmup, 1))
+
+    return results
+
+def check_query_budgets(scenarios):
+    """Scenarios whose worst request made more queries than QUERY_BUDGETS allows.
+
+    A budgeted scenario with any 5xx response is a violation too: a page that
+    fails before its template has run makes fewer queries, not more.
+    """
+    violations = {}
+    for name, result in scenarios.items():
+        if name not in QUERY_BUDGETS:
+            continue
+        server_errors = sum(count for status, count in result['statuses'].items()
+                            if status.isdigit() and int(status) >= 500)
+        if server_errors or result['max_queries'] > QUERY_BUDGETS[name]:
+            violations[name] = {'max_queries': result['max_queries'], 'budget': QUERY_BUDGETS[name],
+                                'server_errors': server_errors}
+    return violations
+
+def compare(current, baseline):
+    """Print how each scenario moved against an earlier run"""
+    print(f'\n{"scenario":40} {"req/s":>18} {"p95 ms":>20} {"queries":>14}', file=sys.stderr)
+    for name, now in current['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            print(f'{name:40} (new)', file=sys.stderr)
+            continue
+
+        def change(key):
+            old, new = before.get(key), now.get(key)
+            if not old or new is None:
+                return f'{new}'
+            return f'{new} ({(new - old) / old:+.0%})'
+
+        print(f'{name:40} {change("requests_per_sec"):>18} {change("p95_ms"):>20} '
+              f'{change("queries_per_request"):>14}', file=sys.stderr)
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--iterations', type=int, default=50, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=5, help='untimed requests per scenario')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the synthetic data')
+    parser.add_argument('--output', help='write results JSON here (default: stdout)')
+    parser.add_argument('--compare', help='earlier results JSON to compare against')
+    parser.add_argument('--keep', action='store_true', help="keep the benchmark's working directory")
+    parser.add_argument('--verbose', action='store_true', help='show app logging, including request errors')
+    args = parser.parse_args(argv)
+
+    # The app reads its database URL at import time, and writes uploads and
+    # PDFs relative to the working directory, so both go in a scratch dir
+    workdir = tempfile.mkdtemp(prefix='benchmark-')
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(workdir, "benchmark.db")}'
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+
+    try:
+        from app import app
+        app.root_path = workdir
+        if not args.verbose:
+            # Failed requests still show up in each scenario's status counts
+            logging.getLogger().setLevel(logging.WARNING)
+            app.logger.disabled = True
+        rng = random.Random(args.seed)
+
+        started = time.perf_counter()
+        with app.app_context():
+            people = seed(SCALES[args.scale], rng)
+        seed_seconds = time.perf_counter() - started
+        print(f'Seeded {args.scale} dataset in {seed_seconds:.1f}s', file=sys.stderr)
+
+        scenarios = run_scenarios(people, args.iterations, args.warmup, rng)
+
+        results = {
+            'meta': {
+                'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+                'commit': _git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'scale': args.scale,
+                'counts': SCALES[args.scale],
+                'iterations': args.iterations,
+                'warmup': args.warmup,
+                'seed': args.seed,
+                'seed_seconds': round(seed_seconds, 2),
+            },
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'scenarios': scenarios,
+            'query_budget_violations': check_query_budgets(scenarios),
+        }
+    finally:
+        if args.keep:
+            print(f'Working directory kept at {workdir}', file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    violations = results['query_budget_violations']
+    for name, violation in violations.items():
+        if violation['server_errors']:
+            print(f'SERVER ERRORS: {name} returned {violation["server_errors"]} 5xx responses, so its '
+                  f'query count is not the real page\'s (run with --verbose to see them)', file=sys.stderr)
+        else:
+            print(f'QUERY BUDGET EXCEEDED: {name} made {violation["max_queries"]} queries '
+                  f'(budget {violation["budget"]})', file=sys.stderr)
+    if violations:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+from io import BytesIO
+from pypdf import PdfReader, PdfWriter
+from werkzeug.utils import secure_filename
+from flask import current_app
+from models import User, Paper
+from app import db
+from jobs import job_handler
+from pdf_generator import get_academy_name, get_paper_questions, record_renders, render_paper, try_answer_key
+from pdf_layout import personalize_pdf
+from workers import process_pool
+import os
+import zipfile
+
+# A class set is one paper personalised for every student in a class. The
+# shared paper (questions, instructions, sections) is laid out once without
+# a name or watermark; each student's copy is that layout with a small
+# overlay page (name and watermark) stamped underneath every page. The
+# stamping (pdf_layout.personalize_pdf) is spread over a process pool.
+
+CLASS_SET_DIR = 'uploads/papers/class_sets'
+OUTPUT_FORMATS = ('zip', 'merged')
+
+def class_students(class_level):
+    """Active students assigned to a class, in roll number order"""
+    return User.query.filter_by(role='student', class_assigned=class_level, is_active=True) \
+        .order_by(User.roll_no, User.name).all()
+
+def build_class_set(paper, students, output_format):
+    """Render a personalised copy of paper for each student, and its answer key.
+
+    Returns (path, answer key path). The path is of a ZIP with one PDF per
+    student, or of a single merged PDF, depending on output_format. The
+    answer key path is None if the key failed to render.
+    """
+    academy_name = get_academy_name()
+    questions = get_paper_questions(paper)
+    watermark_text = paper.watermark or academy_name
+    answer_key_path = try_answer_key(paper, questions, academy_name)
+
+    base = BytesIO()
+    render_paper(base, paper, questions, academy_name, personalize=False)
+    base_pdf = base.getvalue()
+
+    jobs = [(base_pdf, s.name, s.roll_no, watermark_text) for s in students]
+    workers = current_app.config['CLASS_SET_WORKERS']
+    with process_pool(workers) as pool:
+        copies = list(pool.map(personalize_pdf, *zip(*jobs), chunksize=max(1, len(jobs) // (workers * 4))))
+
+    os.makedirs(CLASS_SET_DIR, exist_ok=True)
+    if output_format == 'zip':
+        filepath = os.path.join(CLASS_SET_DIR, f'paper_{paper.id}_class_set.zip')
+        # PDFs are already compressed, so store them as-is
+        with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_STORED) as archive:
+            for student, pdf in zip(students, copies):
+                name = secure_filename(f'{student.roll_no or student.id}_{student.name}') or str(student.id)
+                archive.writestr(f'{name}.pdf', pdf)
+    else:
+        filepath = os.path.join(CLASS_SET_DIR, f'paper_{paper.id}_class_set.pdf')
+        writer = PdfWriter()
+        for pdf in copies:
+            writer.append(PdfReader(BytesIO(pdf)))
+        with open(filepath, 'wb') as f:
+            writer.write(f)
+
+    return filepath, answer_key_path
+
+@job_handler('render_class_set')
+def render_class_set_job(paper_id):
+    """Background job: build the personalised class set for a paper"""
+    paper = db.session.get(Paper, paper_id)
+    if paper is None:
+        return
+
+    try:
+        students = class_students(paper.class_level)
+        if not students:
+            raise ValueError(f'No active students are assigned to class {paper.class_level}.')
+        paper.pdf_path, paper.answer_key_path = build_class_set(paper, students, paper.class_set)
+        record_renders(paper)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        paper.pdf_status = paper.answer_key_status = 'failed'
+        paper.pdf_error = str(e)
+        paper.render_failures = (paper.render_failures or 0) + 1
+        db.session.commit()
+        raise
@@ -0,0 +1,133 @@
+from app import app
+import click
+
+@app.cli.command('upgrade-db')
+def upgrade_db():
+    """Add missing columns and indexes to an existing database."""
+    import migrations
+    migrations.upgrade()
+    click.echo('Database is up to date.')
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if any query the pages run falls back to a full table scan."""
+    from query_plans import capture_statements, check_query_plans
+    statements = capture_statements()
+    failures = check_query_plans(statements)
+    for name, statement, plan in failures:
+        click.echo(f'FULL SCAN: {name}', err=True)
+        click.echo(f'    {" ".join(statement.split())}', err=True)
+        for line in plan:
+            click.echo(f'    {line}', err=True)
+    if failures:
+        raise SystemExit(1)
+    click.echo(f'All {len(statements)} queries the pages run use an index.')
+
+@app.cli.command('reconcile-stats')
+def reconcile_stats_command():
+    """Recount the admin dashboard statistics from the source tables."""
+    from stats import reconcile_counters
+    counts = reconcile_counters()
+    click.echo(f'Recounted {len(counts) - 1} dashboard counters.')
+
+@app.cli.command('collect-storage')
+@click.option('--grace', type=int, default=None, help='Seconds an unreferenced file is kept. Defaults to STORAGE_GC_GRACE.')
+def collect_storage_command(grace):
+    """Delete stored uploads that nothing refers to any more."""
+    from storage import collect_garbage
+    removed = collect_garbage(grace)
+    click.echo(f'Removed {removed} unreferenced stored files.')
+
+@app.cli.command('adopt-uploads')
+def adopt_uploads_command():
+    """Move files uploaded before storage.py into storage."""
+    from media import adopt_uploads
+    moved = adopt_uploads()
+    click.echo(f'Moved {moved} uploaded files into storage.')
+
+@app.cli.command('import-questions')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'json', 'jsonl', 'xlsx']),
+              help='File format. Defaults to the file extension.')
+@click.option('--created-by', default=None, help='Email of the user the questions are credited to. Defaults to the first admin.')
+def import_questions_command(path, file_format, created_by):
+    """Bulk import questions from a CSV, JSON, JSON Lines or XLSX file."""
+    import os
+    from models import User
+    from question_import import FORMATS, ImportFileError, import_questions
+
+    file_format = file_format or FORMATS.get(os.path.splitext(path)[1].lower())
+    if file_format is None:
+        raise click.UsageError('Unknown file type; pass --format.')
+
+    user = (User.query.filter_by(email=created_by).first() if created_by
+            else User.query.filter_by(role='admin').order_by(User.id).first())
+    if user is None:
+        raise click.UsageError('No such user.' if created_by else 'Create an admin user first.')
+
+    def progress(report, done):
+        click.echo(f'{report["rows"]} rows read ({done:.0%}), {report["imported"]} imported', err=True)
+
+    try:
+        report = import_questions(path, file_format, user.id, progress=progress)
+    except ImportFileError as e:
+        raise click.ClickException(str(e))
+
+    for error in report['errors']:
+        click.echo(f'Row {error["row"]}: {error["error"]}', err=True)
+    if report['error_count'] > len(report['errors']):
+        click.echo(f'... and {report["error_count"] - len(report["errors"])} more errors', err=True)
+    click.echo(f'Imported {report["imported"]} of {report["rows"]} rows '
+               f'({report["duplicates"]} duplicates skipped, {report["error_count"]} errors).')
+
+@app.cli.command('import-roster')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--role', type=click.Choice(['student', 'teacher']), default='student',
+              help='Role for rows without a role column.')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'json', 'jsonl', 'xlsx']),
+              help='File format. Defaults to the file extension.')
+@click.option('--credentials', type=click.Path(dir_okay=False, writable=True), default=None,
+              help='Where to move the credentials sheet.')
+def import_roster_command(path, role, file_format, credentials):
+    """Create student or teacher accounts from a roster file."""
+    import os
+    import shutil
+    from question_import import FORMATS, ImportFileError
+    from roster_import import import_roster
+
+    file_format = file_format or FORMATS.get(os.path.splitext(path)[1].lower())
+    if file_format is None:
+        raise click.UsageError('Unknown file type; pass --format.')
+
+    def progress(done, total):
+        click.echo(f'{done}/{total} accounts created ({100 * done // total}%)', err=True)
+
+    try:
+        report = import_roster(path, file_format, role, progress=progress)
+    except ImportFileError as e:
+        raise click.ClickException(str(e))
+
+    for error in report['errors']:
+        click.echo(f'Row {error["row"]}: {error["error"]}', err=True)
+    if report['error_count'] > len(report['errors']):
+        click.echo(f'... and {report["error_count"] - len(report["errors"])} more errors', err=True)
+    click.echo(f'Created {report["created"]} of {report["rows"]} accounts ({report["error_count"]} errors).')
+
+    if report['credentials_path']:
+        if credentials:
+            shutil.move(report['credentials_path'], credentials)
+        click.echo(f'Credentials: {credentials or report["credentials_path"]}')
+
+@app.cli.command('export')
+@click.argument('table', type=click.Choice(['questions', 'papers', 'users', 'downloads']))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl', 'parquet']), default='csv')
+@click.option('--output', '-o', type=click.File('wb'), default='-', help='Output file (default: stdout).')
+def export_command(table, file_format, output):
+    """Export a whole table as CSV, JSON Lines or Parquet."""
+    from exports import ExportError, export_table
+
+    try:
+        for chunk in export_table(table, file_format):
+            output.write(chunk)
+    except ExportError as e:
+        raise click.ClickException(str(e))
@@ -0,0 +1,140 @@
+from flask import current_app, request, send_file
+from sqlalchemy import bindparam, func, update
+from werkzeug.http import dump_options_header
+from urllib.parse import quote
+from app import app, db
+from models import DownloadFile
+import atexit
+import logging
+import mimetypes
+import os
+import storage
+import threading
+
+# File downloads (papers, answer keys, shared files). send_download() answers
+# conditional requests (ETag / Last-Modified, 304 Not Modified) and byte
+# ranges, so an interrupted download resumes where it stopped. With
+# DOWNLOAD_OFFLOAD set, the response has no body, only a header telling the
+# front proxy which file to send:
+#
+#   nginx     X-Accel-Redirect: DOWNLOAD_ACCEL_PREFIX + the file's path,
+#             served by an internal location aliased to the app directory
+#   sendfile  X-Sendfile: the file's absolute path (Apache mod_xsendfile,
+#             lighttpd)
+#
+# Relative paths are resolved against the app directory, as send_file does,
+# and only files inside it are sent.
+#
+# Download counts are added up in memory and written in one transaction, by
+# a timer thread, at most DOWNLOAD_FLUSH_INTERVAL seconds after the first
+# download not yet written, instead of on every download.
+
+_lock = threading.Lock()
+_pending = {}  # DownloadFile id -> downloads not yet written
+_timer = None  # the scheduled flush, if any
+
+def _resolve(path):
+    """Absolute path of a file to send. Raises FileNotFoundError for paths outside the app directory."""
+    root = os.path.realpath(current_app.root_path)
+    full = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full]) != root:
+        logging.warning('Refused to send %s, which is outside %s', path, root)
+        raise FileNotFoundError(path)
+    return full
+
+def send_download(path, download_name, mimetype=None):
+    """Response sending a file as an attachment.
+
+    Raises FileNotFoundError if the file isn't there, so callers need no
+    check of their own.
+    """
+    if not path:
+        raise FileNotFoundError(path)
+    key = storage.key_for(path)
+    if key is not None:
+        path = storage.get_storage().fetch(key) or path  # a local copy of an S3 upload
+    path = _resolve(path)
+
+    offload = current_app.config['DOWNLOAD_OFFLOAD']
+    if offload == 'nginx':
+        os.stat(path)
+        response = current_app.response_class(
+            mimetype=mimetype or mimetypes.guess_type(download_name)[0] or 'application/octet-stream')
+        response.headers['Content-Disposition'] = _attachment(download_name)
+        relative = os.path.relpath(path, os.path.realpath(current_app.root_path))
+        response.headers['X-Accel-Redirect'] = current_app.config['DOWNLOAD_ACCEL_PREFIX'] + relative.replace(os.sep, '/')
+    else:
+        # send_file answers If-None-Match, If-Modified-Since and Range itself,
+        # and with USE_X_SENDFILE leaves the body to the server
+        response = send_file(path, mimetype=mimetype, as_attachment=True, download_name=download_name,
+                             conditional=True, etag=True)
+    # Downloads need a login, so shared caches must not keep them
+    response.cache_control.private = True
+    return response
+
+def _attachment(download_name):
+    """Content-Disposition for a download, built the way send_file builds it"""
+    try:
+        download_name.encode('ascii')
+        return dump_options_header('attachment', {'filename': download_name})
+    except UnicodeEncodeError:
+        simple = download_name.encode('ascii', 'ignore').decode('ascii') or 'download'
+        return dump_options_header('attachment', {'filename': simple,
+                                                  'filename*': f"UTF-8''{quote(download_name, safe='')}"})
+
+def is_full_download(response):
+    """Whether a send_download response sends the whole file, rather than
+    a resumed range or an answer to a cache revalidation"""
+    if response.status_code != 200:
+        return False
+    if current_app.config['DOWNLOAD_OFFLOAD']:
+        # The proxy answers ranges and revalidations itself, after the app's 200
+        return not any(header in request.headers for header in ('Range', 'If-None-Match', 'If-Modified-Since'))
+    return True
+
+def count_download(file_id):
+    """Count a download of a DownloadFile, written with the next flush"""
+    with _lock:
+        _pending[file_id] = _pending.get(file_id, 0) + 1
+        _schedule_flush()
+
+def _schedule_flush():
+    """Start the timer for the next flush unless one is running. Call with _lock held."""
+    global _timer
+    if _timer is None:
+        _timer = threading.Timer(app.config['DOWNLOAD_FLUSH_INTERVAL'], _flush_from_timer)
+        _timer.daemon = True
+        _timer.start()
+
+def _flush_from_timer():
+    global _timer
+    with _lock:
+        _timer = None
+    with app.app_context():
+        flush_download_counts()
+
+def flush_download_counts():
+    """Write the counted downloads to the download_file table"""
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return
+
+    statement = update(DownloadFile).where(DownloadFile.id == bindparam('file_id')) \
+        .values(download_count=func.coalesce(DownloadFile.download_count, 0) + bindparam('downloads'))
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(statement, [{'file_id': k, 'downloads': v} for k, v in sorted(pending.items())])
+    except Exception:
+        # Keep the counts for the next flush
+        with _lock:
+            for file_id, downloads in pending.items():
+                _pending[file_id] = _pending.get(file_id, 0) + downloads
+            _schedule_flush()
+        logging.exception('Could not write download counts')
+
+@atexit.register
+def _flush_at_exit():
+    with app.app_context():
+        flush_download_counts()
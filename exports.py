@@ -0,0 +1,126 @@
+from sqlalchemy import Boolean, Date, DateTime, Integer, select
+from app import db
+from models import Question, Paper, User, DownloadFile
+from datetime import date, datetime
+import csv
+import io
+import json
+
+# Streaming exports of whole tables. Rows are fetched yield_per at a time
+# (a server-side cursor on PostgreSQL) and each chunk is encoded and handed
+# on before the next is read, so memory stays flat however big the table,
+# and an HTTP response starts sending straight away.
+
+CHUNK_ROWS = 1000
+
+# Exportable tables and their columns. Password hashes are never exported.
+TABLES = {
+    'questions': [c for c in Question.__table__.columns],
+    'papers': [c for c in Paper.__table__.columns],
+    'users': [c for c in User.__table__.columns if c.name != 'password_hash'],
+    'downloads': [c for c in DownloadFile.__table__.columns],
+}
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+class ExportError(ValueError):
+    """An export can't be produced"""
+
+def _chunks(columns):
+    """Yield lists of row tuples, CHUNK_ROWS at a time"""
+    statement = select(*columns).order_by(columns[0].table.c.id).execution_options(yield_per=CHUNK_ROWS)
+    for partition in db.session.execute(statement).partitions():
+        yield partition
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def _csv(columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([c.name for c in columns])
+    for rows in _chunks(columns):
+        writer.writerows([_plain(v) for v in row] for row in rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def _jsonl(columns):
+    names = [c.name for c in columns]
+    for rows in _chunks(columns):
+        yield ''.join(json.dumps({n: _plain(v) for n, v in zip(names, row)}) + '\n'
+                      for row in rows).encode('utf-8')
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that collects bytes until they are drained"""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+def _arrow_type(pa, column):
+    if isinstance(column.type, Boolean):
+        return pa.bool_()
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    if isinstance(column.type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(column.type, Date):
+        return pa.date32()
+    return pa.string()
+
+def _parquet(columns):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(c.name, _arrow_type(pa, c)) for c in columns])
+    sink = _ChunkSink()
+    # Each chunk becomes one row group, written out as soon as it is encoded
+    with pq.ParquetWriter(sink, schema, compression='zstd') as writer:
+        for rows in _chunks(columns):
+            writer.write_batch(pa.RecordBatch.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+                schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+_ENCODERS = {'csv': _csv, 'jsonl': _jsonl, 'parquet': _parquet}
+
+def export_table(table, file_format):
+    """Return a generator of encoded byte chunks for a whole table.
+    Raises ExportError for an unknown table or format."""
+    if table not in TABLES:
+        raise ExportError(f'Unknown table {table!r}; choose from {", ".join(TABLES)}.')
+    if file_format not in _ENCODERS:
+        raise ExportError(f'Unknown format {file_format!r}; choose from {", ".join(_ENCODERS)}.')
+    if file_format == 'parquet':
+        # Fail before the response starts rather than part way through it
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ExportError('Parquet export needs the pyarrow package (pip install pyarrow).')
+    return _ENCODERS[file_format](TABLES[table])
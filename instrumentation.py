@@ -0,0 +1,169 @@
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import json
+import logging
+import re
+import threading
+import time
+
+# Per-request SQL accounting. Engine events time every statement run while
+# a request is being handled; after the request the totals go out as a
+# Server-Timing header and a structured log line, and are folded into
+# per-endpoint aggregates shown on the admin diagnostics page. A statement
+# shape (fingerprint) repeated N_PLUS_ONE_THRESHOLD times in one request is
+# reported as a likely N+1 query. With SQL_INSTRUMENTATION off nothing is
+# attached, so statements and requests pay nothing for it.
+
+logger = logging.getLogger('instrumentation')
+
+# Statements kept per request and per endpoint
+SLOWEST_KEPT = 5
+
+_lock = threading.Lock()
+_endpoints = {}
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),             # string literals
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),          # numbers
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),  # IN lists of any length
+    (re.compile(r'\s+'), ' '),
+]
+
+def fingerprint(statement):
+    """Statement with literals and IN-list lengths removed, so repeats group together"""
+    for pattern, replacement in _LITERALS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+def _request_stats():
+    if not has_request_context():
+        return None
+    stats = g.get('_sql_stats')
+    if stats is None:
+        stats = g._sql_stats = {'count': 0, 'seconds': 0.0, 'statements': {}, 'slowest': []}
+    return stats
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['_query_started'] = time.perf_counter()
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('_query_started', None)
+    if started is None:
+        return
+    stats = _request_stats()
+    if stats is None:
+        return
+
+    seconds = time.perf_counter() - started
+    stats['count'] += 1
+    stats['seconds'] += seconds
+
+    key = fingerprint(statement)
+    stats['statements'][key] = stats['statements'].get(key, 0) + 1
+
+    slowest = stats['slowest']
+    if len(slowest) < SLOWEST_KEPT or seconds > slowest[-1][0]:
+        slowest.append((seconds, key))
+        slowest.sort(reverse=True)
+        del slowest[SLOWEST_KEPT:]
+
+    if seconds * 1000 >= current_app.config['SLOW_QUERY_MS']:
+        logger.warning(json.dumps({'event': 'slow_query', 'endpoint': request.endpoint,
+                                   'ms': round(seconds * 1000, 2), 'statement': key}))
+
+def _before_request():
+    g._request_started = time.perf_counter()
+    g.pop('_sql_stats', None)  # left by an earlier request in the same app context
+
+def _after_request(response):
+    if '_request_started' not in g:
+        return response
+
+    total_ms = (time.perf_counter() - g._request_started) * 1000
+    stats = g.get('_sql_stats') or {'count': 0, 'seconds': 0.0, 'statements': {}, 'slowest': []}
+    db_ms = stats['seconds'] * 1000
+    threshold = current_app.config['N_PLUS_ONE_THRESHOLD']
+    repeated = {k: n for k, n in stats['statements'].items() if n >= threshold}
+
+    response.headers.add('Server-Timing', f'db;dur={db_ms:.1f};desc="{stats["count"]} queries"')
+    response.headers.add('Server-Timing', f'app;dur={total_ms:.1f}')
+
+    endpoint = request.endpoint or 'unmatched'
+    record = {
+        'event': 'request',
+        'endpoint': endpoint,
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'ms': round(total_ms, 2),
+        'queries': stats['count'],
+        'db_ms': round(db_ms, 2),
+    }
+    if repeated:
+        record['n_plus_one'] = repeated
+    (logger.warning if repeated else logger.info)(json.dumps(record))
+
+    _aggregate(endpoint, total_ms, stats, db_ms, repeated)
+    return response
+
+def _aggregate(endpoint, total_ms, stats, db_ms, repeated):
+    with _lock:
+        entry = _endpoints.get(endpoint)
+        if entry is None:
+            entry = _endpoints[endpoint] = {
+                'requests': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'queries': 0, 'max_queries': 0,
+                'db_ms': 0.0, 'n_plus_one_requests': 0, 'n_plus_one': {}, 'slowest': [],
+            }
+        entry['requests'] += 1
+        entry['total_ms'] += total_ms
+        entry['max_ms'] = max(entry['max_ms'], total_ms)
+        entry['queries'] += stats['count']
+        entry['max_queries'] = max(entry['max_queries'], stats['count'])
+        entry['db_ms'] += db_ms
+        if repeated:
+            entry['n_plus_one_requests'] += 1
+            for key, count in repeated.items():
+                entry['n_plus_one'][key] = max(entry['n_plus_one'].get(key, 0), count)
+        # Slowest run of each distinct statement
+        slowest = {key: ms for ms, key in entry['slowest']}
+        for seconds, key in stats['slowest']:
+            slowest[key] = max(slowest.get(key, 0.0), seconds * 1000)
+        entry['slowest'] = sorted(((ms, key) for key, ms in slowest.items()), reverse=True)[:SLOWEST_KEPT]
+
+def endpoint_stats():
+    """Per-endpoint aggregates for this process, busiest first"""
+    with _lock:
+        items = [(name, dict(entry, n_plus_one=dict(entry['n_plus_one']), slowest=list(entry['slowest'])))
+                 for name, entry in _endpoints.items()]
+    stats = []
+    for name, entry in items:
+        requests = entry['requests']
+        stats.append({
+            'endpoint': name,
+            'requests': requests,
+            'avg_ms': round(entry['total_ms'] / requests, 2),
+            'max_ms': round(entry['max_ms'], 2),
+            'avg_queries': round(entry['queries'] / requests, 2),
+            'max_queries': entry['max_queries'],
+            'avg_db_ms': round(entry['db_ms'] / requests, 2),
+            'n_plus_one_requests': entry['n_plus_one_requests'],
+            'n_plus_one': entry['n_plus_one'],
+            'slowest': [{'ms': round(ms, 2), 'statement': key} for ms, key in entry['slowest']],
+        })
+    stats.sort(key=lambda s: s['requests'], reverse=True)
+    return stats
+
+def reset_stats():
+    """Forget the per-endpoint aggregates"""
+    with _lock:
+        _endpoints.clear()
+
+def init_app(app):
+    """Time SQL per request for app, if its SQL_INSTRUMENTATION setting is on"""
+    if not app.config['SQL_INSTRUMENTATION']:
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_execute)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import update
+from app import app, db
+from models import Job
+import json
+import logging
+import threading
+
+# Background work (PDF renders and the like) runs on a small thread pool
+# inside each process. Every job is stored in the job table first, so work
+# that was queued when a worker restarted is picked up again on startup.
+
+_handlers = {}
+_executor = None
+_executor_lock = threading.Lock()
+_current = threading.local()  # job_id of the job running on this thread
+
+def job_handler(kind):
+    """Register a function as the handler for jobs of the given kind.
+    Whatever the handler returns is stored as the job's result."""
+    def decorator(f):
+        _handlers[kind] = f
+        return f
+    return decorator
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'],
+                                           thread_name_prefix='job')
+        return _executor
+
+def enqueue(kind, **payload):
+    """Store a job and hand it to the worker pool. Commits the current session."""
+    job = Job(kind=kind, status='queued')
+    job.set_payload(payload)
+    db.session.add(job)
+    db.session.commit()
+
+    _get_executor().submit(run_job, job.id)
+    return job
+
+def run_job(job_id):
+    """Claim and run a single queued job"""
+    with app.app_context():
+        # Claim the job atomically so that only one worker process runs it
+        claimed = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == 'queued')
+            .values(status='running', started_at=datetime.utcnow(), attempts=Job.attempts + 1)
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return
+
+        job = db.session.get(Job, job_id)
+        handler = _handlers.get(job.kind)
+        _current.job_id = job_id
+        try:
+            if handler is None:
+                raise ValueError(f'No handler registered for job kind {job.kind!r}')
+            result = handler(**job.get_payload())
+            job = db.session.get(Job, job_id)
+            job.status = 'done'
+            if result is not None:
+                job.set_result(result)
+        except Exception as e:
+            logging.exception('Job %s (%s) failed', job_id, job.kind)
+            db.session.rollback()
+            job = db.session.get(Job, job_id)
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            _current.job_id = None
+
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+def set_progress(percent):
+    """Record how far the job running on this thread has got (0-100).
+    Does nothing outside a job, so handlers can also be called directly."""
+    job_id = getattr(_current, 'job_id', None)
+    if job_id is None:
+        return
+    with db.engine.begin() as conn:
+        conn.execute(update(Job).where(Job.id == job_id).values(progress=int(percent)))
+
+def set_result(result):
+    """Store a result for the job running on this thread before it finishes,
+    so that a job which then fails still reports it. Does nothing outside a job."""
+    job_id = getattr(_current, 'job_id', None)
+    if job_id is None:
+        return
+    with db.engine.begin() as conn:
+        conn.execute(update(Job).where(Job.id == job_id).values(result=json.dumps(result)))
+
+def queued_job_ids():
+    """Ids of the queued jobs, oldest first"""
+    return [job_id for (job_id,) in db.session.query(Job.id).filter_by(status='queued').order_by(Job.id)]
+
+def resume_pending():
+    """Requeue jobs left behind by a previous process. Call within an app context."""
+    # A job still marked running long after it started belongs to a worker that died
+    stale_before = datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_AFTER'])
+    db.session.execute(
+        update(Job)
+        .where(Job.status == 'running', Job.started_at < stale_before)
+        .values(status='queued')
+    )
+    db.session.commit()
+
+    job_ids = queued_job_ids()
+    for job_id in job_ids:
+        _get_executor().submit(run_job, job_id)
+
+    if job_ids:
+        logging.info('Resumed %d queued job(s)', len(job_ids))
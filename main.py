@@ -1,4 +1,7 @@
-from app import app
+# Process pool workers (see workers.py) run this file again as __mp_main__;
+# they must not import the app
+if __name__ != '__mp_main__':
+    from app import app
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
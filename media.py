@@ -0,0 +1,215 @@
+from PIL import Image, ImageOps, UnidentifiedImageError
+from flask import current_app
+from sqlalchemy import update
+from app import db
+from models import DownloadFile
+from jobs import job_handler, enqueue
+from io import BytesIO
+import hashlib
+import logging
+import os
+import storage
+import threading
+
+# Uploaded images (academy logo and background, paper logos, pictures) go
+# through one pipeline. The request only checks that the upload really is
+# an image (by its content, not its name) and keeps it under the SHA-256 of
+# its bytes (see storage.py), so an image uploaded twice is kept once. A
+# background job then re-encodes it from the pixels alone, which drops EXIF,
+# GPS and other metadata, and stores the size variants:
+#
+#   original  the image itself, at most 2048 px (JPEG stays JPEG, others become PNG)
+#   pdf       PNG for a 1 inch logo at 300 dpi, used by pdf_generator
+#   thumb     small copy for listings, in the original's format
+#   webp      WebP for web pages
+#
+# An image is referred to by the path of its original variant, e.g.
+# uploads/store/3f/3f9c.../original.png; variant() maps that to the others.
+
+UPLOAD_NAME = 'upload'  # the unprocessed upload, until its variants are written
+
+FORMATS = ('PNG', 'JPEG', 'GIF', 'WEBP')
+MAX_PIXELS = 40_000_000  # refuse anything bigger than about 7000 x 5700
+
+# variant -> (longest side in pixels, format or None for the original's format)
+VARIANTS = {
+    'original': (2048, None),
+    'pdf': (300, 'PNG'),
+    'thumb': (256, None),
+    'webp': (1600, 'WEBP'),
+}
+_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp'}
+
+_lock = threading.Lock()
+
+class MediaError(ValueError):
+    """An upload is not an image we accept"""
+
+def _check(data):
+    """Validate image bytes by content and return the format PIL detected"""
+    try:
+        with Image.open(BytesIO(data)) as img:
+            if img.format not in FORMATS:
+                raise MediaError('Images must be PNG, JPEG, GIF or WebP.')
+            if img.width * img.height > MAX_PIXELS:
+                raise MediaError('The image is too large.')
+            img.verify()
+            return img.format
+    except MediaError:
+        raise
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError, ValueError):
+        raise MediaError('The file is not a valid image.')
+
+def _original_format(source_format):
+    return 'JPEG' if source_format == 'JPEG' else 'PNG'
+
+def variant(path, name):
+    """Path of a size variant of a stored image.
+
+    Images stored before the media pipeline have no variants, so their
+    own path is returned.
+    """
+    if storage.key_for(path) is None:
+        return path
+    size, image_format = VARIANTS[name]
+    extension = _EXTENSIONS[image_format] if image_format else os.path.splitext(path)[1].lstrip('.')
+    return os.path.join(os.path.dirname(path), f'{name}.{extension}')
+
+def ready_variant(path, name):
+    """Like variant(), but makes sure the file is on local disk: written
+    first if the job hasn't yet, or fetched from the storage backend.
+    None if the image isn't stored any more."""
+    wanted = variant(path, name)
+    if storage.key_for(path) is None or os.path.exists(wanted):
+        return wanted
+    if os.path.exists(os.path.join(os.path.dirname(path), UPLOAD_NAME)):
+        process_image(path)
+    elif storage.get_storage().fetch(storage.key_for(wanted)) is None:
+        logging.warning('Stored image %s has no %s variant', path, name)
+        return None
+    return wanted
+
+def save_image(upload):
+    """Validate an uploaded image, store it and queue its variants. Returns its path.
+
+    Raises MediaError if the upload is not an acceptable image.
+    """
+    return store_image(upload.read())
+
+def store_image(data):
+    """Like save_image(), for image bytes"""
+    source_format = _check(data)
+
+    digest = hashlib.sha256(data).hexdigest()
+    storage.register(digest, len(data))
+    key = storage.object_key(digest, f'original.{_EXTENSIONS[_original_format(source_format)]}')
+    path = storage.path_for(key)
+    upload_path = storage.path_for(storage.object_key(digest, UPLOAD_NAME))
+    if os.path.exists(upload_path) or storage.get_storage().exists(key):
+        return path  # the same image was uploaded before
+
+    # The raw upload waits on local disk for the job; only variants are stored
+    storage.write_atomic(upload_path, data)
+    enqueue('process_image', path=path)
+    return path
+
+def _clean(img):
+    """A copy of an image's pixels only, upright and without any metadata"""
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+    return Image.frombytes(img.mode, img.size, img.tobytes())
+
+def _encode(img, image_format):
+    if image_format == 'JPEG' and img.mode == 'RGBA':
+        img = img.convert('RGB')
+    buffer = BytesIO()
+    options = {'JPEG': {'quality': 85}, 'WEBP': {'quality': 80, 'method': 4}}.get(image_format, {})
+    img.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+def process_image(path):
+    """Write every variant of a stored image and drop the raw upload"""
+    directory = os.path.dirname(path)
+    upload_path = os.path.join(directory, UPLOAD_NAME)
+    original_format = 'JPEG' if path.endswith('.jpg') else 'PNG'
+
+    backend = storage.get_storage()
+    with _lock:
+        if all(backend.exists(storage.key_for(variant(path, name))) for name in VARIANTS):
+            return
+        try:
+            with Image.open(upload_path) as img:
+                img.seek(0)  # first frame of an animation
+                clean = _clean(img)
+        except FileNotFoundError:
+            # Another process finished it first
+            if backend.exists(storage.key_for(path)):
+                return
+            raise
+
+        for name, (size, image_format) in VARIANTS.items():
+            resized = clean.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+            backend.put(storage.key_for(variant(path, name)), _encode(resized, image_format or original_format))
+
+        os.remove(upload_path)
+    logging.info('Processed image %s', directory)
+
+def adopt_uploads():
+    """Move the files rows refer to by their old upload paths (uploads/logos,
+    uploads/backgrounds, download files, ...) into storage, so they are
+    counted and collected like new uploads. Returns how many files were moved.
+
+    Images go through the pipeline like a new upload; other files are
+    stored as they are. A file that is missing or not an acceptable image
+    is left where it is.
+    """
+    upload_folder = os.path.join(os.path.normpath(current_app.config['UPLOAD_FOLDER']), '')
+    moved = {}  # old path -> new path
+    for model, column in storage.REFERENCES.items():
+        column = getattr(model, column)
+        paths = db.session.query(column).filter(column.like(f'{upload_folder}%')).distinct()
+        for (path,) in paths:
+            if path in moved or storage.key_for(path) is not None:
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if model is DownloadFile:
+                    moved[path] = storage.store_file(data, os.path.basename(path))
+                else:
+                    moved[path] = store_image(data)
+            except (OSError, MediaError) as e:
+                logging.warning('Left %s where it is: %s', path, e)
+    db.session.rollback()
+    if not moved:
+        return 0
+
+    with db.engine.begin() as conn:
+        for model, column in storage.REFERENCES.items():
+            column = getattr(model, column)
+            for old, new in moved.items():
+                conn.execute(update(model).where(column == old).values({column: new}))
+    # Core updates skip the listeners that keep the reference counts
+    storage.recount_references()
+
+    for path in moved:
+        os.remove(path)
+    logging.info('Moved %d uploaded file(s) into storage', len(moved))
+    return len(moved)
+
+def pdf_logo(upload):
+    """The pdf variant of an uploaded image, made in memory (for previews that save nothing)"""
+    data = upload.read()
+    _check(data)
+    with Image.open(BytesIO(data)) as img:
+        img.seek(0)
+        clean = _clean(img)
+    clean.thumbnail((VARIANTS['pdf'][0],) * 2, Image.LANCZOS)
+    return BytesIO(_encode(clean, 'PNG'))
+
+@job_handler('process_image')
+def process_image_job(path):
+    """Background job: write the size variants of an uploaded image"""
+    process_image(path)
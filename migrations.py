@@ -0,0 +1,103 @@
+from sqlalchemy import inspect, text, insert
+from app import db
+import json
+import logging
+
+# db.create_all() only creates missing tables, so columns added to an
+# existing model are listed here and added to older databases on startup.
+# Each entry is (table, column, column DDL).
+COLUMNS = [
+    ('paper', 'pdf_status', "VARCHAR(20) DEFAULT 'done'"),
+    ('paper', 'pdf_error', 'TEXT'),
+    ('paper', 'class_set', 'VARCHAR(10)'),
+    ('paper', 'answer_key_path', 'VARCHAR(200)'),
+    ('paper', 'answer_key_status', 'VARCHAR(20)'),
+    ('paper', 'render_failures', 'INTEGER DEFAULT 0'),
+    ('job', 'result', 'TEXT'),
+    ('job', 'progress', 'INTEGER'),
+]
+
+# Columns made NOT NULL after rows without a value could be written. Rows
+# missing one are backfilled; PostgreSQL then enforces the constraint, while
+# SQLite (which can't alter a column) relies on the model's default.
+# Each entry is (table, column).
+NOT_NULL = [
+    ('user', 'created_at'),
+    ('question', 'created_at'),
+    ('paper', 'created_at'),
+    ('notification', 'created_at'),
+    ('download_file', 'created_at'),
+]
+
+def upgrade():
+    """Bring an existing SQLite or PostgreSQL database up to the current models"""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+
+    with db.engine.begin() as conn:
+        for table, column, ddl in COLUMNS:
+            if table not in tables:
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table)}
+            if column not in existing:
+                logging.info('Adding column %s.%s', table, column)
+                conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+
+        # Indexes declared on the models (index=True or __table_args__)
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    logging.info('Creating index %s', index.name)
+                    index.create(conn, checkfirst=True)
+
+    backfill_paper_questions()
+    backfill_created_at()
+
+def backfill_created_at():
+    """Give rows without a created_at the table's oldest one (keyset pages
+    can't order by NULL) and make the columns in NOT_NULL required"""
+    tables = set(inspect(db.engine).get_table_names())
+    with db.engine.begin() as conn:
+        for table, column in NOT_NULL:
+            if table not in tables:
+                continue
+            # The oldest, so rows of unknown age sort after every dated row
+            filled = conn.execute(text(
+                f'UPDATE "{table}" SET {column} = COALESCE((SELECT MIN({column}) FROM "{table}"), CURRENT_TIMESTAMP) '
+                f'WHERE {column} IS NULL'
+            )).rowcount
+            if filled:
+                logging.info('Backfilled %s.%s for %d row(s)', table, column, filled)
+            if conn.dialect.name == 'postgresql':
+                conn.execute(text(f'ALTER TABLE "{table}" ALTER COLUMN {column} SET NOT NULL'))
+
+def backfill_paper_questions():
+    """Copy question IDs from the legacy Paper.question_ids JSON into paper_question"""
+    from models import PaperQuestion
+
+    with db.engine.begin() as conn:
+        rows = conn.execute(text(
+            'SELECT id, question_ids FROM paper '
+            'WHERE NOT EXISTS (SELECT 1 FROM paper_question WHERE paper_question.paper_id = paper.id)'
+        )).all()
+        if not rows:
+            return
+
+        existing = {question_id for (question_id,) in conn.execute(text('SELECT id FROM question'))}
+        links = []
+        for paper_id, question_ids in rows:
+            try:
+                ids = json.loads(question_ids)
+            except (TypeError, ValueError):
+                continue
+            # Questions deleted since the paper was made can't be linked
+            ids = [q for q in dict.fromkeys(ids) if q in existing]
+            links.extend({'paper_id': paper_id, 'question_id': q, 'position': position}
+                         for position, q in enumerate(ids))
+
+        if links:
+            conn.execute(insert(PaperQuestion), links)
+        logging.info('Backfilled %d paper question link(s) for %d paper(s)', len(links), len(rows))
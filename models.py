@@ -14,11 +14,17 @@ class User(UserMixin, db.Model):
     class_assigned = db.Column(db.String(50), nullable=True)  # For students and teachers
     roll_no = db.Column(db.String(20), nullable=True)  # For students
     subject = db.Column(db.String(100), nullable=True)  # For teachers
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     
     # Relationships
     papers_created = db.relationship('Paper', backref='teacher', lazy=True, foreign_keys='Paper.teacher_id')
     
+    __table_args__ = (
+        # Role listings and class rosters (class sets, student dashboards)
+        db.Index('ix_user_role_class', 'role', 'class_assigned'),
+        db.Index('ix_user_role_name', 'role', 'name'),
+    )
+    
     def __repr__(self):
         return f'<User {self.email}>'
 
@@ -39,9 +45,21 @@ class Question(db.Model):
     part_b_text = db.Column(db.Text, nullable=True)  # Part B question text
     part_b_marks = db.Column(db.Integer, nullable=True)  # Part B marks
     has_parts = db.Column(db.Boolean, default=False)  # Whether question has A/B parts
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
+    __table_args__ = (
+        # Question bank filters: subject, then class, then chapter
+        db.Index('ix_question_subject_class_chapter', 'subject', 'class_level', 'chapter_number'),
+        db.Index('ix_question_created_by', 'created_by'),
+        db.Index('ix_question_created_at', 'created_at'),
+        # Filtered admin question pages, newest first
+        db.Index('ix_question_subject_class_created', 'subject', 'class_level', 'created_at'),
+        db.Index('ix_question_subject_created', 'subject', 'created_at'),
+        db.Index('ix_question_class_created', 'class_level', 'created_at'),
+        db.Index('ix_question_type_created', 'question_type', 'created_at'),
+    )
+    
     def get_options(self):
         """Get options as a list for MCQ questions"""
         if self.options:
@@ -67,35 +85,72 @@ class Paper(db.Model):
     time_allowed = db.Column(db.Integer, nullable=False)  # in minutes
     teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     student_name = db.Column(db.String(100), nullable=True)
+    class_set = db.Column(db.String(10), nullable=True)  # zip or merged: one personalized copy per student
     logo_path = db.Column(db.String(200), nullable=True)
     watermark = db.Column(db.String(100), nullable=True)
-    question_ids = db.Column(db.Text, nullable=False)  # JSON string of question IDs
+    question_ids = db.Column(db.Text, nullable=False)  # Legacy JSON copy of the question IDs; paper_question is authoritative
     pdf_path = db.Column(db.String(200), nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    answer_key_path = db.Column(db.String(200), nullable=True)  # answers and marks, for the owning teacher only
+    answer_key_status = db.Column(db.String(20), default='pending')  # pending, done, failed; NULL for older papers
+    pdf_status = db.Column(db.String(20), default='pending')  # pending, done, failed
+    pdf_error = db.Column(db.Text, nullable=True)
+    render_failures = db.Column(db.Integer, default=0)  # failed renders in a row; retries stop at PDF_RENDER_MAX_ATTEMPTS
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Dashboards list a teacher's or a class's papers newest first
+        db.Index('ix_paper_teacher_created', 'teacher_id', 'created_at'),
+        db.Index('ix_paper_class_created', 'class_level', 'created_at'),
+        db.Index('ix_paper_created_at', 'created_at'),
+    )
+    
+    # Relationships
+    question_links = db.relationship('PaperQuestion', backref='paper', lazy=True,
+                                     order_by='PaperQuestion.position', cascade='all, delete-orphan')
+    questions = db.relationship('Question', secondary='paper_question', lazy=True,
+                                order_by='PaperQuestion.position', viewonly=True)
     
     def get_question_ids(self):
-        """Get question IDs as a list"""
-        try:
-            return json.loads(self.question_ids)
-        except:
-            return []
+        """Get question IDs as a list, in paper order"""
+        return [link.question_id for link in self.question_links]
     
     def set_question_ids(self, ids_list):
-        """Set question IDs from a list"""
+        """Set question IDs from a list, in paper order"""
+        ids_list = list(dict.fromkeys(ids_list))  # drop repeats, keep order
+        self.question_links = [PaperQuestion(question_id=question_id, position=position)
+                               for position, question_id in enumerate(ids_list)]
         self.question_ids = json.dumps(ids_list)
     
     def __repr__(self):
         return f'<Paper {self.title}>'
 
+class PaperQuestion(db.Model):
+    """A question selected for a paper, with its position in the paper"""
+    __tablename__ = 'paper_question'
+    
+    paper_id = db.Column(db.Integer, db.ForeignKey('paper.id', ondelete='CASCADE'), primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), primary_key=True, index=True)
+    position = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f'<PaperQuestion {self.paper_id}:{self.question_id}>'
+
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     message = db.Column(db.Text, nullable=False)
     target_role = db.Column(db.String(20), nullable=False)  # teacher, student, all
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
+    __table_args__ = (
+        # Active notifications for a role, newest first
+        db.Index('ix_notification_role_active_created', 'target_role', 'is_active', 'created_at'),
+        db.Index('ix_notification_role_created', 'target_role', 'created_at'),
+        db.Index('ix_notification_created_at', 'created_at'),
+    )
+    
     def __repr__(self):
         return f'<Notification {self.title}>'
 
@@ -119,9 +174,14 @@ class DownloadFile(db.Model):
     subject = db.Column(db.String(100), nullable=True)  # specific subject or null for all
     is_active = db.Column(db.Boolean, default=True)
     download_count = db.Column(db.Integer, default=0)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
+    __table_args__ = (
+        # Active files for a role, newest first
+        db.Index('ix_download_file_role_active_created', 'target_role', 'is_active', 'created_at'),
+    )
+    
     def __repr__(self):
         return f'<DownloadFile {self.title}>'
 
@@ -138,3 +198,68 @@ class GalleryImage(db.Model):
     
     def __repr__(self):
         return f'<GalleryImage {self.title}>'
+
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # e.g. render_paper
+    payload = db.Column(db.Text, nullable=True)  # JSON string of job arguments
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, running, done, failed
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text, nullable=True)
+    result = db.Column(db.Text, nullable=True)  # JSON string returned by the handler
+    progress = db.Column(db.Integer, nullable=True)  # Percent complete, for long jobs
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def get_payload(self):
+        """Get job arguments as a dict"""
+        if self.payload:
+            try:
+                return json.loads(self.payload)
+            except:
+                return {}
+        return {}
+    
+    def set_payload(self, payload_dict):
+        """Set job arguments from a dict"""
+        self.payload = json.dumps(payload_dict)
+    
+    def get_result(self):
+        """Get the handler's result, or None"""
+        if self.result:
+            try:
+                return json.loads(self.result)
+            except:
+                return None
+        return None
+    
+    def set_result(self, result):
+        """Store a JSON-serialisable handler result"""
+        self.result = json.dumps(result)
+    
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind}: {self.status}>'
+
+class StatCounter(db.Model):
+    """A maintained count shown on the admin dashboard, e.g. 'users:teacher'
+    or 'questions:subject:Physics'. See stats.py."""
+    __tablename__ = 'stat_counter'
+    key = db.Column(db.String(200), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<StatCounter {self.key}={self.value}>'
+
+class StoredObject(db.Model):
+    """One distinct uploaded file (and anything derived from it) in storage,
+    with the number of rows that refer to it. See storage.py."""
+    __tablename__ = 'stored_object'
+    digest = db.Column(db.String(64), primary_key=True)  # SHA-256 of the uploaded bytes
+    size = db.Column(db.BigInteger)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f'<StoredObject {self.digest} refs={self.refcount}>'
@@ -0,0 +1,108 @@
+from sqlalchemy import and_, or_
+from datetime import datetime, date
+import base64
+import json
+
+# Keyset (cursor) pagination: instead of OFFSET, each page continues from the
+# sort key of the last row on the previous page, so every page costs the
+# same index lookup however deep the user pages.
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+class KeysetPage:
+    """One page of results plus the cursor for the page after it"""
+
+    def __init__(self, items, next_cursor, page_size):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.page_size = page_size
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'d': value.isoformat()}
+    return value
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if 'dt' in value:
+            return datetime.fromisoformat(value['dt'])
+        if 'd' in value:
+            return date.fromisoformat(value['d'])
+    return value
+
+def encode_cursor(values):
+    data = json.dumps([_encode_value(v) for v in values]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Decode a cursor from a URL, or None if it is missing or malformed"""
+    if not cursor:
+        return None
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data)
+        if not isinstance(values, list):
+            return None
+        return [_decode_value(v) for v in values]
+    except (ValueError, TypeError, KeyError):
+        return None
+
+def _fits(column, value):
+    """Whether a cursor value has the Python type of the column it is compared with"""
+    try:
+        expected = column.type.python_type
+    except NotImplementedError:
+        return False
+    if value is None or isinstance(value, bool) and expected is not bool:
+        return False
+    if expected is float:
+        return isinstance(value, (int, float))
+    if expected is date:
+        return isinstance(value, date) and not isinstance(value, datetime)
+    return isinstance(value, expected)
+
+def _after(sort_keys, values):
+    """WHERE clause selecting rows that sort after the given key values"""
+    clauses = []
+    for i, (column, descending) in enumerate(sort_keys):
+        equal = [c == v for (c, _), v in zip(sort_keys[:i], values[:i])]
+        beyond = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*equal, beyond))
+    return or_(*clauses)
+
+def keyset_paginate(query, sort_keys, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """Return a KeysetPage of query ordered by sort_keys.
+
+    sort_keys is a list of (column, descending) pairs. The last key must be
+    unique (normally the primary key) so the order is stable, and none of the
+    columns may be NULL.
+    """
+    page_size = max(1, min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+
+    # A cursor comes from the URL, so one that doesn't fit the sort keys
+    # starts again from the first page
+    values = decode_cursor(cursor)
+    if (isinstance(values, list) and len(values) == len(sort_keys)
+            and all(_fits(column, value) for (column, _), value in zip(sort_keys, values))):
+        query = query.filter(_after(sort_keys, values))
+
+    query = query.order_by(*[column.desc() if descending else column.asc()
+                             for column, descending in sort_keys])
+
+    # Fetch one extra row to learn whether another page exists
+    rows = query.limit(page_size + 1).all()
+    items = rows[:page_size]
+
+    next_cursor = None
+    if len(rows) > page_size:
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, column.key) for column, _ in sort_keys])
+
+    return KeysetPage(items, next_cursor, page_size)
@@ -0,0 +1,237 @@
+from flask import current_app
+from app import db
+from models import Question
+from question_bank import bank_version
+import heapq
+import random
+import threading
+import time
+
+# Builds a paper from a blueprint instead of hand-picking questions:
+#
+#   {'subject': 'Science', 'class_level': '9', 'total_marks': 50,
+#    'question_types': {'MCQ': 10, 'Short': 5, 'Long': 3},
+#    'chapter_weights': {'1': 2, '2': 1, '3': 1}}
+#
+# Every question type gets exactly its count and the marks add up to exactly
+# total_marks. Chapter weights bias which questions are drawn (chapters left
+# out of chapter_weights are not used); without weights all chapters are
+# equally likely.
+#
+# Only marks decide whether a blueprint can be met, so each type's candidates
+# are cut down to a weighted random sample of at most `count` questions per
+# distinct mark value. That sample can reach every total the full bank can,
+# and it keeps the subset-sum DP below small whatever the size of the bank.
+
+QUESTION_TYPES = ('MCQ', 'Short', 'Long')
+
+class AssemblyError(ValueError):
+    """The blueprint is invalid or the question bank cannot satisfy it"""
+
+def question_marks(marks, has_parts, part_a_marks, part_b_marks):
+    """Marks a question is worth on a paper; a two-part question is worth both parts"""
+    if has_parts and (part_a_marks or part_b_marks):
+        return (part_a_marks or 0) + (part_b_marks or 0)
+    return marks or 0
+
+_MARK_COLUMNS = (Question.marks, Question.has_parts, Question.part_a_marks, Question.part_b_marks)
+
+def selected_marks(question_ids):
+    """Total marks of the given questions, or None if any of them doesn't exist"""
+    question_ids = set(question_ids)
+    rows = db.session.query(Question.id, *_MARK_COLUMNS).filter(Question.id.in_(question_ids)).all()
+    if len(rows) != len(question_ids):
+        return None
+    return sum(question_marks(*row[1:]) for row in rows)
+
+_lock = threading.Lock()
+_index = {}  # (subject, class_level) -> (bank version, expires at, {type: [(id, chapter, marks)]})
+_stats = {'hits': 0, 'misses': 0}
+
+def bank_index(subject, class_level):
+    """{question_type: [(id, chapter_number, marks), ...]} for one subject and class"""
+    key = (subject, class_level)
+    version = bank_version()
+    now = time.monotonic()
+    with _lock:
+        entry = _index.get(key)
+        if entry is not None and entry[0] == version and entry[1] > now:
+            _stats['hits'] += 1
+            return entry[2]
+        _stats['misses'] += 1
+
+    index = {}
+    rows = db.session.query(Question.id, Question.chapter_number, Question.question_type, *_MARK_COLUMNS) \
+        .filter_by(subject=subject, class_level=class_level).all()
+    for question_id, chapter_number, question_type, *mark_columns in rows:
+        marks = question_marks(*mark_columns)
+        if marks > 0:
+            index.setdefault(question_type, []).append((question_id, chapter_number, marks))
+
+    with _lock:
+        _index[key] = (version, now + current_app.config['ASSEMBLY_INDEX_TTL'], index)
+    return index
+
+def cache_stats():
+    """Snapshot of the hit/miss counters for this process"""
+    with _lock:
+        stats = dict(_stats, size=len(_index))
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+def parse_blueprint(data):
+    """Validate a blueprint dict (e.g. request JSON) and normalise its types"""
+    if not isinstance(data, dict):
+        raise AssemblyError('Blueprint must be an object.')
+
+    subject = data.get('subject')
+    class_level = data.get('class_level')
+    if not subject or not class_level:
+        raise AssemblyError('Subject and class are required.')
+
+    try:
+        total_marks = int(data.get('total_marks'))
+        question_types = {t: int(n) for t, n in (data.get('question_types') or {}).items() if int(n) > 0}
+        chapter_weights = {int(c): float(w) for c, w in (data.get('chapter_weights') or {}).items()}
+    except (TypeError, ValueError, AttributeError):
+        raise AssemblyError('Marks, question counts and chapter weights must be numbers.')
+
+    if total_marks <= 0:
+        raise AssemblyError('Total marks must be positive.')
+    # The DP's size grows with both, so they are capped before any work is done
+    max_marks = current_app.config['ASSEMBLY_MAX_MARKS']
+    if total_marks > max_marks:
+        raise AssemblyError(f'Total marks can be at most {max_marks}.')
+    if not question_types:
+        raise AssemblyError('Ask for at least one question.')
+    max_questions = current_app.config['ASSEMBLY_MAX_QUESTIONS']
+    if sum(question_types.values()) > max_questions:
+        raise AssemblyError(f'A paper can have at most {max_questions} questions.')
+    unknown = set(question_types) - set(QUESTION_TYPES)
+    if unknown:
+        raise AssemblyError(f'Unknown question type: {", ".join(sorted(unknown))}.')
+    if any(w < 0 for w in chapter_weights.values()):
+        raise AssemblyError('Chapter weights cannot be negative.')
+    if chapter_weights and not any(chapter_weights.values()):
+        raise AssemblyError('At least one chapter needs a positive weight.')
+    seed = data.get('seed')
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool)):
+        raise AssemblyError('Seed must be a whole number.')
+
+    return {
+        'subject': subject,
+        'class_level': class_level,
+        'total_marks': total_marks,
+        'question_types': question_types,
+        'chapter_weights': chapter_weights,
+        'seed': seed,
+    }
+
+def _candidate_pool(questions, count, chapter_weights, rng):
+    """Weighted random sample keeping at most count questions of each mark value,
+    best draw first, as (id, chapter, marks)"""
+    by_marks = {}
+    for question_id, chapter_number, marks in questions:
+        weight = chapter_weights.get(chapter_number, 0.0) if chapter_weights else 1.0
+        if weight <= 0:
+            continue
+        # Weighted sampling without replacement: keep the largest u ** (1 / w)
+        draw = rng.random() ** (1.0 / weight)
+        by_marks.setdefault(marks, []).append((draw, question_id, chapter_number))
+
+    pool = []
+    for marks, drawn in by_marks.items():
+        pool.extend((draw, question_id, chapter_number, marks)
+                    for draw, question_id, chapter_number in heapq.nlargest(count, drawn))
+    pool.sort(reverse=True)
+    return [(question_id, chapter_number, marks) for _, question_id, chapter_number, marks in pool]
+
+def _reachable(pool, count, limit):
+    """layers[i][k] is a bitmask of the totals (up to limit) that exactly k of
+    the first i pool questions can add up to"""
+    mask = (1 << (limit + 1)) - 1
+    layer = [1] + [0] * count
+    layers = [layer]
+    for _, _, marks in pool:
+        layer = layer[:]
+        for k in range(count, 0, -1):
+            layer[k] |= (layer[k - 1] << marks) & mask
+        layers.append(layer)
+    return layers
+
+def _sumset(a, b, limit):
+    """Bitmask of every x + y with x in a and y in b, up to limit"""
+    mask = (1 << (limit + 1)) - 1
+    result = 0
+    shift = 0
+    while a >> shift:
+        if (a >> shift) & 1:
+            result |= (b << shift) & mask
+        shift += 1
+    return result
+
+def _bits(mask):
+    return [i for i in range(mask.bit_length()) if (mask >> i) & 1]
+
+def _pick(pool, layers, count, total):
+    """Walk the DP back to exactly count questions worth total, preferring the
+    earliest (best drawn) questions in the pool"""
+    chosen = []
+    for i in range(len(pool), 0, -1):
+        if count == 0:
+            break
+        if (layers[i - 1][count] >> total) & 1:
+            continue  # Reachable without question i - 1
+        chosen.append(pool[i - 1])
+        count -= 1
+        total -= pool[i - 1][2]
+    return chosen
+
+def assemble_paper(blueprint):
+    """Choose questions meeting a parsed blueprint. Raises AssemblyError if no
+    combination of questions in the bank does."""
+    rng = random.Random(blueprint['seed'])
+    limit = blueprint['total_marks']
+    index = bank_index(blueprint['subject'], blueprint['class_level'])
+
+    types = [t for t in QUESTION_TYPES if t in blueprint['question_types']]
+    groups = []
+    for question_type in types:
+        count = blueprint['question_types'][question_type]
+        pool = _candidate_pool(index.get(question_type, []), count, blueprint['chapter_weights'], rng)
+        if len(pool) < count:
+            raise AssemblyError(f'Only {len(pool)} {question_type} questions are available for this '
+                                f'subject, class and chapters; {count} were requested.')
+        layers = _reachable(pool, count, limit)
+        groups.append((question_type, count, pool, layers))
+
+    # suffix[i]: totals reachable by the question types from i onwards
+    suffix = [1]
+    for _, count, _, layers in reversed(groups):
+        suffix.insert(0, _sumset(layers[-1][count], suffix[0], limit))
+    if not (suffix[0] >> limit) & 1:
+        raise AssemblyError(f'No combination of questions adds up to exactly {limit} marks. '
+                            f'Try different question counts or chapters.')
+
+    # Split the marks between types at random among the splits that work
+    questions = []
+    marks_by_type = {}
+    remaining = limit
+    for i, (question_type, count, pool, layers) in enumerate(groups):
+        options = [s for s in _bits(layers[-1][count])
+                   if s <= remaining and (suffix[i + 1] >> (remaining - s)) & 1]
+        share = rng.choice(options)
+        remaining -= share
+        marks_by_type[question_type] = share
+        chosen = sorted(_pick(pool, layers, count, share), key=lambda q: (q[1], q[0]))
+        questions.extend({'id': question_id, 'question_type': question_type,
+                          'chapter_number': chapter_number, 'marks': marks}
+                         for question_id, chapter_number, marks in chosen)
+
+    return {
+        'question_ids': [q['id'] for q in questions],
+        'questions': questions,
+        'total_marks': limit,
+        'marks_by_type': marks_by_type,
+    }
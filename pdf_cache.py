@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import media
+import os
+import threading
+
+# Rendered papers are stored under a name derived from a hash of everything
+# that affects the output, so regenerating an identical paper (e.g. the same
+# test for another section) reuses the existing file instead of running
+# ReportLab again. Large papers rendered a section at a time also keep each
+# section, so after an edit only the sections that changed are laid out
+# again. The directory is kept under a size limit by evicting the least
+# recently used files.
+
+CACHE_DIR = 'uploads/papers'
+
+# Bump when the layout changes, so files rendered the old way aren't reused
+LAYOUT_VERSION = 3
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def question_version(question):
+    """Fingerprint of the question fields that appear in a rendered paper"""
+    content = [
+        question.question_type, question.question_text, question.options, question.marks,
+        question.has_parts, question.part_a_text, question.part_a_marks,
+        question.part_b_text, question.part_b_marks,
+    ]
+    return hashlib.sha256(json.dumps(content).encode('utf-8')).hexdigest()
+
+def file_digest(path):
+    """SHA-256 of a file's bytes, or None if it can't be read"""
+    if not path or not os.path.exists(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _paper_inputs(paper, academy_name):
+    return {
+        'layout': LAYOUT_VERSION,
+        'title': paper.title,
+        'subject': paper.subject,
+        'class_level': paper.class_level,
+        'total_marks': paper.total_marks,
+        'time_allowed': paper.time_allowed,
+        'student_name': paper.student_name,
+        'watermark': paper.watermark,
+        'logo': file_digest(media.ready_variant(paper.logo_path, 'pdf')),
+        'academy_name': academy_name,
+    }
+
+def _digest(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+def render_key(paper, questions, academy_name):
+    """Cache key covering every input of generate_paper_pdf"""
+    inputs = _paper_inputs(paper, academy_name)
+    inputs['questions'] = [[q.id, question_version(q)] for q in questions]
+    return _digest(inputs)
+
+def answer_key_key(paper, questions, academy_name):
+    """Cache key covering every input of a paper's answer key"""
+    inputs = _paper_inputs(paper, academy_name)
+    inputs['answer_key'] = True
+    inputs['questions'] = [[q.id, question_version(q), q.correct_answer] for q in questions]
+    return _digest(inputs)
+
+def section_key(paper, academy_name, questions, first_number, with_header, last):
+    """Cache key for one separately rendered section of a large paper.
+
+    Only the first section carries the paper header, so the others depend
+    on nothing but their questions, numbering and watermark.
+    """
+    if with_header:
+        inputs = _paper_inputs(paper, academy_name)
+    else:
+        inputs = {'layout': LAYOUT_VERSION, 'watermark': paper.watermark or academy_name}
+    inputs.update(questions=[[q.id, question_version(q)] for q in questions],
+                  first_number=first_number, last=last)
+    return _digest(inputs)
+
+def cache_path(key, kind='paper'):
+    return os.path.join(CACHE_DIR, f'{kind}_{key}.pdf')
+
+def lookup(key, kind='paper'):
+    """Return the cached file for key, or None on a miss"""
+    path = cache_path(key, kind)
+    try:
+        # Touch the file so eviction sees it as recently used
+        os.utime(path)
+    except FileNotFoundError:
+        with _lock:
+            _stats['misses'] += 1
+        return None
+
+    with _lock:
+        _stats['hits'] += 1
+    return path
+
+def store(key, data, kind='paper'):
+    """Write data as the cached file for key and return its path"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = cache_path(key, kind)
+    # Write under a temporary name so readers never see a partial file
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+def evict(max_bytes, keep=()):
+    """Delete least recently used PDFs until the directory fits in max_bytes.
+    Files in keep (paths just written) are never deleted."""
+    keep = {os.path.abspath(path) for path in keep}
+    entries = []
+    total = 0
+    for entry in os.scandir(CACHE_DIR):
+        if entry.is_file() and entry.name.endswith('.pdf'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        total -= size
+        with _lock:
+            _stats['evictions'] += 1
+        logging.info('Evicted cached paper %s', path)
+
+def cache_stats():
+    """Snapshot of the hit/miss/eviction counters for this process"""
+    with _lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
@@ -1,174 +1,252 @@
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.lib import colors
-from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
-from reportlab.pdfgen import canvas
-from models import Question, Setting
+from pypdf import PdfReader, PdfWriter
+from models import Question, Paper, PaperQuestion
+from settings_cache import get_settings, DEFAULTS
+from app import db
+from jobs import job_handler, enqueue
+from flask import current_app
+from io import BytesIO
+from pdf_layout import (answer_key_story, build_doc, header_story, new_doc, paper_sections, render_chunk,
+                        render_context, section_story)
+from workers import process_pool
+import pdf_cache
+import media
+import logging
 import os
-from datetime import datetime
+import threading
+
+# Rendering papers and answer keys from the database: loads the rows,
+# caches the results (pdf_cache) and records each render's outcome on the
+# paper. The layout itself is in pdf_layout.
+
+@job_handler('render_paper')
+def render_paper_job(paper_id):
+    """Background job: render the PDF for a paper and record the outcome"""
+    paper = db.session.get(Paper, paper_id)
+    if paper is None:
+        return
+    
+    try:
+        paper.pdf_path, paper.answer_key_path = generate_paper_pdf(paper)
+        record_renders(paper)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        paper.pdf_status = paper.answer_key_status = 'failed'
+        paper.pdf_error = str(e)
+        paper.render_failures = (paper.render_failures or 0) + 1
+        db.session.commit()
+        raise
+
+@job_handler('render_answer_key')
+def render_answer_key_job(paper_id):
+    """Background job: render only a paper's answer key, leaving its PDF as it is"""
+    paper = db.session.get(Paper, paper_id)
+    if paper is None:
+        return
+    
+    try:
+        paper.answer_key_path = generate_answer_key(paper, get_paper_questions(paper), get_academy_name())
+        paper.answer_key_status = 'done'
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        paper.answer_key_status = 'failed'
+        paper.render_failures = (paper.render_failures or 0) + 1
+        db.session.commit()
+        raise
+
+def record_renders(paper):
+    """Mark a paper's PDF as rendered, and its answer key as rendered or,
+    if it has no path, failed"""
+    paper.pdf_status = 'done'
+    paper.pdf_error = None
+    paper.answer_key_status = 'done' if paper.answer_key_path else 'failed'
+    # A failed key counts towards its retries (see answer_key_available)
+    paper.render_failures = 0 if paper.answer_key_path else 1
 
 def generate_paper_pdf(paper):
-    """Generate PDF for the given paper"""
+    """Generate the PDF and answer key for the given paper, reusing identical earlier renders if cached.
+    
+    Both are built from one fetch of the questions. Returns (PDF path,
+    answer key path), the answer key path being None if the key failed to
+    render; the paper's PDF doesn't depend on it.
+    """
     
     # Create PDF directory if it doesn't exist
-    pdf_dir = 'uploads/papers'
+    pdf_dir = pdf_cache.CACHE_DIR
     os.makedirs(pdf_dir, exist_ok=True)
     
-    # Generate filename
-    filename = f'paper_{paper.id}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.pdf'
-    filepath = os.path.join(pdf_dir, filename)
-    
-    # Create the PDF document
-    doc = SimpleDocTemplate(filepath, pagesize=A4, topMargin=1*inch, bottomMargin=1*inch)
-    
-    # Get styles
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=16,
-        alignment=TA_CENTER,
-        spaceAfter=20
-    )
-    
-    header_style = ParagraphStyle(
-        'CustomHeader',
-        parent=styles['Heading2'],
-        fontSize=12,
-        alignment=TA_CENTER,
-        spaceAfter=10
-    )
-    
-    question_style = ParagraphStyle(
-        'Question',
-        parent=styles['Normal'],
-        fontSize=11,
-        spaceAfter=10,
-        leftIndent=0
-    )
-    
-    # Build the content
-    story = []
-    
-    # Add logo if provided
-    if paper.logo_path and os.path.exists(paper.logo_path):
-        try:
-            logo = Image(paper.logo_path, width=1*inch, height=1*inch)
-            logo.hAlign = 'CENTER'
-            story.append(logo)
-            story.append(Spacer(1, 12))
-        except:
-            pass  # Skip logo if there's an error
-    
-    # Get academy name from settings
-    academy_name = 'Bright Star Academy'
-    academy_setting = Setting.query.filter_by(key='academy_name').first()
-    if academy_setting and academy_setting.value:
-        academy_name = academy_setting.value
-    
-    # Header information
-    story.append(Paragraph(academy_name, title_style))
-    story.append(Paragraph(f"Subject: {paper.subject}", header_style))
-    story.append(Paragraph(f"Class: {paper.class_level}", header_style))
-    story.append(Paragraph(f"Time: {paper.time_allowed} minutes", header_style))
-    story.append(Paragraph(f"Total Marks: {paper.total_marks}", header_style))
-    
-    if paper.student_name:
-        story.append(Paragraph(f"Student: {paper.student_name}", header_style))
-    
-    story.append(Spacer(1, 20))
-    
-    # Instructions
-    instructions = [
-        "1. Read all questions carefully before answering.",
-        "2. Write your answers clearly and legibly.",
-        "3. For MCQs, select the best option.",
-        "4. Manage your time wisely."
-    ]
-    
-    story.append(Paragraph("<b>Instructions:</b>", styles['Heading3']))
-    for instruction in instructions:
-        story.append(Paragraph(instruction, styles['Normal']))
-    
-    story.append(Spacer(1, 20))
-    
-    # Add questions
-    question_ids = paper.get_question_ids()
-    questions = Question.query.filter(Question.id.in_(question_ids)).all()
-    
-    # Group questions by type
-    mcq_questions = [q for q in questions if q.question_type == 'MCQ']
-    short_questions = [q for q in questions if q.question_type == 'Short']
-    long_questions = [q for q in questions if q.question_type == 'Long']
-    
-    question_number = 1
-    
-    # MCQ Section
-    if mcq_questions:
-        story.append(Paragraph("<b>Section A: Multiple Choice Questions</b>", styles['Heading3']))
-        story.append(Spacer(1, 10))
-        
-        for question in mcq_questions:
-            story.append(Paragraph(f"<b>Q{question_number}.</b> {question.question_text} <b>({question.marks} mark{'s' if question.marks > 1 else ''})</b>", question_style))
-            
-            options = question.get_options()
-            if options:
-                for i, option in enumerate(options, 1):
-                    story.append(Paragraph(f"&nbsp;&nbsp;&nbsp;&nbsp;{chr(96+i)}) {option}", styles['Normal']))
-            
-            story.append(Spacer(1, 10))
-            question_number += 1
-        
-        story.append(Spacer(1, 20))
-    
-    # Short Questions Section
-    if short_questions:
-        story.append(Paragraph("<b>Section B: Short Questions</b>", styles['Heading3']))
-        story.append(Spacer(1, 10))
-        
-        for question in short_questions:
-            story.append(Paragraph(f"<b>Q{question_number}.</b> {question.question_text} <b>({question.marks} mark{'s' if question.marks > 1 else ''})</b>", question_style))
-            story.append(Spacer(1, 30))  # Space for answer
-            question_number += 1
-        
-        story.append(Spacer(1, 20))
-    
-    # Long Questions Section
-    if long_questions:
-        story.append(Paragraph("<b>Section C: Long Questions</b>", styles['Heading3']))
-        story.append(Spacer(1, 10))
-        
-        for question in long_questions:
-            story.append(Paragraph(f"<b>Q{question_number}.</b> {question.question_text} <b>({question.marks} mark{'s' if question.marks > 1 else ''})</b>", question_style))
-            story.append(Spacer(1, 60))  # More space for answer
-            question_number += 1
-    
-    # Build PDF with watermark
-    if paper.watermark:
-        doc.build(story, onFirstPage=lambda canvas, doc: add_watermark(canvas, doc, paper.watermark),
-                  onLaterPages=lambda canvas, doc: add_watermark(canvas, doc, paper.watermark))
+    academy_name = get_academy_name()
+    questions = get_paper_questions(paper)
+    answer_key_path = try_answer_key(paper, questions, academy_name)
+    
+    key = pdf_cache.render_key(paper, questions, academy_name)
+    cached = pdf_cache.lookup(key)
+    if cached:
+        return cached, answer_key_path
+    
+    # Render to a temporary name and move it into place so that concurrent
+    # renders of the same paper never expose a half-written file
+    filepath = pdf_cache.cache_path(key)
+    tmp_path = f'{filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+    
+    try:
+        if len(questions) >= current_app.config['SECTIONED_RENDER_MIN_QUESTIONS']:
+            render_sections(tmp_path, paper, questions, academy_name)
+        else:
+            render_paper(tmp_path, paper, questions, academy_name)
+        os.replace(tmp_path, filepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    pdf_cache.evict(current_app.config['PDF_CACHE_MAX_BYTES'], keep=[p for p in (filepath, answer_key_path) if p])
+    
+    return filepath, answer_key_path
+
+def generate_answer_key(paper, questions, academy_name):
+    """Answer key for a paper from the cache, rendering it on a miss. Returns its path."""
+    key = pdf_cache.answer_key_key(paper, questions, academy_name)
+    cached = pdf_cache.lookup(key, 'answer_key')
+    if cached:
+        return cached
+    
+    buffer = BytesIO()
+    render_answer_key(buffer, paper, questions, academy_name)
+    return pdf_cache.store(key, buffer.getvalue(), 'answer_key')
+
+def try_answer_key(paper, questions, academy_name):
+    """generate_answer_key(), logging a failure and returning None instead of raising"""
+    try:
+        return generate_answer_key(paper, questions, academy_name)
+    except Exception:
+        logging.exception('Could not render the answer key for paper %s', paper.id)
+        return None
+
+def get_academy_name():
+    """Academy name from settings, used in the paper header and default watermark"""
+    return get_settings()['academy_name'] or DEFAULTS['academy_name']
+
+def get_paper_questions(paper):
+    """Load the questions selected for a paper, in paper order, with one query"""
+    return Question.query.join(PaperQuestion, PaperQuestion.question_id == Question.id) \
+        .filter(PaperQuestion.paper_id == paper.id) \
+        .order_by(PaperQuestion.position).all()
+
+PAPER_FIELDS = ('title', 'subject', 'class_level', 'total_marks', 'time_allowed', 'student_name',
+                'watermark')
+QUESTION_FIELDS = ('id', 'question_type', 'question_text', 'options', 'marks', 'has_parts',
+                   'part_a_text', 'part_a_marks', 'part_b_text', 'part_b_marks')
+
+def _plain(row, fields):
+    """The given fields of a row as a plain dict, to send to a worker process"""
+    return {field: getattr(row, field) for field in fields}
+
+def _logo_path(paper):
+    """Local path of the pdf variant of a paper's logo, or None"""
+    return media.ready_variant(paper.logo_path, 'pdf') if paper.logo_path else None
+
+def render_paper_bytes(paper, questions, logo=None):
+    """Render a paper in memory and return the PDF, without writing any file.
+    
+    paper need not be saved; questions are the Question rows to print, in
+    order. logo is an optional image file object used instead of
+    paper.logo_path.
+    """
+    buffer = BytesIO()
+    render_paper(buffer, paper, questions, get_academy_name(), logo=logo)
+    return buffer.getvalue()
+
+def render_paper(target, paper, questions, academy_name, personalize=True, logo=None):
+    """Lay out and write a paper to target (a file path or a binary file object).
+    
+    With personalize=False the student name and watermark are left out so
+    they can be stamped on afterwards (see class_sets). logo, if given, is
+    an image file object used instead of paper.logo_path.
+    """
+    context = render_context()
+    story = header_story(context, paper, academy_name, personalize, logo,
+                         logo_path=None if logo is not None else _logo_path(paper))
+    sections = paper_sections(questions)
+    for i, (question_type, chosen, first_number) in enumerate(sections):
+        story.extend(section_story(context, question_type, chosen, first_number, last=i == len(sections) - 1))
+    
+    # Use academy name as default watermark
+    build_doc(new_doc(target), story, (paper.watermark or academy_name) if personalize else None)
+
+def render_answer_key(target, paper, questions, academy_name):
+    """Lay out and write a paper's answer key to target (a file path or a binary file object)"""
+    context = render_context()
+    story = answer_key_story(context, paper, paper_sections(questions), academy_name)
+    build_doc(new_doc(target), story, None)
+
+def render_sections(target, paper, questions, academy_name):
+    """Render a large paper one section at a time and stitch the sections together.
+    
+    Each section starts on a new page (the header goes with the first one)
+    and is laid out in its own worker process. Sections are cached by
+    content, so re-rendering after an edit only redoes the ones that changed.
+    """
+    values = _plain(paper, PAPER_FIELDS)
+    logo_path = _logo_path(paper)
+    sections = paper_sections(questions) or [None]
+    
+    chunks = []  # [cache key, cached path or None, render args]
+    for i, section in enumerate(sections):
+        with_header, last = i == 0, i == len(sections) - 1
+        chosen, first_number = (section[1], section[2]) if section else ([], 1)
+        key = pdf_cache.section_key(paper, academy_name, chosen, first_number, with_header, last)
+        # Workers get plain values only, never ORM rows
+        plain_section = (section[0], [_plain(q, QUESTION_FIELDS) for q in chosen], first_number) if section else None
+        chunks.append([key, pdf_cache.lookup(key, 'section'),
+                       (values, academy_name, logo_path, with_header, plain_section, last)])
+    
+    missing = [chunk for chunk in chunks if chunk[1] is None]
+    workers = min(current_app.config['PDF_RENDER_WORKERS'], len(missing))
+    if workers <= 1:
+        rendered = [render_chunk(*chunk[2]) for chunk in missing]
     else:
-        # Use academy name as default watermark
-        doc.build(story, onFirstPage=lambda canvas, doc: add_watermark(canvas, doc, academy_name),
-                  onLaterPages=lambda canvas, doc: add_watermark(canvas, doc, academy_name))
-    
-    return filepath
+        with process_pool(workers) as pool:
+            rendered = list(pool.map(render_chunk, *zip(*[chunk[2] for chunk in missing])))
+    for chunk, data in zip(missing, rendered):
+        chunk[1] = pdf_cache.store(chunk[0], data, 'section')
+    
+    writer = PdfWriter()
+    for _, path, _ in chunks:
+        writer.append(PdfReader(path))
+    if isinstance(target, str):
+        with open(target, 'wb') as f:
+            writer.write(f)
+    else:
+        writer.write(target)
 
-def add_watermark(canvas, doc, watermark_text):
-    """Add watermark to the page"""
-    canvas.saveState()
-    canvas.setFont('Helvetica', 50)
-    canvas.setFillColorRGB(0.8, 0.8, 0.8, alpha=0.3)
-    
-    # Calculate position for center of page
-    page_width = letter[0]
-    page_height = letter[1]
-    
-    # Rotate and draw watermark
-    canvas.translate(page_width/2, page_height/2)
-    canvas.rotate(45)
-    canvas.drawCentredText(0, 0, watermark_text)
-    
-    canvas.restoreState()
+def pdf_available(paper):
+    """Check that a finished paper's PDF is on disk.
+    
+    Cached files can be evicted, so a missing file is queued for rendering
+    again. A failed render is retried only PDF_RENDER_MAX_ATTEMPTS times.
+    """
+    if paper.pdf_path and os.path.exists(paper.pdf_path):
+        return True
+    
+    if _should_retry(paper, paper.pdf_status):
+        paper.pdf_status = 'pending'
+        enqueue('render_class_set' if paper.class_set else 'render_paper', paper_id=paper.id)
+    return False
+
+def answer_key_available(paper):
+    """Check that a paper's answer key is on disk, queueing a render of the key
+    alone if not. The paper's PDF stays downloadable meanwhile."""
+    if paper.answer_key_path and os.path.exists(paper.answer_key_path):
+        return True
+    
+    if _should_retry(paper, paper.answer_key_status):
+        paper.answer_key_status = 'pending'
+        enqueue('render_answer_key', paper_id=paper.id)
+    return False
+
+def _should_retry(paper, status):
+    if status == 'pending':
+        return False
+    if status == 'failed':
+        return (paper.render_failures or 0) < current_app.config['PDF_RENDER_MAX_ATTEMPTS']
+    return True  # done, but the file has been evicted
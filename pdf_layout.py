@@ -0,0 +1,392 @@
+from reportlab.lib.pagesizes import letter, A4
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas as pdf_canvas
+from reportlab import rl_config
+from PIL import Image as PILImage
+from pypdf import PdfReader, PdfWriter
+from collections import OrderedDict
+from contextlib import contextmanager
+from io import BytesIO
+from types import SimpleNamespace
+from xml.sax.saxutils import escape
+import copy
+import hashlib
+import json
+import os
+import threading
+
+# Paper layout: the ReportLab stories for a paper's header, question
+# sections and answer key, and the stamping of class set copies. Nothing
+# here touches the app or the database, so worker processes (see
+# workers.py) can import this module alone; pdf_generator and class_sets
+# load the rows and hand them over.
+#
+# Everything in a paper that doesn't depend on its questions (styles, the
+# decoded logo, the header and instruction paragraphs) is built once per
+# process and reused, so each render only lays out the question content.
+
+LOGO_CACHE_SIZE = 32
+LOGO_DPI = 300  # logos are stored at print resolution for the size they're drawn at
+PARAGRAPH_CACHE_SIZE = 512
+
+_a85_lock = threading.Lock()
+_a85_builds = 0  # documents being built without ASCII85
+_a85_saved = None  # rl_config.useA85 from before the first of them
+
+INSTRUCTIONS = [
+    "1. Read all questions carefully before answering.",
+    "2. Write your answers clearly and legibly.",
+    "3. For MCQs, select the best option.",
+    "4. Manage your time wisely."
+]
+
+class RenderContext:
+    """Styles, logos and paragraphs shared by every paper this process renders"""
+
+    def __init__(self):
+        styles = getSampleStyleSheet()
+        self.styles = {
+            'title': ParagraphStyle('CustomTitle', parent=styles['Heading1'], fontSize=16,
+                                    alignment=TA_CENTER, spaceAfter=20),
+            'header': ParagraphStyle('CustomHeader', parent=styles['Heading2'], fontSize=12,
+                                     alignment=TA_CENTER, spaceAfter=10),
+            'question': ParagraphStyle('Question', parent=styles['Normal'], fontSize=11,
+                                       spaceAfter=10, leftIndent=0),
+            'heading': styles['Heading3'],
+            'normal': styles['Normal'],
+            'part': ParagraphStyle('Part', parent=styles['Normal'], fontSize=11, leftIndent=18,
+                                   spaceBefore=4),
+        }
+        self._lock = threading.Lock()
+        self._logos = OrderedDict()  # (path, mtime, width, height) -> ImageReader
+        self._paragraphs = OrderedDict()  # (text, style name) -> Paragraph
+
+    def paragraph(self, text, style):
+        """Paragraph of text in one of self.styles, parsed once and copied per use"""
+        key = (text, style)
+        with self._lock:
+            cached = self._paragraphs.get(key)
+            if cached is not None:
+                self._paragraphs.move_to_end(key)
+        if cached is None:
+            cached = Paragraph(text, self.styles[style])
+            with self._lock:
+                self._paragraphs[key] = cached
+                if len(self._paragraphs) > PARAGRAPH_CACHE_SIZE:
+                    self._paragraphs.popitem(last=False)
+        # Layout state is stored on the flowable, so every document gets its own copy
+        return copy.copy(cached)
+
+    def logo(self, path, width, height):
+        """Image flowable for a logo, decoded again only when the file changes"""
+        key = (path, os.stat(path).st_mtime_ns, width, height)
+        with self._lock:
+            reader = self._logos.get(key)
+            if reader is not None:
+                self._logos.move_to_end(key)
+        if reader is None:
+            with PILImage.open(path) as picture:
+                picture.load()
+                picture.thumbnail((round(width / inch * LOGO_DPI), round(height / inch * LOGO_DPI)))
+            reader = ImageReader(picture)
+            reader.getRGBData()  # decode now rather than on first draw
+            with self._lock:
+                self._logos[key] = reader
+                if len(self._logos) > LOGO_CACHE_SIZE:
+                    self._logos.popitem(last=False)
+        image = Image(path, width=width, height=height)
+        image._img = reader  # Image would otherwise open and decode the file itself
+        image.hAlign = 'CENTER'
+        return image
+
+    def instructions(self):
+        """The instructions block printed on every paper"""
+        return [self.paragraph("<b>Instructions:</b>", 'heading')] + \
+            [self.paragraph(instruction, 'normal') for instruction in INSTRUCTIONS]
+
+_context = RenderContext()
+
+def render_context():
+    return _context
+
+def reset_render_context():
+    """Drop the shared styles and caches (the next render rebuilds them)"""
+    global _context
+    _context = RenderContext()
+
+# Question sections in paper order: question type, heading and the space
+# left for the answer after each question (or part)
+SECTIONS = [
+    ('MCQ', 'Section A: Multiple Choice Questions', 10),
+    ('Short', 'Section B: Short Questions', 30),
+    ('Long', 'Section C: Long Questions', 60),
+]
+
+class Record(SimpleNamespace):
+    """A paper or question handed to a worker process as a plain dict"""
+
+    def get_options(self):
+        """Options as a list, like Question.get_options"""
+        try:
+            return json.loads(self.options) if self.options else []
+        except ValueError:
+            return []
+
+def paper_sections(questions):
+    """Group questions into (question type, questions, first question number), in paper order"""
+    sections = []
+    number = 1
+    for question_type, _, _ in SECTIONS:
+        chosen = [q for q in questions if q.question_type == question_type]
+        if chosen:
+            sections.append((question_type, chosen, number))
+            number += len(chosen)
+    return sections
+
+def _marks(marks):
+    return f"{marks} mark{'s' if marks > 1 else ''}"
+
+def header_story(context, paper, academy_name, personalize=True, logo=None, logo_path=None):
+    """Flowables for the top of the first page: logo, paper details and instructions.
+    
+    logo is an image file object, or logo_path the local path of the
+    logo's pdf variant (the copy pre-sized for print).
+    """
+    story = []
+    
+    # Add logo if provided
+    if logo is not None or (logo_path and os.path.exists(logo_path)):
+        try:
+            if logo is not None:
+                image = Image(logo, width=1*inch, height=1*inch)
+                image.hAlign = 'CENTER'
+                story.append(image)
+            else:
+                story.append(context.logo(logo_path, width=1*inch, height=1*inch))
+            story.append(Spacer(1, 12))
+        except:
+            pass  # Skip logo if there's an error
+    
+    # Header information
+    story.append(context.paragraph(academy_name, 'title'))
+    story.append(context.paragraph(f"Subject: {paper.subject}", 'header'))
+    story.append(context.paragraph(f"Class: {paper.class_level}", 'header'))
+    story.append(context.paragraph(f"Time: {paper.time_allowed} minutes", 'header'))
+    story.append(context.paragraph(f"Total Marks: {paper.total_marks}", 'header'))
+    
+    if personalize and paper.student_name:
+        story.append(Paragraph(f"Student: {paper.student_name}", context.styles['header']))
+    
+    story.append(Spacer(1, 20))
+    
+    # Instructions
+    story.extend(context.instructions())
+    
+    story.append(Spacer(1, 20))
+    return story
+
+def section_story(context, question_type, questions, first_number, last=True):
+    """Flowables for one section of questions, numbered from first_number"""
+    styles = context.styles
+    heading, answer_space = next((h, space) for t, h, space in SECTIONS if t == question_type)
+    story = [context.paragraph(f"<b>{heading}</b>", 'heading'), Spacer(1, 10)]
+    
+    for number, question in enumerate(questions, first_number):
+        story.append(Paragraph(f"<b>Q{number}.</b> {question.question_text} <b>({_marks(question.marks)})</b>",
+                               styles['question']))
+        
+        if question.has_parts:
+            # Two-part question: each part with its own marks and answer space
+            for label, text, marks in (('a', question.part_a_text, question.part_a_marks),
+                                       ('b', question.part_b_text, question.part_b_marks)):
+                story.append(Paragraph(f"<b>({label})</b> {text} <b>({_marks(marks)})</b>", styles['part']))
+                story.append(Spacer(1, answer_space))
+            continue
+        
+        options = question.get_options() if question_type == 'MCQ' else None
+        if options:
+            for i, option in enumerate(options, 1):
+                story.append(Paragraph(f"&nbsp;&nbsp;&nbsp;&nbsp;{chr(96+i)}) {option}", styles['normal']))
+        story.append(Spacer(1, answer_space))
+    
+    if not last:
+        story.append(Spacer(1, 20))
+    return story
+
+@contextmanager
+def plain_streams():
+    """Write the streams of documents built inside as plain zlib data.
+    
+    ASCII85 on top makes every file a quarter bigger and, without
+    ReportLab's C accelerators, is most of the time spent writing a paper
+    with a logo. ReportLab only reads the process-wide rl_config.useA85,
+    while a document is built, so it is switched off while any build here
+    runs and put back after the last one.
+    """
+    global _a85_builds, _a85_saved
+    with _a85_lock:
+        if _a85_builds == 0:
+            _a85_saved = rl_config.useA85
+            rl_config.useA85 = 0
+        _a85_builds += 1
+    try:
+        yield
+    finally:
+        with _a85_lock:
+            _a85_builds -= 1
+            if _a85_builds == 0:
+                rl_config.useA85 = _a85_saved
+
+def build_doc(doc, story, watermark_text):
+    """Build a document from a story, with the watermark on every page unless it is None"""
+    with plain_streams():
+        if watermark_text is None:
+            doc.build(story)
+        else:
+            on_page = lambda canvas, doc: add_watermark(canvas, doc, watermark_text)
+            doc.build(story, onFirstPage=on_page, onLaterPages=on_page)
+
+def new_doc(target):
+    """A4 document with the margins every paper uses"""
+    return SimpleDocTemplate(target, pagesize=A4, topMargin=1*inch, bottomMargin=1*inch)
+
+ANSWER_TABLE_STYLE = TableStyle([
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ('ALIGN', (2, 0), (2, -1), 'RIGHT'),
+])
+
+def mcq_answer(question):
+    """The correct option of an MCQ as "b) text", from an option letter, number or text"""
+    answer = (question.correct_answer or '').strip()
+    options = question.get_options()
+    if answer and options:
+        if len(answer) == 1 and answer.isalpha():
+            index = ord(answer.lower()) - ord('a')
+        elif answer.isdigit():
+            index = int(answer) - 1
+        else:
+            index = next((i for i, option in enumerate(options)
+                          if str(option).strip().casefold() == answer.casefold()), None)
+        if index is not None and 0 <= index < len(options):
+            return f"{chr(97+index)}) {options[index]}"
+    return answer
+
+def answer_key_story(context, paper, sections, academy_name):
+    """Flowables for a paper's answer key: answers and marks for every question and part"""
+    styles = context.styles
+    story = [
+        context.paragraph(academy_name, 'title'),
+        Paragraph(f"Answer Key: {escape(paper.title)}", styles['header']),
+        context.paragraph(f"Subject: {paper.subject}", 'header'),
+        context.paragraph(f"Class: {paper.class_level}", 'header'),
+        context.paragraph(f"Total Marks: {paper.total_marks}", 'header'),
+        Spacer(1, 20),
+    ]
+    
+    for question_type, questions, first_number in sections:
+        heading = next(h for t, h, _ in SECTIONS if t == question_type)
+        rows = [['Q', 'Answer / marking scheme', 'Marks']]
+        for number, question in enumerate(questions, first_number):
+            if question_type == 'MCQ' and not question.has_parts:
+                answer = mcq_answer(question)
+            else:
+                answer = (question.correct_answer or '').strip()
+            rows.append([f"Q{number}", Paragraph(escape(answer) or '<i>No answer recorded</i>', styles['normal']),
+                         str(question.marks)])
+            if question.has_parts:
+                for label, text, marks in (('a', question.part_a_text, question.part_a_marks),
+                                           ('b', question.part_b_text, question.part_b_marks)):
+                    rows.append(['', Paragraph(f"({label}) {escape(text or '')}", styles['part']), str(marks)])
+        
+        table = Table(rows, colWidths=[0.6*inch, 4.9*inch, 0.8*inch], repeatRows=1)
+        table.setStyle(ANSWER_TABLE_STYLE)
+        story.append(context.paragraph(f"<b>{heading}</b>", 'heading'))
+        story.append(table)
+        story.append(Spacer(1, 20))
+    
+    return story
+
+def render_chunk(paper, academy_name, logo_path, with_header, section, last):
+    """Lay out the header and/or one section of a paper and return the PDF.
+    
+    paper is a dict of the paper's fields and section is (question type,
+    question dicts, first number) or None. Runs in a worker process.
+    """
+    paper = Record(**paper)
+    context = render_context()
+    story = header_story(context, paper, academy_name, logo_path=logo_path) if with_header else []
+    if section:
+        question_type, questions, first_number = section
+        story.extend(section_story(context, question_type, [Record(**q) for q in questions], first_number,
+                                   last=last))
+    buffer = BytesIO()
+    build_doc(new_doc(buffer), story, paper.watermark or academy_name)
+    return buffer.getvalue()
+
+def _overlay_pdf(page_count, student_name, roll_no, watermark_text):
+    """Pages carrying only the per-student name stamp and watermark"""
+    buffer = BytesIO()
+    width, height = A4
+    label = f'Student: {student_name}' + (f'  (Roll No: {roll_no})' if roll_no else '')
+
+    with plain_streams():
+        c = pdf_canvas.Canvas(buffer, pagesize=A4)
+        for page_number in range(page_count):
+            add_watermark(c, None, watermark_text)
+            c.setFont('Helvetica-Bold' if page_number == 0 else 'Helvetica', 11 if page_number == 0 else 8)
+            c.drawRightString(width - 0.75*inch, height - 0.6*inch, label)
+            c.showPage()
+        c.save()
+    return buffer.getvalue()
+
+def personalize_pdf(base_pdf, student_name, roll_no, watermark_text):
+    """Stamp one student's overlay onto a copy of the shared paper. Runs in a worker process."""
+    base = PdfReader(BytesIO(base_pdf))
+    overlay = PdfReader(BytesIO(_overlay_pdf(len(base.pages), student_name, roll_no, watermark_text)))
+
+    writer = PdfWriter()
+    for page, overlay_page in zip(base.pages, overlay.pages):
+        # Draw the overlay underneath so the paper looks like a normal render
+        page.merge_page(overlay_page, over=False)
+        writer.add_page(page)
+
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+def add_watermark(canvas, doc, watermark_text):
+    """Add watermark to the page.
+    
+    The watermark is drawn once per document as a Form XObject, which every
+    page then refers to instead of carrying its own copy of the drawing.
+    """
+    name = 'watermark_' + hashlib.sha1(watermark_text.encode('utf-8')).hexdigest()[:16]
+    if not canvas.hasForm(name):
+        canvas.beginForm(name)
+        canvas.setFont('Helvetica', 50)
+        canvas.setFillColorRGB(0.8, 0.8, 0.8)
+        
+        # Calculate position for center of page
+        page_width = letter[0]
+        page_height = letter[1]
+        
+        # Rotate and draw watermark
+        canvas.translate(page_width/2, page_height/2)
+        canvas.rotate(45)
+        canvas.drawCentredString(0, 0, watermark_text)
+        canvas.endForm()
+    
+    # Transparency goes on the page: ReportLab forms don't carry graphics states
+    canvas.saveState()
+    canvas.setFillAlpha(0.3)
+    canvas.doForm(name)
+    canvas.restoreState()
@@ -0,0 +1,146 @@
+from flask import g
+from sqlalchemy import event
+from app import app, db
+from models import User, Question, Paper
+from instrumentation import fingerprint
+import logging
+import re
+import threading
+
+# The filtered and ordered queries the app runs, checked against the
+# database's plans. capture_statements() requests each page below with the
+# test client, as a user of the page's role, and calls the helpers that run
+# outside requests, recording every SELECT they send. check_query_plans()
+# asks the database how it would execute each one and reports any that fall
+# back to a full table scan. The statements are the ones the views build, so
+# a view that changes its query changes what is checked.
+#
+# Pages are requested against the current database, so run it where there
+# is at least one teacher and one student; pages for a missing role are
+# skipped. Only pages that read are listed here.
+
+# Small tables read whole on purpose and kept in memory (the dashboard
+# counters and the settings cache), so scanning them is expected
+WHOLE_TABLE_READS = {'stat_counter', 'setting'}
+
+# (role, url); {class_level} and {subject} are filled in from the database
+PAGES = [
+    ('admin', '/admin/dashboard'),
+    ('admin', '/admin/teachers'),
+    ('admin', '/admin/students'),
+    ('admin', '/admin/questions'),
+    ('admin', '/admin/questions?subject={subject}&class_level={class_level}'),
+    ('admin', '/admin/notifications'),
+    ('teacher', '/teacher/dashboard'),
+    ('teacher', '/teacher/papers'),
+    ('teacher', '/teacher/downloads'),
+    ('teacher', '/teacher/api/questions?subject={subject}&class_level={class_level}&chapter_number=1'),
+    ('student', '/student/dashboard'),
+    ('student', '/student/dashboard?subject={subject}'),
+    ('student', '/student/downloads'),
+]
+
+def _helpers():
+    """(name, function) for the queries run outside requests"""
+    from class_sets import class_students
+    from jobs import queued_job_ids
+    from pdf_generator import get_paper_questions
+
+    paper = Paper.query.first()
+    helpers = [('jobs.queued_job_ids', queued_job_ids)]
+    if paper is not None:
+        helpers += [('pdf_generator.get_paper_questions', lambda: get_paper_questions(paper)),
+                    ('class_sets.class_students', lambda: class_students(paper.class_level))]
+    return helpers
+
+class _Recorder:
+    """Collects the SELECTs this thread sends while it is listening"""
+
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.name = None
+        self.statements = {}  # (name, fingerprint) -> (name, statement, parameters)
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if self.name is None or threading.get_ident() != self.thread or executemany:
+            return
+        if not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            return
+        self.statements.setdefault((self.name, fingerprint(statement)), (self.name, statement, parameters))
+
+def capture_statements():
+    """(name, statement, parameters) for every distinct SELECT the pages and helpers run"""
+    users = {role: User.query.filter_by(role=role, is_active=True).order_by(User.id).first()
+             for role in ('admin', 'teacher', 'student')}
+    question = Question.query.first()
+    values = {
+        'subject': question.subject if question else 'Mathematics',
+        'class_level': users['student'].class_assigned if users['student'] else '9',
+    }
+    helpers = _helpers()
+    db.session.rollback()
+
+    recorder = _Recorder()
+    event.listen(db.engine, 'before_cursor_execute', recorder)
+    try:
+        for role, url in PAGES:
+            user = users[role]
+            if user is None:
+                logging.warning('No active %s to request %s as; skipped', role, url)
+                continue
+            url = url.format(**values)
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user.id)
+                session['_fresh'] = True
+            g.pop('_login_user', None)  # the user Flask-Login cached for the previous page
+            recorder.name = url
+            try:
+                response = client.get(url)
+                if response.status_code != 200:
+                    logging.warning('%s answered %s', url, response.status_code)
+            except Exception:
+                # The statements sent before the failure are still checked
+                logging.exception('%s failed', url)
+            finally:
+                recorder.name = None
+
+        for name, helper in helpers:
+            recorder.name = name
+            try:
+                helper()
+            finally:
+                recorder.name = None
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', recorder)
+        db.session.rollback()
+    return list(recorder.statements.values())
+
+def explain(statement, parameters=()):
+    """Return the database's plan for a statement as a list of lines"""
+    with db.engine.begin() as conn:
+        if db.engine.dialect.name == 'sqlite':
+            return [row[3] for row in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+        # Small tables are always cheapest to scan, so make PostgreSQL show
+        # whether an index path exists at all
+        conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        return [row[0] for row in conn.exec_driver_sql(f'EXPLAIN {statement}', parameters)]
+
+def is_full_scan(plan_line):
+    if db.engine.dialect.name == 'sqlite':
+        # "SCAN paper" is a table scan; "SCAN paper USING INDEX ..." walks an index
+        match = re.match(r'^SCAN (\w+)$', plan_line.strip())
+        return match is not None and match.group(1) not in WHOLE_TABLE_READS
+    match = re.search(r'Seq Scan on (\w+)', plan_line)
+    return match is not None and match.group(1) not in WHOLE_TABLE_READS
+
+def check_query_plans(statements=None):
+    """Return (name, statement, plan) for every captured statement that needs a full table scan"""
+    if statements is None:
+        statements = capture_statements()
+    failures = []
+    for name, statement, parameters in statements:
+        plan = explain(statement, parameters)
+        if any(is_full_scan(line) for line in plan):
+            failures.append((name, statement, plan))
+    return failures
@@ -0,0 +1,117 @@
+from flask import current_app
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+from app import db
+from models import Question
+from pagination import keyset_paginate
+import threading
+import time
+
+# The paper builder used to load every Question into one page. Instead it
+# now asks for the subject -> class -> chapter tree (small, cached per
+# process) and then pages through just the questions of the chapter the
+# teacher opens, selecting only the columns the picker shows.
+# ORM changes made in this process drop the cached tree on commit; bulk
+# inserts that bypass the ORM must call invalidate_question_tree() themselves.
+# Changes made by other processes show up once QUESTION_TREE_TTL expires.
+
+# Columns the picker needs for each question
+PICKER_COLUMNS = (
+    Question.id, Question.chapter_number, Question.chapter_name, Question.question_type,
+    Question.question_text, Question.marks, Question.has_parts,
+    Question.part_a_marks, Question.part_b_marks,
+)
+
+PICKER_FILTERS = ('subject', 'class_level', 'chapter_number', 'question_type')
+
+_lock = threading.Lock()
+# version is bumped whenever this process learns the bank changed
+_cache = {'tree': None, 'expires_at': 0.0, 'version': 0}
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+def _build_tree():
+    rows = db.session.query(
+        Question.subject, Question.class_level, Question.chapter_number,
+        Question.chapter_name, func.count(Question.id)
+    ).group_by(
+        Question.subject, Question.class_level, Question.chapter_number, Question.chapter_name
+    ).order_by(
+        Question.subject, Question.class_level, Question.chapter_number
+    ).all()
+
+    tree = {}
+    for subject, class_level, chapter_number, chapter_name, count in rows:
+        chapters = tree.setdefault(subject, {}).setdefault(class_level, {})
+        chapter = chapters.setdefault(chapter_number, {'number': chapter_number, 'name': chapter_name, 'count': 0})
+        chapter['count'] += count
+
+    return [
+        {'subject': subject, 'classes': [
+            {'class_level': class_level, 'chapters': list(chapters.values()),
+             'count': sum(c['count'] for c in chapters.values())}
+            for class_level, chapters in classes.items()
+        ]}
+        for subject, classes in tree.items()
+    ]
+
+def question_tree():
+    """Subjects, their classes and chapters with question counts. Treat as read-only."""
+    now = time.monotonic()
+    with _lock:
+        if _cache['tree'] is not None and _cache['expires_at'] > now:
+            _stats['hits'] += 1
+            return _cache['tree']
+        _stats['misses'] += 1
+
+    tree = _build_tree()
+    with _lock:
+        _cache.update(tree=tree, expires_at=now + current_app.config['QUESTION_TREE_TTL'])
+    return tree
+
+def invalidate_question_tree():
+    """Drop this process's cached tree and anything keyed on bank_version()"""
+    with _lock:
+        if _cache['tree'] is not None:
+            _stats['invalidations'] += 1
+        _cache.update(tree=None, expires_at=0.0, version=_cache['version'] + 1)
+
+def bank_version():
+    """Counter that changes whenever the question bank changes in this process"""
+    with _lock:
+        return _cache['version']
+
+def cache_stats():
+    """Snapshot of the hit/miss counters for this process"""
+    with _lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+def picker_page(filters, cursor=None, page_size=None):
+    """One keyset page of questions matching filters, as plain rows of PICKER_COLUMNS"""
+    query = db.session.query(*PICKER_COLUMNS)
+    for column in PICKER_FILTERS:
+        value = filters.get(column)
+        if value not in (None, ''):
+            query = query.filter(getattr(Question, column) == value)
+    # Chapter order within the (subject, class_level, chapter_number) index
+    return keyset_paginate(query, [(Question.chapter_number, False), (Question.id, False)],
+                           cursor=cursor, page_size=page_size)
+
+@event.listens_for(Question, 'after_insert')
+@event.listens_for(Question, 'after_update')
+@event.listens_for(Question, 'after_delete')
+def _question_changed(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info['question_tree_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    if session.info.pop('question_tree_changed', False):
+        invalidate_question_tree()
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('question_tree_changed', None)
@@ -0,0 +1,312 @@
+from flask import current_app
+from app import db
+from models import Question
+from jobs import job_handler, set_progress, set_result
+from question_bank import invalidate_question_tree
+from stats import bump_counters, deltas_for
+import csv
+import hashlib
+import json
+import os
+import re
+
+# Bulk question import from CSV, JSON (a list of objects), JSON Lines or
+# XLSX. Files are read a row at a time, every row goes through the same
+# checks as admin.add_question, rows already in the bank (or earlier in the
+# file) are skipped, and the rest are inserted IMPORT_BATCH_SIZE at a time.
+#
+# Columns / keys: subject, class_level, chapter_name, chapter_number,
+# question_type, question_text, marks, has_parts, part_a_text, part_a_marks,
+# part_b_text, part_b_marks, correct_answer and either option_1 ... option_N
+# or options (a JSON list, or values separated by "|").
+
+FORMATS = {
+    '.csv': 'csv',
+    '.json': 'json',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.xlsx': 'xlsx',
+}
+
+# Errors kept in an import report; further errors are only counted
+MAX_REPORTED_ERRORS = 1000
+
+class QuestionError(ValueError):
+    """A question fails validation"""
+
+class ImportFileError(ValueError):
+    """An import file can't be read at all"""
+
+def validate_question(fields):
+    """Check a question's fields and return the Question column values.
+
+    fields holds subject, class_level, chapter_name, chapter_number,
+    question_type, has_parts, question_text, marks, part_a_text,
+    part_a_marks, part_b_text, part_b_marks, options (a list) and optionally
+    correct_answer. Raises QuestionError with a message for the user.
+    """
+    if not all(fields.get(k) for k in ('subject', 'class_level', 'chapter_name', 'chapter_number', 'question_type')):
+        raise QuestionError('All required fields must be filled.')
+
+    values = {
+        'subject': fields['subject'],
+        'class_level': fields['class_level'],
+        'chapter_name': fields['chapter_name'],
+        'chapter_number': fields['chapter_number'],
+        'question_type': fields['question_type'],
+        'question_text': fields.get('question_text'),
+        'options': None,
+        'correct_answer': fields.get('correct_answer') or None,
+        'has_parts': bool(fields.get('has_parts')),
+        'part_a_text': None,
+        'part_a_marks': None,
+        'part_b_text': None,
+        'part_b_marks': None,
+    }
+
+    if values['has_parts']:
+        parts = [fields.get(k) for k in ('part_a_text', 'part_a_marks', 'part_b_text', 'part_b_marks')]
+        if not all([values['question_text'], *parts]):
+            raise QuestionError('All parts (A and B) must be completed with their marks.')
+        values.update(part_a_text=parts[0], part_a_marks=parts[1], part_b_text=parts[2], part_b_marks=parts[3],
+                      marks=parts[1] + parts[3])
+    else:
+        if not values['question_text']:
+            raise QuestionError('Question text is required.')
+        values['marks'] = fields.get('marks') or 1
+
+    # MCQ options (no correct answer required)
+    if values['question_type'] == 'MCQ' and not values['has_parts']:
+        options = [o for o in fields.get('options') or [] if o]
+        if not options:
+            raise QuestionError('MCQ questions must have options.')
+        values['options'] = json.dumps(options)
+
+    return values
+
+def _text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+def _whole_number(row, key):
+    value = row.get(key)
+    if value is None or value == '':
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = None
+    if number is None or not number.is_integer():
+        raise QuestionError(f'{key} must be a whole number.')
+    return int(number)
+
+def _flag(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y')
+    return bool(value)
+
+def _options(row):
+    options = row.get('options')
+    if isinstance(options, str):
+        options = options.strip()
+        options = json.loads(options) if options.startswith('[') else options.split('|')
+    options = [_text(o) for o in options or []]
+    numbered = sorted((int(k[7:]), v) for k, v in row.items() if re.fullmatch(r'option_\d+', k))
+    options.extend(_text(v) for _, v in numbered)
+    return [o for o in options if o]
+
+def row_fields(raw):
+    """Turn a raw file row into the fields validate_question expects"""
+    row = {str(k).strip().lower(): v for k, v in raw.items() if k is not None}
+    try:
+        options = _options(row)
+    except ValueError:
+        raise QuestionError('options must be a JSON list or values separated by "|".')
+    return {
+        'subject': _text(row.get('subject')),
+        'class_level': _text(row.get('class_level')),
+        'chapter_name': _text(row.get('chapter_name')),
+        'chapter_number': _whole_number(row, 'chapter_number'),
+        'question_type': _text(row.get('question_type')),
+        'question_text': _text(row.get('question_text')),
+        'marks': _whole_number(row, 'marks'),
+        'has_parts': _flag(row.get('has_parts')),
+        'part_a_text': _text(row.get('part_a_text')),
+        'part_a_marks': _whole_number(row, 'part_a_marks'),
+        'part_b_text': _text(row.get('part_b_text')),
+        'part_b_marks': _whole_number(row, 'part_b_marks'),
+        'correct_answer': _text(row.get('correct_answer')),
+        'options': options,
+    }
+
+# Each reader keeps position['done'] at the fraction of the file read so far
+
+def _read_csv(path, position):
+    size = os.path.getsize(path) or 1
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        for row_number, row in enumerate(csv.DictReader(f), start=2):
+            position['done'] = f.buffer.tell() / size
+            yield row_number, row
+
+def _read_jsonl(path, position):
+    size = os.path.getsize(path) or 1
+    with open(path, encoding='utf-8-sig') as f:
+        for row_number, line in enumerate(f, start=1):
+            position['done'] = f.buffer.tell() / size
+            if line.strip():
+                try:
+                    yield row_number, json.loads(line)
+                except ValueError:
+                    yield row_number, None
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+def _read_json(path, position, chunk_size=1 << 16):
+    """Yield the items of a top-level JSON list without loading the whole file"""
+    decoder = json.JSONDecoder()
+    size = os.path.getsize(path) or 1
+    with open(path, encoding='utf-8-sig') as f:
+        buffer = f.read(chunk_size).lstrip()
+        position['done'] = f.buffer.tell() / size
+        if not buffer.startswith('['):
+            raise ImportFileError('A JSON file must contain a list of questions.')
+        pos = 1
+        eof = False
+        row_number = 0
+        while True:
+            pos = _SEPARATORS.match(buffer, pos).end()
+            if buffer.startswith(']', pos):
+                return
+            try:
+                if pos == len(buffer):
+                    raise ValueError('Need more data')
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise ImportFileError(f'The JSON file is malformed after item {row_number}.')
+                chunk = f.read(chunk_size)
+                position['done'] = f.buffer.tell() / size
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            row_number += 1
+            yield row_number, item
+
+def _read_xlsx(path, position):
+    try:
+        import openpyxl
+    except ImportError:
+        raise ImportFileError('Importing XLSX files needs the openpyxl package (pip install openpyxl).')
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.active
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        for row_number, row in enumerate(rows, start=2):
+            if sheet.max_row:
+                position['done'] = row_number / sheet.max_row
+            if any(cell is not None for cell in row):
+                yield row_number, dict(zip(header, row))
+    finally:
+        workbook.close()
+
+_READERS = {'csv': _read_csv, 'json': _read_json, 'jsonl': _read_jsonl, 'xlsx': _read_xlsx}
+
+def read_rows(path, file_format, position=None):
+    """Yield (row number, raw row dict) from an import file.
+
+    position, if given, is a dict whose 'done' key is kept at the fraction
+    of the file read so far.
+    """
+    try:
+        yield from _READERS[file_format](path, {} if position is None else position)
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise ImportFileError(f'The file could not be read: {e}')
+
+def _normalise(text):
+    return ' '.join((text or '').split()).casefold()
+
+def _dedupe_key(chapter_number, question_type, question_text, part_a_text, part_b_text):
+    key = '\x1f'.join([str(chapter_number), question_type, _normalise(question_text),
+                       _normalise(part_a_text), _normalise(part_b_text)])
+    return hashlib.sha1(key.encode('utf-8')).digest()
+
+def _existing_keys(subject, class_level):
+    rows = db.session.query(
+        Question.chapter_number, Question.question_type, Question.question_text,
+        Question.part_a_text, Question.part_b_text
+    ).filter_by(subject=subject, class_level=class_level).yield_per(5000)
+    return {_dedupe_key(*row) for row in rows}
+
+def import_questions(path, file_format, created_by, progress=None):
+    """Import questions from a file and return a report dict.
+
+    progress, if given, is called with the report so far and the fraction
+    of the file read after each batch.
+    """
+    batch_size = current_app.config['IMPORT_BATCH_SIZE']
+    report = {'rows': 0, 'imported': 0, 'duplicates': 0, 'error_count': 0, 'errors': []}
+    seen = {}  # (subject, class_level) -> dedupe keys already in the bank or this file
+    batch = []
+    position = {'done': 0}
+
+    def flush():
+        if batch:
+            db.session.execute(db.insert(Question), batch)
+            bump_counters(db.session.connection(), deltas_for(Question, batch))
+            db.session.commit()
+            report['imported'] += len(batch)
+            batch.clear()
+            if progress:
+                progress(report, position['done'])
+
+    try:
+        for row_number, raw in read_rows(path, file_format, position):
+            report['rows'] += 1
+            try:
+                if not isinstance(raw, dict):
+                    raise QuestionError('Row is not a JSON object.')
+                values = validate_question(row_fields(raw))
+            except QuestionError as e:
+                report['error_count'] += 1
+                if len(report['errors']) < MAX_REPORTED_ERRORS:
+                    report['errors'].append({'row': row_number, 'error': str(e)})
+                continue
+
+            group = (values['subject'], values['class_level'])
+            if group not in seen:
+                seen[group] = _existing_keys(*group)
+            key = _dedupe_key(values['chapter_number'], values['question_type'], values['question_text'],
+                              values['part_a_text'], values['part_b_text'])
+            if key in seen[group]:
+                report['duplicates'] += 1
+                continue
+            seen[group].add(key)
+
+            values['created_by'] = created_by
+            batch.append(values)
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+    finally:
+        # Core inserts bypass the ORM events that normally do this
+        if report['imported']:
+            invalidate_question_tree()
+
+    return report
+
+def _job_progress(report, done):
+    # The report so far, so the job page shows row errors before the end
+    set_result(report)
+    set_progress(100 * done)
+
+@job_handler('import_questions')
+def import_questions_job(path, file_format, created_by):
+    try:
+        return import_questions(path, file_format, created_by, progress=_job_progress)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
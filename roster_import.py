@@ -0,0 +1,209 @@
+from flask import current_app
+from sqlalchemy import func
+from werkzeug.security import generate_password_hash
+from app import db
+from models import User
+from jobs import job_handler, set_progress, set_result
+from stats import bump_counters, deltas_for
+from question_import import MAX_REPORTED_ERRORS, read_rows
+from utils import generate_password
+from workers import process_pool
+from datetime import datetime
+import csv
+import os
+import secrets
+import time
+
+# Bulk creation of student and teacher accounts from a roster file (any
+# format question_import can read). Rows are checked like admin.add_student
+# and add_teacher, except that an empty password gets a generated one. Every
+# email is checked against the database in one query, passwords are hashed
+# on a process pool and users are inserted IMPORT_BATCH_SIZE at a time. The
+# new logins are written to a credentials CSV for the admin to hand out; each
+# batch's logins are on disk before the batch is committed, so no account is
+# created without its password being recorded. The sheet is deleted once it
+# has been downloaded, or ROSTER_CREDENTIALS_TTL seconds after the import.
+#
+# Columns / keys: name, email, role (student or teacher; defaults to the role
+# chosen for the import), password, class_assigned, roll_no, subject and
+# expiry_date (YYYY-MM-DD, teachers only).
+
+CREDENTIALS_DIR = 'uploads/credentials'
+ROLES = ('student', 'teacher')
+
+class RosterError(ValueError):
+    """A roster row fails validation"""
+
+def _text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+def _roster_user(raw, default_role):
+    """Validate one roster row and return (User column values, password)"""
+    row = {str(k).strip().lower(): v for k, v in raw.items() if k is not None}
+    role = (_text(row.get('role')) or default_role or '').lower()
+    name = _text(row.get('name'))
+    email = (_text(row.get('email')) or '').lower() or None
+    password = _text(row.get('password')) or generate_password(10)
+    class_assigned = _text(row.get('class_assigned'))
+
+    if role not in ROLES:
+        raise RosterError('Role must be student or teacher.')
+
+    values = {
+        'name': name,
+        'email': email,
+        'role': role,
+        'class_assigned': class_assigned,
+        'roll_no': None,
+        'subject': None,
+        'expiry_date': None,
+        'is_active': True,
+    }
+
+    if role == 'student':
+        values['roll_no'] = _text(row.get('roll_no'))
+        if not all([name, email, class_assigned, values['roll_no']]):
+            raise RosterError('Name, email, class and roll number are required.')
+    else:
+        values['subject'] = _text(row.get('subject'))
+        if not all([name, email, values['subject']]):
+            raise RosterError('Name, email and subject are required.')
+        expiry_date = row.get('expiry_date')
+        if isinstance(expiry_date, datetime):
+            values['expiry_date'] = expiry_date.date()
+        elif _text(expiry_date):
+            try:
+                values['expiry_date'] = datetime.strptime(_text(expiry_date), '%Y-%m-%d').date()
+            except ValueError:
+                raise RosterError('Invalid date format.')
+
+    return values, password
+
+def remove_expired_credentials():
+    """Delete credentials sheets older than ROSTER_CREDENTIALS_TTL. Returns how many."""
+    if not os.path.isdir(CREDENTIALS_DIR):
+        return 0
+    cutoff = time.time() - current_app.config['ROSTER_CREDENTIALS_TTL']
+    removed = 0
+    for name in os.listdir(CREDENTIALS_DIR):
+        path = os.path.join(CREDENTIALS_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            pass  # downloaded and removed meanwhile
+    return removed
+
+def _error(report, row_number, message):
+    report['error_count'] += 1
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+        report['errors'].append({'row': row_number, 'error': message})
+
+def import_roster(path, file_format, default_role=None, progress=None, report=None):
+    """Create the users in a roster file and return a report dict.
+
+    progress, if given, is called with (users created, users to create)
+    after each batch. report, if given, is the dict to fill in, so a caller
+    still has the counts and the credentials sheet if the import fails.
+    """
+    if report is None:
+        report = {}
+    report.update({'rows': 0, 'created': 0, 'error_count': 0, 'errors': [], 'credentials_path': None})
+    remove_expired_credentials()
+    pending = []  # (row number, values, password)
+    first_row = {}  # email -> row it first appeared on
+
+    for row_number, raw in read_rows(path, file_format):
+        report['rows'] += 1
+        try:
+            if not isinstance(raw, dict):
+                raise RosterError('Row is not a JSON object.')
+            values, password = _roster_user(raw, default_role)
+        except RosterError as e:
+            _error(report, row_number, str(e))
+            continue
+        if values['email'] in first_row:
+            _error(report, row_number, f'Email already appears on row {first_row[values["email"]]}.')
+            continue
+        first_row[values['email']] = row_number
+        pending.append((row_number, values, password))
+
+    # One query for every email in the file
+    existing = set()
+    emails = list(first_row)
+    if emails:
+        existing = {email for (email,) in db.session.query(func.lower(User.email))
+                    .filter(func.lower(User.email).in_(emails))}
+    users = []
+    for row_number, values, password in pending:
+        if values['email'] in existing:
+            _error(report, row_number, 'Email already exists.')
+        else:
+            users.append((values, password))
+    report['errors'].sort(key=lambda error: error['row'])
+
+    if not users:
+        return report
+
+    os.makedirs(CREDENTIALS_DIR, exist_ok=True)
+    credentials_path = os.path.join(CREDENTIALS_DIR, f'roster_{secrets.token_hex(8)}.csv')
+    batch_size = current_app.config['IMPORT_BATCH_SIZE']
+    workers = current_app.config['PASSWORD_HASH_WORKERS']
+
+    # Readable by the app's user only: the sheet holds plaintext passwords
+    fd = os.open(credentials_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    report['credentials_path'] = credentials_path
+    with open(fd, 'w', newline='', encoding='utf-8') as f, \
+            process_pool(workers) as pool:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'email', 'password', 'role', 'class_assigned', 'roll_no', 'subject'])
+        for start in range(0, len(users), batch_size):
+            batch = users[start:start + batch_size]
+            passwords = [password for _, password in batch]
+            hashes = pool.map(generate_password_hash, passwords,
+                              chunksize=max(1, len(batch) // (workers * 4)))
+            rows = [dict(values, password_hash=password_hash)
+                    for (values, _), password_hash in zip(batch, hashes)]
+
+            # The batch's logins reach the disk before its users exist
+            f.flush()
+            written = f.tell()
+            for values, password in batch:
+                writer.writerow([values['name'], values['email'], password, values['role'],
+                                 values['class_assigned'], values['roll_no'], values['subject']])
+            f.flush()
+            os.fsync(f.fileno())
+
+            try:
+                db.session.execute(db.insert(User), rows)
+                # Core inserts skip the ORM events that keep the dashboard counters
+                bump_counters(db.session.connection(), deltas_for(User, rows))
+                db.session.commit()
+            except Exception:
+                # Leave only the logins of accounts that were created
+                f.truncate(written)
+                raise
+            report['created'] += len(batch)
+            if progress:
+                progress(report['created'], len(users))
+
+    return report
+
+@job_handler('import_roster')
+def import_roster_job(path, file_format, default_role):
+    report = {}
+    try:
+        return import_roster(path, file_format, default_role,
+                             progress=lambda done, total: set_progress(100 * done / total), report=report)
+    except Exception:
+        # Keep what was created, and the sheet with their logins, on the failed job
+        db.session.rollback()
+        set_result(report)
+        raise
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
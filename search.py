@@ -0,0 +1,129 @@
+from flask import current_app
+from sqlalchemy import inspect, text
+from app import db
+import logging
+import re
+
+# Full-text search over the question bank. On SQLite the text columns are
+# indexed in an FTS5 table kept in step with the question table by triggers;
+# on PostgreSQL a generated tsvector column with a GIN index does the same.
+# Either way every insert, update or delete of a question (from
+# admin.add_question, delete_question or anywhere else) updates the index
+# in the same transaction.
+
+FACETS = ('subject', 'class_level', 'chapter_number', 'question_type')
+
+_SQLITE_SETUP = [
+    """CREATE VIRTUAL TABLE question_fts USING fts5(
+        question_text, part_a_text, part_b_text, chapter_name, options,
+        content='question', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER question_fts_insert AFTER INSERT ON question BEGIN
+        INSERT INTO question_fts(rowid, question_text, part_a_text, part_b_text, chapter_name, options)
+        VALUES (new.id, new.question_text, new.part_a_text, new.part_b_text, new.chapter_name, new.options);
+    END""",
+    """CREATE TRIGGER question_fts_delete AFTER DELETE ON question BEGIN
+        INSERT INTO question_fts(question_fts, rowid, question_text, part_a_text, part_b_text, chapter_name, options)
+        VALUES ('delete', old.id, old.question_text, old.part_a_text, old.part_b_text, old.chapter_name, old.options);
+    END""",
+    """CREATE TRIGGER question_fts_update AFTER UPDATE ON question BEGIN
+        INSERT INTO question_fts(question_fts, rowid, question_text, part_a_text, part_b_text, chapter_name, options)
+        VALUES ('delete', old.id, old.question_text, old.part_a_text, old.part_b_text, old.chapter_name, old.options);
+        INSERT INTO question_fts(rowid, question_text, part_a_text, part_b_text, chapter_name, options)
+        VALUES (new.id, new.question_text, new.part_a_text, new.part_b_text, new.chapter_name, new.options);
+    END""",
+    # Index the questions that already exist
+    "INSERT INTO question_fts(question_fts) VALUES ('rebuild')",
+]
+
+def _postgres_setup(language):
+    return [
+        f"""ALTER TABLE question ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('{language}', coalesce(question_text, '')), 'A') ||
+            setweight(to_tsvector('{language}', coalesce(part_a_text, '') || ' ' || coalesce(part_b_text, '')), 'B') ||
+            setweight(to_tsvector('{language}', coalesce(chapter_name, '')), 'C') ||
+            setweight(to_tsvector('{language}', coalesce(options, '')), 'D')
+        ) STORED""",
+        'CREATE INDEX IF NOT EXISTS ix_question_search_vector ON question USING GIN (search_vector)',
+    ]
+
+def ensure_search_index():
+    """Create the full-text index for the current database if it doesn't exist yet"""
+    dialect = db.engine.dialect.name
+    with db.engine.begin() as conn:
+        if dialect == 'sqlite':
+            exists = conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'question_fts'"
+            )).first()
+            if not exists:
+                logging.info('Building question full-text index (FTS5)')
+                for statement in _SQLITE_SETUP:
+                    conn.execute(text(statement))
+        elif dialect == 'postgresql':
+            columns = {c['name'] for c in inspect(conn).get_columns('question')}
+            if 'search_vector' not in columns:
+                logging.info('Building question full-text index (tsvector/GIN)')
+                for statement in _postgres_setup(current_app.config['SEARCH_LANGUAGE']):
+                    conn.execute(text(statement))
+
+def _fts5_query(q):
+    """Turn free text into a safe FTS5 query: every word must match, the last as a prefix"""
+    words = re.findall(r'\w+', q)
+    if not words:
+        return None
+    terms = [f'"{w}"' for w in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+def search_questions(q, filters=None, limit=20):
+    """Rank questions matching q and count matches per facet.
+
+    filters may restrict any of FACETS. Returns a dict with 'results' (best
+    match first) and 'facets' ({facet: {value: count}}).
+    """
+    filters = {k: v for k, v in (filters or {}).items() if k in FACETS and v not in (None, '')}
+    dialect = db.engine.dialect.name
+    params = {'limit': limit}
+
+    if dialect == 'sqlite':
+        params['query'] = _fts5_query(q)
+        if params['query'] is None:
+            return {'results': [], 'facets': {f: {} for f in FACETS}}
+        # CROSS JOIN makes SQLite run the MATCH first instead of once per question row
+        source = 'question_fts CROSS JOIN question ON question.id = question_fts.rowid'
+        where = ['question_fts MATCH :query']
+        # bm25 is lower for better matches; weight question text above parts, chapter and options
+        rank = '-bm25(question_fts, 10.0, 5.0, 5.0, 2.0, 1.0)'
+    elif dialect == 'postgresql':
+        params['query'] = q
+        params['language'] = current_app.config['SEARCH_LANGUAGE']
+        source = 'question'
+        where = ['question.search_vector @@ websearch_to_tsquery(CAST(:language AS regconfig), :query)']
+        rank = 'ts_rank_cd(question.search_vector, websearch_to_tsquery(CAST(:language AS regconfig), :query))'
+    else:
+        raise RuntimeError(f'Full-text search is not supported on {dialect}')
+
+    for facet, value in filters.items():
+        where.append(f'question.{facet} = :{facet}')
+        params[facet] = value
+    where_sql = ' AND '.join(where)
+
+    rows = db.session.execute(text(
+        f'SELECT question.id, question.subject, question.class_level, question.chapter_number, '
+        f'question.chapter_name, question.question_type, question.question_text, question.marks, '
+        f'question.has_parts, {rank} AS rank '
+        f'FROM {source} WHERE {where_sql} ORDER BY rank DESC LIMIT :limit'
+    ), params).mappings().all()
+
+    # One grouped pass over the matches gives the counts for every facet
+    facets = {facet: {} for facet in FACETS}
+    columns = ', '.join(f'question.{facet}' for facet in FACETS)
+    combinations = db.session.execute(text(
+        f'SELECT {columns}, COUNT(*) FROM {source} WHERE {where_sql} GROUP BY {columns}'
+    ), params).all()
+    for row in combinations:
+        count = row[-1]
+        for facet, value in zip(FACETS, row):
+            facets[facet][value] = facets[facet].get(value, 0) + count
+
+    return {'results': [dict(row) for row in rows], 'facets': facets}
@@ -0,0 +1,61 @@
+from flask import current_app
+from app import db
+from models import Setting
+import threading
+import time
+import uuid
+
+# Settings change perhaps once a term but are read on every page render and
+# by every PDF, so each process keeps them in memory. A version stamp stored
+# as its own Setting row is changed whenever settings are saved; other
+# processes compare it at most once per SETTINGS_CHECK_INTERVAL seconds and
+# reload when it differs.
+
+VERSION_KEY = 'settings_version'
+
+DEFAULTS = {
+    'academy_name': 'Bright Star Academy',
+    'academy_logo': '',
+    'background_image': '',
+}
+
+_lock = threading.Lock()
+_cache = {'settings': None, 'version': None, 'checked_at': 0.0}
+
+def _current_version():
+    return db.session.query(Setting.value).filter_by(key=VERSION_KEY).scalar()
+
+def _load():
+    settings = dict(DEFAULTS)
+    for setting in Setting.query.filter(Setting.key != VERSION_KEY).all():
+        settings[setting.key] = setting.value
+    return settings
+
+def get_settings():
+    """All settings as a dict, with defaults for missing keys. Treat as read-only."""
+    now = time.monotonic()
+    with _lock:
+        settings, version, checked_at = _cache['settings'], _cache['version'], _cache['checked_at']
+
+    if settings is not None and now - checked_at < current_app.config['SETTINGS_CHECK_INTERVAL']:
+        return settings
+
+    current = _current_version()
+    if settings is None or current != version:
+        settings = _load()
+
+    with _lock:
+        _cache.update(settings=settings, version=current, checked_at=now)
+    return settings
+
+def invalidate_settings():
+    """Mark settings as changed. Call before committing the change so the new
+    version stamp is saved in the same transaction."""
+    setting = Setting.query.filter_by(key=VERSION_KEY).first()
+    if setting is None:
+        setting = Setting(key=VERSION_KEY)
+        db.session.add(setting)
+    setting.value = uuid.uuid4().hex
+
+    with _lock:
+        _cache.update(settings=None, version=None, checked_at=0.0)
@@ -0,0 +1,189 @@
+from sqlalchemy import event, func, inspect, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from app import app, db
+from models import User, Question, Paper, StatCounter
+from jobs import enqueue, job_handler
+import logging
+import time
+
+# Dashboard statistics kept in the stat_counter table instead of counted on
+# every page load. ORM inserts, deletes and updates of users, questions and
+# papers adjust the counters in the same transaction; bulk Core inserts call
+# bump_counters() themselves. A reconcile job recounts everything from the
+# source tables every STATS_RECONCILE_INTERVAL seconds to repair any drift
+# (raw SQL, crashes, concurrent edits).
+#
+# Keys: users:<role>, students:class:<class>, questions,
+# questions:subject:<subject>, questions:class:<class>, papers,
+# papers:subject:<subject>, papers:class:<class>.
+
+RECONCILED_AT = 'reconciled_at'  # Unix time of the last reconcile, stored as a counter
+
+def counter_keys(model, values):
+    """Counter keys a row with the given column values counts towards"""
+    if model is User:
+        keys = [f'users:{values["role"]}']
+        if values['role'] == 'student' and values.get('class_assigned'):
+            keys.append(f'students:class:{values["class_assigned"]}')
+        return keys
+    prefix = 'questions' if model is Question else 'papers'
+    return [prefix, f'{prefix}:subject:{values["subject"]}', f'{prefix}:class:{values["class_level"]}']
+
+_COLUMNS = {
+    User: ('role', 'class_assigned'),
+    Question: ('subject', 'class_level'),
+    Paper: ('subject', 'class_level'),
+}
+
+def deltas_for(model, rows):
+    """Counter changes for inserting rows (dicts of column values) of model"""
+    deltas = {}
+    for values in rows:
+        for key in counter_keys(model, values):
+            deltas[key] = deltas.get(key, 0) + 1
+    return deltas
+
+def bump_counters(connection, deltas):
+    """Add deltas ({key: change}) to the counters on connection's transaction"""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    _upsert(connection, deltas, lambda excluded: StatCounter.__table__.c.value + excluded.value)
+
+def _upsert(connection, values, new_value):
+    """Insert counters ({key: value}), setting existing ones to new_value(excluded)"""
+    dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+    statement = dialect.insert(StatCounter.__table__)
+    statement = statement.on_conflict_do_update(index_elements=['key'],
+                                                set_={'value': new_value(statement.excluded)})
+    connection.execute(statement, [{'key': k, 'value': v} for k, v in sorted(values.items())])
+
+def _record(target, deltas):
+    session = Session.object_session(target)
+    if session is None:
+        return
+    pending = session.info.setdefault('stat_deltas', {})
+    for key, change in deltas.items():
+        pending[key] = pending.get(key, 0) + change
+
+def _current(target):
+    return {column: getattr(target, column) for column in _COLUMNS[type(target)]}
+
+def _after_insert(mapper, connection, target):
+    _record(target, {key: 1 for key in counter_keys(type(target), _current(target))})
+
+def _after_delete(mapper, connection, target):
+    _record(target, {key: -1 for key in counter_keys(type(target), _current(target))})
+
+def _after_update(mapper, connection, target):
+    state = inspect(target)
+    new = _current(target)
+    old = dict(new)
+    for column in _COLUMNS[type(target)]:
+        history = state.attrs[column].history
+        if history.deleted:
+            old[column] = history.deleted[0]
+    if old == new:
+        return
+    deltas = {}
+    for key in counter_keys(type(target), old):
+        deltas[key] = deltas.get(key, 0) - 1
+    for key in counter_keys(type(target), new):
+        deltas[key] = deltas.get(key, 0) + 1
+    _record(target, deltas)
+
+def _load_old_value(target, value, oldvalue, initiator):
+    pass
+
+for _model, _columns in _COLUMNS.items():
+    event.listen(_model, 'after_insert', _after_insert)
+    event.listen(_model, 'after_delete', _after_delete)
+    event.listen(_model, 'after_update', _after_update)
+    # active_history loads the old value when an expired attribute is set,
+    # so _after_update knows which counters to take the row out of
+    for _column in _columns:
+        event.listen(getattr(_model, _column), 'set', _load_old_value, active_history=True)
+
+@event.listens_for(Session, 'after_flush')
+def _apply_deltas(session, flush_context):
+    deltas = session.info.pop('stat_deltas', None)
+    if deltas:
+        bump_counters(session.connection(), deltas)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_deltas(session):
+    session.info.pop('stat_deltas', None)
+
+def _recount(connection):
+    counts = {}
+    for model, (first, second) in _COLUMNS.items():
+        columns = [getattr(model, first), getattr(model, second)]
+        rows = connection.execute(db.select(*columns, func.count()).group_by(*columns))
+        for a, b, count in rows:
+            for key in counter_keys(model, {first: a, second: b}):
+                counts[key] = counts.get(key, 0) + count
+    return counts
+
+def reconcile_counters():
+    """Recount every statistic from the source tables and overwrite the counters.
+
+    Counters are upserted in place rather than the table being emptied and
+    refilled, so a dashboard read or counter bump running at the same time
+    never finds them missing. Counters nothing counts towards any more are
+    set to 0.
+    """
+    with db.engine.begin() as conn:
+        counts = _recount(conn)
+        counts[RECONCILED_AT] = int(time.time())
+        _upsert(conn, counts, lambda excluded: excluded.value)
+        conn.execute(update(StatCounter).where(StatCounter.key.not_in(list(counts)), StatCounter.value != 0)
+                     .values(value=0))
+    return counts
+
+def _claim_reconcile(now):
+    """True if this process should run the overdue reconcile (only one worker wins)"""
+    interval = app.config['STATS_RECONCILE_INTERVAL']
+    with db.engine.begin() as conn:
+        return conn.execute(
+            update(StatCounter)
+            .where(StatCounter.key == RECONCILED_AT, StatCounter.value < now - interval)
+            .values(value=now)
+        ).rowcount == 1
+
+def dashboard_stats():
+    """All dashboard statistics from a single query on the counters table"""
+    counters = dict(db.session.query(StatCounter.key, StatCounter.value).all())
+
+    def breakdown(prefix):
+        return {key[len(prefix):]: value for key, value in sorted(counters.items())
+                if key.startswith(prefix) and value}
+
+    stats = {
+        'teachers': counters.get('users:teacher', 0),
+        'students': counters.get('users:student', 0),
+        'questions': counters.get('questions', 0),
+        'papers': counters.get('papers', 0),
+        'students_by_class': breakdown('students:class:'),
+        'questions_by_subject': breakdown('questions:subject:'),
+        'questions_by_class': breakdown('questions:class:'),
+        'papers_by_subject': breakdown('papers:subject:'),
+        'papers_by_class': breakdown('papers:class:'),
+    }
+
+    # Schedule the periodic recount when it is due
+    now = int(time.time())
+    if now - counters.get(RECONCILED_AT, 0) >= app.config['STATS_RECONCILE_INTERVAL'] and _claim_reconcile(now):
+        enqueue('reconcile_stats')
+
+    return stats
+
+def ensure_counters():
+    """Fill the counters on first start. Call within an app context."""
+    if db.session.get(StatCounter, RECONCILED_AT) is None:
+        logging.info('Counting dashboard statistics')
+        reconcile_counters()
+
+@job_handler('reconcile_stats')
+def reconcile_stats_job():
+    reconcile_counters()
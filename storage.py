@@ -0,0 +1,309 @@
+from sqlalchemy import delete, event, inspect, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from app import app, db
+from models import Paper, Setting, DownloadFile, GalleryImage, StoredObject
+from jobs import job_handler
+from werkzeug.utils import secure_filename
+from datetime import datetime, timedelta
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+
+# Uploaded files are kept once per distinct content. A file's key is
+# "<aa>/<digest>/<name>", where digest is the SHA-256 of the uploaded bytes,
+# and files derived from it (image variants) sit under the same digest.
+# Rows refer to a stored file by its local path, STORAGE_ROOT/<key>.
+#
+# The backend is the local filesystem, or with STORAGE_BACKEND=s3 an
+# S3-compatible bucket (STORAGE_S3_ENDPOINT_URL points it at MinIO or another
+# stand-in). With S3, STORAGE_ROOT holds local copies of the files in use,
+# fetched on demand.
+#
+# stored_object counts the rows that refer to each digest. ORM inserts,
+# updates and deletes of the columns in REFERENCES adjust the count in the
+# same transaction, as stats.py does for the dashboard counters.
+# collect_garbage() deletes files nobody has referred to for
+# STORAGE_GC_GRACE seconds, after recounting to repair any drift. Files
+# uploaded before storage.py (uploads/logos, uploads/backgrounds, ...) are
+# only counted once "flask adopt-uploads" has moved them in.
+
+REFERENCES = {
+    Paper: 'logo_path',
+    Setting: 'value',
+    DownloadFile: 'file_path',
+    GalleryImage: 'image_path',
+}
+
+_DIGEST = re.compile(r'[0-9a-f]{64}')
+
+class StorageError(RuntimeError):
+    """The storage backend is misconfigured or unavailable"""
+
+def write_atomic(path, data):
+    """Write a file under a temporary name and move it into place"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def object_key(digest, name):
+    return f'{digest[:2]}/{digest}/{name}'
+
+def path_for(key):
+    """Local path of a stored file"""
+    return os.path.join(app.config['STORAGE_ROOT'], key)
+
+def key_for(path):
+    """Key of a stored file from its local path, or None for any other path"""
+    if not path:
+        return None
+    root = os.path.normpath(app.config['STORAGE_ROOT'])
+    relative = os.path.relpath(os.path.normpath(path), root)
+    parts = relative.split(os.sep)
+    if len(parts) == 3 and _DIGEST.fullmatch(parts[1]) and parts[0] == parts[1][:2]:
+        return '/'.join(parts)
+    return None
+
+def digest_of(path):
+    """Content digest of a stored file from its local path, or None"""
+    key = key_for(path)
+    return key.split('/')[1] if key else None
+
+class LocalStorage:
+    """Files kept in the local STORAGE_ROOT directory"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.root, key))
+
+    def put(self, key, data):
+        write_atomic(os.path.join(self.root, key), data)
+
+    def fetch(self, key):
+        """Local path of a stored file, or None if it isn't stored"""
+        path = os.path.join(self.root, key)
+        return path if os.path.exists(path) else None
+
+    def delete(self, digest):
+        """Remove every file stored under a digest"""
+        shutil.rmtree(os.path.join(self.root, digest[:2], digest), ignore_errors=True)
+
+class S3Storage(LocalStorage):
+    """Files kept in an S3-compatible bucket, with local copies under root"""
+
+    def __init__(self, root, bucket, prefix='', endpoint_url=None, client=None):
+        super().__init__(root)
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise StorageError('S3 storage needs the boto3 package (pip install boto3).')
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def exists(self, key):
+        if super().exists(key):
+            return True
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except self.client.exceptions.ClientError:
+            return False
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+        super().put(key, data)
+
+    def fetch(self, key):
+        path = super().fetch(key)
+        if path:
+            return path
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            self.client.download_file(self.bucket, self.prefix + key, tmp_path)
+            os.replace(tmp_path, path)
+        except self.client.exceptions.ClientError:
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+    def delete(self, digest):
+        prefix = f'{self.prefix}{digest[:2]}/{digest}/'
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if objects:
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects})
+        super().delete(digest)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_storage():
+    """The configured storage backend"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            config = app.config
+            if config['STORAGE_BACKEND'] == 's3':
+                if not config['STORAGE_S3_BUCKET']:
+                    raise StorageError('STORAGE_S3_BUCKET must be set to use S3 storage.')
+                _backend = S3Storage(config['STORAGE_ROOT'], config['STORAGE_S3_BUCKET'],
+                                     config['STORAGE_S3_PREFIX'], config['STORAGE_S3_ENDPOINT_URL'])
+            else:
+                _backend = LocalStorage(config['STORAGE_ROOT'])
+        return _backend
+
+def _upsert(connection, rows, set_):
+    dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+    statement = dialect.insert(StoredObject.__table__)
+    statement = statement.on_conflict_do_update(index_elements=['digest'], set_=set_(statement.excluded))
+    connection.execute(statement, rows)
+
+def register(digest, size):
+    """Record an uploaded file before anything refers to it.
+
+    Committed straight away, so the file is known to garbage collection
+    even if the request that uploaded it fails. The grace period starts
+    again on every upload of the same content. Call it before checking
+    whether the content is already stored: it waits for a garbage
+    collection of the digest that is under way to finish.
+    """
+    with db.engine.begin() as conn:
+        _upsert(conn, [{'digest': digest, 'size': size, 'refcount': 0, 'updated_at': datetime.utcnow()}],
+                lambda excluded: {'size': excluded.size, 'updated_at': excluded.updated_at})
+
+def store_file(data, name):
+    """Store a file's bytes under their digest and return its path"""
+    digest = hashlib.sha256(data).hexdigest()
+    register(digest, len(data))
+    key = object_key(digest, secure_filename(name) or 'file')
+    backend = get_storage()
+    if not backend.exists(key):
+        backend.put(key, data)
+    return path_for(key)
+
+def add_references(connection, deltas):
+    """Add deltas ({digest: change}) to the reference counts on connection's transaction"""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    table = StoredObject.__table__
+    now = datetime.utcnow()
+    _upsert(connection, [{'digest': k, 'refcount': v, 'updated_at': now} for k, v in sorted(deltas.items())],
+            lambda excluded: {'refcount': table.c.refcount + excluded.refcount, 'updated_at': excluded.updated_at})
+
+def _record(target, digest, change):
+    session = Session.object_session(target)
+    if digest is None or session is None:
+        return
+    pending = session.info.setdefault('storage_refs', {})
+    pending[digest] = pending.get(digest, 0) + change
+
+def _after_insert(mapper, connection, target):
+    _record(target, digest_of(getattr(target, REFERENCES[type(target)])), 1)
+
+def _after_delete(mapper, connection, target):
+    _record(target, digest_of(getattr(target, REFERENCES[type(target)])), -1)
+
+def _after_update(mapper, connection, target):
+    column = REFERENCES[type(target)]
+    history = inspect(target).attrs[column].history
+    if not history.deleted:
+        return
+    old, new = history.deleted[0], getattr(target, column)
+    if old != new:
+        _record(target, digest_of(old), -1)
+        _record(target, digest_of(new), 1)
+
+def _load_old_value(target, value, oldvalue, initiator):
+    pass
+
+for _model, _column in REFERENCES.items():
+    event.listen(_model, 'after_insert', _after_insert)
+    event.listen(_model, 'after_delete', _after_delete)
+    event.listen(_model, 'after_update', _after_update)
+    # Load the old value when an expired attribute is set, so the file it
+    # pointed to is released
+    event.listen(getattr(_model, _column), 'set', _load_old_value, active_history=True)
+
+@event.listens_for(Session, 'after_flush')
+def _apply_references(session, flush_context):
+    deltas = session.info.pop('storage_refs', None)
+    if deltas:
+        add_references(session.connection(), deltas)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_references(session):
+    session.info.pop('storage_refs', None)
+
+def recount_references():
+    """Recount every reference from the source tables and fix the counts that drifted"""
+    root = os.path.normpath(app.config['STORAGE_ROOT'])
+    counts = {}
+    with db.engine.begin() as conn:
+        for model, column in REFERENCES.items():
+            column = getattr(model, column)
+            for (path,) in conn.execute(select(column).where(column.like(f'{root}/%'))):
+                digest = digest_of(path)
+                if digest:
+                    counts[digest] = counts.get(digest, 0) + 1
+
+        stored = dict(conn.execute(select(StoredObject.digest, StoredObject.refcount)).all())
+        now = datetime.utcnow()
+        for digest, refcount in stored.items():
+            if counts.get(digest, 0) != refcount:
+                conn.execute(update(StoredObject).where(StoredObject.digest == digest)
+                             .values(refcount=counts.get(digest, 0), updated_at=now))
+        missing = [{'digest': d, 'refcount': c, 'updated_at': now} for d, c in counts.items() if d not in stored]
+        if missing:
+            conn.execute(db.insert(StoredObject), missing)
+    return counts
+
+def collect_garbage(grace=None):
+    """Delete stored files no row has referred to for grace seconds. Returns how many."""
+    recount_references()
+    grace = app.config['STORAGE_GC_GRACE'] if grace is None else grace
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    unreferenced = (StoredObject.refcount <= 0) & (StoredObject.updated_at < cutoff)
+    with db.engine.connect() as conn:
+        digests = conn.execute(select(StoredObject.digest).where(unreferenced)).scalars().all()
+
+    backend = get_storage()
+    removed = 0
+    for digest in digests:
+        # Only delete the files if this worker removed the row and nothing
+        # uploaded or referred to them in the meantime. They are deleted
+        # before the row's removal commits: an upload of the same content
+        # waits in register() until then, and so finds the files gone and
+        # stores them again instead of reusing them.
+        with db.engine.begin() as conn:
+            if not conn.execute(delete(StoredObject).where(StoredObject.digest == digest, unreferenced)).rowcount:
+                continue
+            backend.delete(digest)
+        removed += 1
+    if removed:
+        logging.info('Removed %d unreferenced stored files', removed)
+    return removed
+
+@job_handler('collect_storage')
+def collect_storage_job():
+    """Background job: remove stored files that are no longer referenced"""
+    return {'removed': collect_garbage()}
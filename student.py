@@ -1,8 +1,9 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file
+from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required, current_user
+from sqlalchemy.orm import joinedload
 from models import User, Paper, Notification
-from app import db
-import os
+from pdf_generator import pdf_available
+from downloads import count_download, is_full_download, send_download
 
 student_bp = Blueprint('student', __name__)
 
@@ -21,20 +22,22 @@ def student_required(f):
 @student_required
 def dashboard():
     # Get papers for student's class
-    papers = Paper.query.filter_by(class_level=current_user.class_assigned).order_by(Paper.created_at.desc()).all()
+    # Class sets bundle every student's copy, so they are only for the teacher
+    class_papers = Paper.query.filter_by(class_level=current_user.class_assigned, class_set=None)
+    
+    # Filter by subject if requested
+    subject_filter = request.args.get('subject')
+    papers = class_papers.filter_by(subject=subject_filter) if subject_filter else class_papers
+    # The page shows each paper's teacher; load them in the same query
+    papers = papers.options(joinedload(Paper.teacher)).order_by(Paper.created_at.desc()).all()
     
     # Get notifications for students
     notifications = Notification.query.filter(
         (Notification.target_role == 'student') | (Notification.target_role == 'all')
     ).filter_by(is_active=True).order_by(Notification.created_at.desc()).limit(5).all()
     
-    # Filter by subject if requested
-    subject_filter = request.args.get('subject')
-    if subject_filter:
-        papers = [p for p in papers if p.subject == subject_filter]
-    
     # Get available subjects for filtering
-    subjects = list(set([p.subject for p in Paper.query.filter_by(class_level=current_user.class_assigned).all()]))
+    subjects = [s for (s,) in class_papers.with_entities(Paper.subject).distinct().order_by(Paper.subject)]
     
     return render_template('student/dashboard.html', papers=papers, notifications=notifications, subjects=subjects, current_subject=subject_filter)
 
@@ -45,15 +48,22 @@ def download_paper(paper_id):
     paper = Paper.query.get_or_404(paper_id)
     
     # Ensure student can only download papers for their class
-    if paper.class_level != current_user.class_assigned:
+    if paper.class_level != current_user.class_assigned or paper.class_set:
         flash('Access denied.', 'error')
         return redirect(url_for('student.dashboard'))
     
-    if not paper.pdf_path or not os.path.exists(paper.pdf_path):
-        flash('PDF file not found.', 'error')
+    if paper.pdf_status == 'pending':
+        flash('This paper is still being generated. Please try again in a moment.', 'info')
         return redirect(url_for('student.dashboard'))
     
-    return send_file(paper.pdf_path, as_attachment=True, download_name=f'{paper.title}.pdf')
+    try:
+        return send_download(paper.pdf_path, f'{paper.title}.pdf')
+    except FileNotFoundError:
+        if not pdf_available(paper) and paper.pdf_status == 'failed':
+            flash('The PDF could not be generated. Please contact your administrator.', 'error')
+        else:
+            flash('The PDF is being regenerated. Please try again in a moment.', 'info')
+        return redirect(url_for('student.dashboard'))
 
 @student_bp.route('/downloads')
 @login_required
@@ -96,15 +106,16 @@ def download_file(file_id):
         flash('This file is not available for your class.', 'error')
         return redirect(url_for('student.downloads'))
     
-    if not os.path.exists(file.file_path):
+    try:
+        response = send_download(file.file_path, file.title + '.' + file.file_type)
+    except FileNotFoundError:
         flash('File not found.', 'error')
         return redirect(url_for('student.downloads'))
     
-    # Increment download count
-    file.download_count += 1
-    db.session.commit()
-    
-    return send_file(file.file_path, as_attachment=True, download_name=file.title + '.' + file.file_type)
+    # Count full downloads only, not resumed ranges or cache revalidations
+    if is_full_download(response):
+        count_download(file.id)
+    return response
 
 @student_bp.route('/profile')
 @login_required
@@ -1,10 +1,17 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, flash, send_file, jsonify
 from flask_login import login_required, current_user
-from werkzeug.utils import secure_filename
 from models import User, Question, Paper, Notification
 from app import db
-from pdf_generator import generate_paper_pdf
+from jobs import enqueue
+from pdf_generator import answer_key_available, pdf_available, render_paper_bytes
+from downloads import count_download, is_full_download, send_download
+from class_sets import class_students, OUTPUT_FORMATS
+from search import search_questions
+from question_bank import question_tree, picker_page
+from paper_assembly import AssemblyError, assemble_paper, parse_blueprint, question_marks, selected_marks
 from datetime import date
+from io import BytesIO
+import media
 import os
 import json
 
@@ -55,6 +62,7 @@ def generate_paper():
         time_allowed = request.form.get('time_allowed', type=int)
         student_name = request.form.get('student_name', '')
         watermark = request.form.get('watermark', '')
+        class_set = request.form.get('class_set') or None  # zip or merged
         
         # Get selected questions
         selected_questions = request.form.getlist('questions')
@@ -67,15 +75,35 @@ def generate_paper():
             flash('Please select at least one question.', 'error')
             return redirect(url_for('teacher.generate_paper'))
         
+        question_ids = [int(q) for q in selected_questions]
+        marks = selected_marks(question_ids)
+        if marks is None:
+            flash('Some of the selected questions no longer exist.', 'error')
+            return redirect(url_for('teacher.generate_paper'))
+        if marks != total_marks:
+            flash(f'The selected questions add up to {marks} marks, but the paper is out of {total_marks}.', 'error')
+            return redirect(url_for('teacher.generate_paper'))
+        
+        if class_set:
+            if class_set not in OUTPUT_FORMATS:
+                flash('Invalid class set format.', 'error')
+                return redirect(url_for('teacher.generate_paper'))
+            if not class_students(class_level):
+                flash(f'No active students are assigned to class {class_level}.', 'error')
+                return redirect(url_for('teacher.generate_paper'))
+            # Each copy carries its own student's name
+            student_name = ''
+        
         # Handle logo upload
         logo_path = None
         if 'logo' in request.files:
             logo_file = request.files['logo']
             if logo_file and logo_file.filename:
-                filename = secure_filename(logo_file.filename)
-                logo_path = os.path.join('uploads/logos', f'paper_{current_user.id}_{filename}')
-                os.makedirs(os.path.dirname(logo_path), exist_ok=True)
-                logo_file.save(logo_path)
+                try:
+                    logo_path = media.save_image(logo_file)
+                except media.MediaError as e:
+                    flash(f'Logo not saved: {e}', 'error')
+                    return redirect(url_for('teacher.generate_paper'))
         
         # Create paper record
         paper = Paper(
@@ -86,35 +114,132 @@ def generate_paper():
             time_allowed=time_allowed,
             teacher_id=current_user.id,
             student_name=student_name,
+            class_set=class_set,
             logo_path=logo_path,
             watermark=watermark
         )
-        paper.set_question_ids([int(q) for q in selected_questions])
+        paper.set_question_ids(question_ids)
         
         db.session.add(paper)
-        db.session.commit()
+        db.session.flush()
         
-        # Generate PDF
-        try:
-            pdf_path = generate_paper_pdf(paper)
-            paper.pdf_path = pdf_path
-            db.session.commit()
-            
-            flash('Paper generated successfully!', 'success')
-            return redirect(url_for('teacher.view_papers'))
-        except Exception as e:
-            flash(f'Error generating PDF: {str(e)}', 'error')
-            return redirect(url_for('teacher.generate_paper'))
+        # Render the PDF in the background so the worker is free for other requests.
+        # The paper and its job are committed together.
+        enqueue('render_class_set' if class_set else 'render_paper', paper_id=paper.id)
+        
+        flash('Paper created. The PDF is being generated and will be ready shortly.', 'success')
+        return redirect(url_for('teacher.view_papers'))
     
-    # Get available questions
-    questions = Question.query.all()
-    subjects = db.session.query(Question.subject).distinct().all()
-    classes = db.session.query(Question.class_level).distinct().all()
+    # The page loads questions chapter by chapter from the picker API
+    tree = question_tree()
+    subjects = [node['subject'] for node in tree]
+    classes = sorted({c['class_level'] for node in tree for c in node['classes']})
     
     return render_template('teacher/generate_paper.html', 
-                         questions=questions, 
-                         subjects=[s[0] for s in subjects],
-                         classes=[c[0] for c in classes])
+                         question_tree=tree,
+                         subjects=subjects,
+                         classes=classes)
+
+@teacher_bp.route('/papers/preview', methods=['POST'])
+@login_required
+@teacher_required
+def preview_paper():
+    """Render the paper being built straight into the response, without saving anything"""
+    question_ids = list(dict.fromkeys(int(q) for q in request.form.getlist('questions') if q.isdigit()))
+    if not question_ids:
+        return jsonify({'error': 'Please select at least one question.'}), 400
+    limit = current_app.config['PREVIEW_MAX_QUESTIONS']
+    if len(question_ids) > limit:
+        return jsonify({'error': f'A preview can show at most {limit} questions.'}), 400
+    
+    by_id = {q.id: q for q in Question.query.filter(Question.id.in_(question_ids))}
+    if len(by_id) != len(question_ids):
+        return jsonify({'error': 'Some of the selected questions no longer exist.'}), 400
+    questions = [by_id[question_id] for question_id in question_ids]
+    
+    # A transient paper: never added to the session, so no row is written
+    paper = Paper(
+        title=request.form.get('title') or 'Preview',
+        subject=request.form.get('subject') or questions[0].subject,
+        class_level=request.form.get('class_level') or questions[0].class_level,
+        total_marks=request.form.get('total_marks', type=int) or sum(
+            question_marks(q.marks, q.has_parts, q.part_a_marks, q.part_b_marks) for q in questions),
+        time_allowed=request.form.get('time_allowed', type=int) or 0,
+        teacher_id=current_user.id,
+        student_name=request.form.get('student_name', ''),
+        watermark=request.form.get('watermark', '')
+    )
+    
+    # An uploaded logo is checked and sized in memory rather than saved
+    logo = None
+    logo_file = request.files.get('logo')
+    if logo_file and logo_file.filename:
+        try:
+            logo = media.pdf_logo(logo_file)
+        except media.MediaError as e:
+            return jsonify({'error': str(e)}), 400
+    
+    response = send_file(BytesIO(render_paper_bytes(paper, questions, logo=logo)), mimetype='application/pdf',
+                         download_name=f'{paper.title} (preview).pdf')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@teacher_bp.route('/api/questions/tree')
+@login_required
+@teacher_required
+def question_bank_tree():
+    """Subject, class and chapter tree of the question bank with counts"""
+    return jsonify({'tree': question_tree()})
+
+@teacher_bp.route('/api/questions')
+@login_required
+@teacher_required
+def question_bank_page():
+    """One page of questions for the paper builder"""
+    filters = {
+        'subject': request.args.get('subject'),
+        'class_level': request.args.get('class_level'),
+        'chapter_number': request.args.get('chapter_number', type=int),
+        'question_type': request.args.get('question_type'),
+    }
+    page = picker_page(filters, cursor=request.args.get('cursor'),
+                       page_size=request.args.get('limit', type=int))
+    
+    return jsonify({
+        'questions': [dict(row._mapping) for row in page.items],
+        'next_cursor': page.next_cursor,
+    })
+
+@teacher_bp.route('/api/papers/assemble', methods=['POST'])
+@login_required
+@teacher_required
+def assemble_paper_questions():
+    """Pick questions matching a blueprint of type counts, chapter weights and total marks"""
+    try:
+        blueprint = parse_blueprint(request.get_json(silent=True))
+        return jsonify(assemble_paper(blueprint))
+    except AssemblyError as e:
+        return jsonify({'error': str(e)}), 400
+
+@teacher_bp.route('/api/questions/search')
+@login_required
+@teacher_required
+def search_question_bank():
+    """Ranked full-text search over the question bank, with facet counts"""
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': 'Enter something to search for.'}), 400
+    
+    filters = {
+        'subject': request.args.get('subject'),
+        'class_level': request.args.get('class_level'),
+        'chapter_number': request.args.get('chapter_number', type=int),
+        'question_type': request.args.get('question_type'),
+    }
+    # Between 1 and 100; a negative LIMIT would return every match
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    
+    return jsonify(search_questions(q, filters, limit=limit))
 
 @teacher_bp.route('/papers')
 @login_required
@@ -134,11 +259,62 @@ def download_paper(paper_id):
         flash('Access denied.', 'error')
         return redirect(url_for('teacher.view_papers'))
     
-    if not paper.pdf_path or not os.path.exists(paper.pdf_path):
-        flash('PDF file not found.', 'error')
+    if paper.pdf_status == 'pending':
+        flash('The PDF is still being generated. Please try again in a moment.', 'info')
         return redirect(url_for('teacher.view_papers'))
     
-    return send_file(paper.pdf_path, as_attachment=True, download_name=f'{paper.title}.pdf')
+    try:
+        extension = os.path.splitext(paper.pdf_path or '')[1]
+        return send_download(paper.pdf_path, f'{paper.title}{extension}')
+    except FileNotFoundError:
+        if not pdf_available(paper) and paper.pdf_status == 'failed':
+            flash('The PDF could not be generated. Please contact your administrator.', 'error')
+        else:
+            flash('The PDF is being regenerated. Please try again in a moment.', 'info')
+        return redirect(url_for('teacher.view_papers'))
+
+@teacher_bp.route('/papers/answer-key/<int:paper_id>')
+@login_required
+@teacher_required
+def download_answer_key(paper_id):
+    paper = Paper.query.get_or_404(paper_id)
+    
+    # Answers are only ever shown to the teacher who set the paper
+    if paper.teacher_id != current_user.id:
+        flash('Access denied.', 'error')
+        return redirect(url_for('teacher.view_papers'))
+    
+    if paper.pdf_status == 'pending' or paper.answer_key_status == 'pending':
+        flash('The answer key is still being generated. Please try again in a moment.', 'info')
+        return redirect(url_for('teacher.view_papers'))
+    
+    try:
+        return send_download(paper.answer_key_path, f'{paper.title} - answer key.pdf')
+    except FileNotFoundError:
+        if not answer_key_available(paper) and paper.answer_key_status == 'failed':
+            flash('The answer key could not be generated. Please contact your administrator.', 'error')
+        else:
+            flash('The answer key is being regenerated. Please try again in a moment.', 'info')
+        return redirect(url_for('teacher.view_papers'))
+
+@teacher_bp.route('/papers/status/<int:paper_id>')
+@login_required
+@teacher_required
+def paper_status(paper_id):
+    """PDF generation status for a paper, polled by the papers page"""
+    paper = Paper.query.get_or_404(paper_id)
+    
+    if paper.teacher_id != current_user.id:
+        return jsonify({'error': 'Access denied.'}), 403
+    
+    return jsonify({
+        'id': paper.id,
+        'status': paper.pdf_status,
+        'error': paper.pdf_error,
+        'download_url': url_for('teacher.download_paper', paper_id=paper.id) if paper.pdf_status == 'done' else None,
+        'answer_key_url': url_for('teacher.download_answer_key', paper_id=paper.id)
+            if paper.pdf_status == 'done' and paper.answer_key_status != 'pending' else None
+    })
 
 # Question management moved to admin only
 
@@ -168,15 +344,16 @@ def download_file(file_id):
         flash('Access denied.', 'error')
         return redirect(url_for('teacher.downloads'))
     
-    if not os.path.exists(file.file_path):
+    try:
+        response = send_download(file.file_path, file.title + '.' + file.file_type)
+    except FileNotFoundError:
         flash('File not found.', 'error')
         return redirect(url_for('teacher.downloads'))
     
-    # Increment download count
-    file.download_count += 1
-    db.session.commit()
-    
-    return send_file(file.file_path, as_attachment=True, download_name=file.title + '.' + file.file_type)
+    # Count full downloads only, not resumed ranges or cache revalidations
+    if is_full_download(response):
+        count_download(file.id)
+    return response
 
 @teacher_bp.route('/profile')
 @login_required
@@ -0,0 +1,115 @@
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+# The app reads its database URL at import time and writes uploads relative
+# to the working directory, so both go in a scratch directory
+_workdir = tempfile.mkdtemp(prefix='tests-')
+os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(_workdir, "test.db")}'
+os.chdir(_workdir)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash
+from app import app as flask_app, db
+
+PASSWORD = 'password'
+_password_hash = generate_password_hash(PASSWORD)
+
+@pytest.fixture
+def app():
+    """The app inside an application context, with every table emptied afterwards
+    (except the default admin and settings)"""
+    flask_app.config['TESTING'] = True
+    flask_app.root_path = _workdir
+    with flask_app.app_context():
+        yield flask_app
+        db.session.rollback()
+        wait_for_jobs()
+        _clean()
+
+def _clean():
+    from models import User, Setting
+    from question_bank import invalidate_question_tree
+    from settings_cache import invalidate_settings
+    from stats import reconcile_counters
+    import user_cache
+
+    with db.engine.begin() as conn:
+        for table in reversed(db.metadata.sorted_tables):
+            if table.name == 'user':
+                conn.execute(table.delete().where(table.c.role != 'admin'))
+            elif table.name != 'setting' and not table.name.startswith('question_fts'):
+                conn.execute(table.delete())
+    reconcile_counters()
+    invalidate_question_tree()
+    invalidate_settings()
+    db.session.commit()
+    with user_cache._lock:
+        user_cache._entries.clear()
+
+@pytest.fixture
+def make_user(app):
+    """Create a user with the test password"""
+    from models import User
+
+    def make(role='student', **values):
+        count = User.query.count()
+        values.setdefault('name', f'{role.title()} {count}')
+        values.setdefault('email', f'{role}{count}@example.com')
+        if role == 'student':
+            values.setdefault('class_assigned', '9')
+            values.setdefault('roll_no', str(count))
+        if role == 'teacher':
+            values.setdefault('subject', 'Science')
+        user = User(role=role, password_hash=_password_hash, is_active=True, **values)
+        db.session.add(user)
+        db.session.commit()
+        return user
+    return make
+
+@pytest.fixture
+def make_question(app):
+    """Create a question in the bank"""
+    from models import Question, User
+
+    def make(**values):
+        values.setdefault('subject', 'Science')
+        values.setdefault('class_level', '9')
+        values.setdefault('chapter_name', 'Matter')
+        values.setdefault('chapter_number', 1)
+        values.setdefault('question_type', 'Short')
+        values.setdefault('question_text', 'Why?')
+        values.setdefault('marks', 2)
+        values.setdefault('created_by', User.query.filter_by(role='admin').first().id)
+        question = Question(**values)
+        db.session.add(question)
+        db.session.commit()
+        return question
+    return make
+
+def wait_for_jobs(timeout=30):
+    """Wait until no background job is queued or running"""
+    from models import Job
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        busy = db.session.query(Job.id).filter(Job.status.in_(['queued', 'running'])).count()
+        db.session.rollback()
+        if not busy:
+            return
+        time.sleep(0.05)
+    raise TimeoutError('Background jobs did not finish')
+
+def login(client, email, password=PASSWORD):
+    response = client.post('/auth/login', data={'email': email, 'password': password})
+    assert response.status_code == 302
+    return client
+
+@pytest.fixture
+def client_for(app):
+    """A test client logged in as the given user"""
+    def make(user):
+        return login(app.test_client(), user.email)
+    return make
@@ -0,0 +1,86 @@
+import os
+import time
+
+import pytest
+from flask import g
+
+from app import db
+from models import DownloadFile, User
+import downloads
+
+@pytest.fixture
+def shared_file(app, make_user):
+    """A file shared with students, and a logged-in student client"""
+    app.config['DOWNLOAD_FLUSH_INTERVAL'] = 0.1
+    os.makedirs(os.path.join(app.root_path, 'uploads', 'downloads'), exist_ok=True)
+    with open(os.path.join(app.root_path, 'uploads', 'downloads', 'notes.pdf'), 'wb') as f:
+        f.write(b'%PDF-1.4 ' + b'x' * 1000)
+    admin = User.query.filter_by(role='admin').first()
+    file = DownloadFile(title='Notes', file_path='uploads/downloads/notes.pdf', file_type='pdf',
+                        target_role='student', created_by=admin.id)
+    db.session.add(file)
+    db.session.commit()
+    yield file
+    downloads.flush_download_counts()  # so no count lands on the next test's rows
+    app.config['DOWNLOAD_FLUSH_INTERVAL'] = 10
+    app.config['DOWNLOAD_OFFLOAD'] = ''
+
+def download(client, file, **headers):
+    g.pop('_login_user', None)
+    return client.get(f'/student/downloads/file/{file.id}', headers=headers)
+
+def count_of(file):
+    """The file's download count once pending counts are written"""
+    deadline = time.monotonic() + 5
+    while downloads._pending and time.monotonic() < deadline:
+        time.sleep(0.02)
+    time.sleep(0.05)  # let a flush under way commit
+    db.session.expire_all()
+    return db.session.get(DownloadFile, file.id).download_count
+
+def test_full_downloads_are_counted_by_the_timer(app, shared_file, make_user, client_for):
+    client = client_for(make_user('student'))
+    response = download(client, shared_file)
+    assert response.status_code == 200
+    assert 'private' in response.headers['Cache-Control']
+    # No later download arrives; the timer writes the count
+    assert count_of(shared_file) == 1
+
+def test_revalidations_and_ranges_are_not_counted(app, shared_file, make_user, client_for):
+    client = client_for(make_user('student'))
+    etag = download(client, shared_file).headers['ETag']
+    assert count_of(shared_file) == 1
+
+    assert download(client, shared_file, **{'If-None-Match': etag}).status_code == 304
+    response = download(client, shared_file, Range='bytes=500-')
+    assert response.status_code == 206
+    assert len(response.data) == 509
+    assert count_of(shared_file) == 1
+
+def test_nginx_offload_counts_only_full_downloads(app, shared_file, make_user, client_for):
+    app.config['DOWNLOAD_OFFLOAD'] = 'nginx'
+    client = client_for(make_user('student'))
+
+    response = download(client, shared_file)
+    assert response.status_code == 200 and response.data == b''
+    assert response.headers['X-Accel-Redirect'] == '/protected/uploads/downloads/notes.pdf'
+    # nginx answers these itself, after the app's 200
+    assert download(client, shared_file, Range='bytes=500-').status_code == 200
+    assert download(client, shared_file, **{'If-None-Match': '"x"'}).status_code == 200
+    assert count_of(shared_file) == 1
+
+@pytest.mark.parametrize('offload', ['', 'nginx'])
+def test_files_outside_the_app_directory_are_refused(app, shared_file, make_user, client_for, tmp_path, offload):
+    app.config['DOWNLOAD_OFFLOAD'] = offload
+    outside = tmp_path / 'secret.pdf'
+    outside.write_bytes(b'%PDF-1.4')
+    client = client_for(make_user('student'))
+
+    for path in [str(outside), '../' + os.path.basename(app.root_path) + '-other/secret.pdf',
+                 os.path.relpath(outside, app.root_path)]:
+        shared_file.file_path = path
+        db.session.commit()
+        response = download(client, shared_file)
+        assert response.status_code == 302, path
+        assert 'X-Accel-Redirect' not in response.headers
+    assert count_of(shared_file) == 0
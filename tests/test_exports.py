@@ -0,0 +1,82 @@
+import csv
+import io
+import json
+import sys
+
+import pytest
+from flask import g
+
+from models import User
+from conftest import login
+import exports
+from exports import ExportError, export_table
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(exports, 'CHUNK_ROWS', 3)
+
+def test_csv_is_streamed_a_chunk_at_a_time(app, small_chunks, make_user):
+    for _ in range(7):
+        make_user('student')
+    users = User.query.count()
+
+    chunks = list(export_table('users', 'csv'))
+
+    # One chunk per CHUNK_ROWS rows, the header going out with the first
+    assert len(chunks) == -(-users // 3)
+    rows = list(csv.DictReader(io.StringIO(b''.join(chunks).decode('utf-8'))))
+    assert len(rows) == users
+    assert rows[0]['email'] == 'admin@brightstar.edu'
+    assert chunks[0].decode('utf-8').startswith('id,name,email,')
+
+def test_jsonl_is_streamed_a_chunk_at_a_time(app, small_chunks, make_question):
+    for _ in range(5):
+        make_question()
+
+    chunks = export_table('questions', 'jsonl')
+    first = next(chunks)
+    assert len(first.splitlines()) == 3
+    rows = [json.loads(line) for line in (first + b''.join(chunks)).splitlines()]
+    assert len(rows) == 5
+    assert rows[0]['subject'] == 'Science' and 'T' in rows[0]['created_at']
+
+def test_password_hashes_are_never_exported(app, make_user):
+    make_user('teacher')
+    assert 'password_hash' not in [c.name for c in exports.TABLES['users']]
+
+    text = b''.join(export_table('users', 'csv')).decode('utf-8')
+    assert 'password_hash' not in text and 'pbkdf2' not in text and 'scrypt' not in text
+    for line in b''.join(export_table('users', 'jsonl')).splitlines():
+        assert 'password_hash' not in json.loads(line)
+
+def test_parquet_export_has_a_row_group_per_chunk(app, small_chunks, make_user):
+    pq = pytest.importorskip('pyarrow.parquet')  # the optional "parquet" extra
+    for _ in range(4):
+        make_user('student')
+
+    table = pq.ParquetFile(io.BytesIO(b''.join(export_table('users', 'parquet'))))
+
+    assert table.metadata.num_rows == User.query.count()
+    assert table.metadata.num_row_groups == -(-table.metadata.num_rows // 3)
+    assert 'password_hash' not in table.schema_arrow.names
+
+def test_unknown_tables_and_formats_are_rejected(app, monkeypatch):
+    with pytest.raises(ExportError, match='Unknown table'):
+        export_table('setting', 'csv')
+    with pytest.raises(ExportError, match='Unknown format'):
+        export_table('users', 'xml')
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    with pytest.raises(ExportError, match='pyarrow'):
+        export_table('users', 'parquet')
+
+def test_export_route(app):
+    g.pop('_login_user', None)
+    client = login(app.test_client(), 'admin@brightstar.edu', 'admin123')
+
+    response = client.get('/admin/export/users.csv')
+    assert response.status_code == 200 and response.is_streamed
+    assert response.headers['Content-Disposition'].startswith('attachment; filename=users_')
+    assert b'admin@brightstar.edu' in response.data
+
+    for url in ['/admin/export/setting.csv', '/admin/export/users.xml']:
+        assert client.get(url).status_code == 302
@@ -0,0 +1,84 @@
+import re
+import threading
+
+import pytest
+from flask import Flask, g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import instrumentation
+from instrumentation import endpoint_stats, fingerprint, reset_stats
+from test_query_budgets import templates  # noqa: F401 (fixture)
+
+HOOKS = [('before_cursor_execute', instrumentation._before_execute),
+         ('after_cursor_execute', instrumentation._after_execute)]
+
+def request_counting(client, url):
+    """The response to a GET and the number of statements sent for it"""
+    thread, count = threading.get_ident(), [0]
+
+    def counter(*args):
+        if threading.get_ident() == thread:
+            count[0] += 1
+    event.listen(Engine, 'before_cursor_execute', counter)
+    try:
+        g.pop('_login_user', None)
+        return client.get(url), count[0]
+    finally:
+        event.remove(Engine, 'before_cursor_execute', counter)
+
+@pytest.fixture
+def fresh_stats(app):
+    reset_stats()
+    yield
+    reset_stats()
+
+def test_fingerprints_group_statements_that_differ_in_literals():
+    assert fingerprint("SELECT * FROM user WHERE id = 7 AND name = 'O''Neil'") == \
+        fingerprint("SELECT * FROM user WHERE id = 12 AND name = 'Ann'")
+    assert fingerprint('SELECT 1 FROM question WHERE id IN (1, 2, 3)') == \
+        fingerprint('SELECT 1 FROM question WHERE id IN (4)')
+
+def test_a_requests_queries_are_counted_timed_and_aggregated(app, templates, fresh_stats, make_user, client_for):
+    client = client_for(make_user('teacher'))
+
+    response, sent = request_counting(client, '/teacher/dashboard')
+
+    assert response.status_code == 200 and sent > 0
+    timings = response.headers.getlist('Server-Timing')
+    db_timing = re.fullmatch(r'db;dur=([\d.]+);desc="(\d+) queries"', timings[0])
+    assert db_timing and int(db_timing.group(2)) == sent
+    assert re.fullmatch(r'app;dur=[\d.]+', timings[1])
+    assert float(db_timing.group(1)) <= float(timings[1].split('=')[1])
+
+    stats = {s['endpoint']: s for s in endpoint_stats()}['teacher.dashboard']
+    assert (stats['requests'], stats['avg_queries'], stats['max_queries']) == (1, sent, sent)
+    assert stats['avg_db_ms'] > 0 and stats['slowest']
+
+def test_repeated_statements_are_reported_as_n_plus_one(app, templates, fresh_stats, monkeypatch, make_user,
+                                                        client_for):
+    monkeypatch.setitem(app.config, 'N_PLUS_ONE_THRESHOLD', 1)
+    client = client_for(make_user('teacher'))
+    request_counting(client, '/teacher/dashboard')
+
+    stats = {s['endpoint']: s for s in endpoint_stats()}['teacher.dashboard']
+    assert stats['n_plus_one_requests'] == 1 and stats['n_plus_one']
+
+def test_nothing_is_attached_when_turned_off(app):
+    for name, listener in HOOKS:
+        event.remove(Engine, name, listener)
+    try:
+        off = Flask('off')
+        off.config['SQL_INSTRUMENTATION'] = False
+        instrumentation.init_app(off)
+        assert not any(event.contains(Engine, name, listener) for name, listener in HOOKS)
+        assert not off.before_request_funcs and not off.after_request_funcs
+
+        on = Flask('on')
+        on.config['SQL_INSTRUMENTATION'] = True
+        instrumentation.init_app(on)
+        assert all(event.contains(Engine, name, listener) for name, listener in HOOKS)
+        assert on.before_request_funcs[None] == [instrumentation._before_request]
+    finally:
+        for name, listener in HOOKS:
+            event.listen(Engine, name, listener)
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from models import Job
+from conftest import wait_for_jobs
+import jobs
+from jobs import enqueue, job_handler, resume_pending, run_job, set_progress, set_result
+
+@pytest.fixture
+def handlers(app, monkeypatch):
+    """A handler registry of the test's own, so test handlers don't outlive it"""
+    monkeypatch.setattr(jobs, '_handlers', dict(jobs._handlers))
+    return jobs._handlers
+
+def queued(kind, **payload):
+    """A job stored as enqueue() stores it, but not handed to the worker pool"""
+    job = Job(kind=kind, status='queued')
+    job.set_payload(payload)
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+def job(job_id):
+    db.session.expire_all()
+    return db.session.get(Job, job_id)
+
+def test_registered_handlers_run_with_the_payload(app, handlers):
+    @job_handler('add')
+    def add(a, b):
+        set_progress(50)
+        return {'sum': a + b}
+
+    assert handlers['add'] is add
+    job_id = enqueue('add', a=2, b=3).id
+    wait_for_jobs()
+
+    done = job(job_id)
+    assert (done.status, done.get_result(), done.progress, done.attempts) == ('done', {'sum': 5}, 50, 1)
+    assert done.started_at <= done.finished_at
+    # Outside a job the helpers do nothing
+    set_progress(10)
+    set_result({'ignored': True})
+
+def test_a_failing_job_records_its_error_and_partial_result(app, handlers):
+    @job_handler('explode')
+    def explode():
+        set_result({'rows': 10})
+        db.session.add(Job(kind='left-behind', status='queued'))
+        raise RuntimeError('disk full')
+
+    job_id = queued('explode')
+    run_job(job_id)
+
+    failed = job(job_id)
+    assert (failed.status, failed.error, failed.attempts) == ('failed', 'disk full', 1)
+    assert failed.get_result() == {'rows': 10} and failed.finished_at
+    # The handler's own uncommitted changes are rolled back
+    assert not Job.query.filter_by(kind='left-behind').count()
+
+def test_a_kind_without_a_handler_fails(app, handlers):
+    job_id = queued('no-such-kind')
+    run_job(job_id)
+    assert job(job_id).status == 'failed' and 'no-such-kind' in job(job_id).error
+
+def test_a_job_is_run_once_however_often_it_is_claimed(app, handlers):
+    runs = []
+    handlers['count'] = lambda: runs.append(1)
+
+    job_id = queued('count')
+    run_job(job_id)
+    run_job(job_id)  # a second worker handed the same id
+
+    assert runs == [1] and job(job_id).attempts == 1
+
+def test_stale_running_jobs_are_claimed_again(app, handlers):
+    handlers['count'] = lambda: None
+    long_ago = datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_AFTER'] + 60)
+    stale, recent = queued('count'), queued('count')
+    Job.query.filter_by(id=stale).update({'status': 'running', 'started_at': long_ago, 'attempts': 1})
+    Job.query.filter_by(id=recent).update({'status': 'running', 'started_at': datetime.utcnow(), 'attempts': 1})
+    db.session.commit()
+
+    resume_pending()
+
+    # A job that started recently is still its worker's
+    assert (job(recent).status, job(recent).attempts) == ('running', 1)
+    Job.query.filter_by(id=recent).update({'status': 'failed'})  # so the wait below ends
+    db.session.commit()
+    wait_for_jobs()
+    assert (job(stale).status, job(stale).attempts) == ('done', 2)
@@ -0,0 +1,91 @@
+from datetime import date, datetime, timedelta
+
+from flask import g
+
+from app import db
+from models import Question
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_cursor, encode_cursor, keyset_paginate
+from query_plans import explain, is_full_scan
+from test_query_budgets import templates  # noqa: F401 (fixture)
+
+SORT = [(Question.created_at, True), (Question.id, True)]
+
+def all_pages(query, sort_keys, page_size):
+    """Ids of every row, walking the pages by cursor"""
+    ids, cursor = [], None
+    while True:
+        page = keyset_paginate(query, sort_keys, cursor=cursor, page_size=page_size)
+        ids.extend(row.id for row in page.items)
+        if not page.has_next:
+            return ids
+        cursor = page.next_cursor
+
+def test_cursors_round_trip():
+    values = [datetime(2026, 3, 1, 8, 30, 15, 250), date(2026, 3, 1), 42, 'Matter', None]
+    cursor = encode_cursor(values)
+    assert '=' not in cursor and '/' not in cursor  # safe in a URL as it is
+    assert decode_cursor(cursor) == values
+
+def test_malformed_cursors_start_from_the_first_page(app, make_question):
+    questions = [make_question() for _ in range(3)]
+    cursors = [None, '', 'not-a-cursor', '%%%', encode_cursor([1]),
+               # Values that don't fit the sort columns
+               encode_cursor([None, None]), encode_cursor([[1], {}]), encode_cursor(['yesterday', 5]),
+               encode_cursor([datetime(2026, 1, 1), '5']), encode_cursor([date(2026, 1, 1), 5]),
+               encode_cursor([datetime(2026, 1, 1), True]), encode_cursor([datetime(2026, 1, 1), 2.5]),
+               'e30',  # {} rather than a list
+               encode_cursor([{'dt': 'not a date'}, 5]), encode_cursor([{'dt': 5}, 5])]
+    for cursor in cursors:
+        page = keyset_paginate(Question.query, SORT, cursor=cursor, page_size=2)
+        assert [q.id for q in page.items] == [questions[2].id, questions[1].id], cursor
+
+def test_malformed_cursors_are_not_server_errors(app, templates, make_user, make_question, client_for):
+    make_question()
+    admin = client_for(make_user('admin'))
+    teacher = client_for(make_user('teacher'))
+    for cursor in [encode_cursor([None, None]), encode_cursor([[1], {}]), encode_cursor([{'x': 1}, 'a'])]:
+        for client, url in [(admin, '/admin/questions'), (admin, '/admin/teachers'), (admin, '/admin/students'),
+                            (admin, '/admin/notifications'), (teacher, '/teacher/api/questions')]:
+            g.pop('_login_user', None)
+            assert client.get(f'{url}?cursor={cursor}').status_code < 500, (url, cursor)
+
+def test_pages_cover_every_row_once_with_equal_timestamps(app, make_question):
+    start = datetime(2026, 1, 1)
+    # Several rows share each created_at, so the id breaks the ties
+    questions = [make_question(created_at=start + timedelta(minutes=i // 3)) for i in range(11)]
+    expected = [q.id for q in sorted(questions, key=lambda q: (q.created_at, q.id), reverse=True)]
+
+    assert all_pages(Question.query, SORT, 4) == expected
+    ascending = [(Question.created_at, False), (Question.id, False)]
+    assert all_pages(Question.query, ascending, 4) == expected[::-1]
+
+def test_cursors_keep_the_filter(app, make_question):
+    maths = [make_question(subject='Maths') for _ in range(5)]
+    make_question(subject='Science')
+    query = Question.query.filter_by(subject='Maths')
+    assert all_pages(query, SORT, 2) == [q.id for q in reversed(maths)]
+
+def test_rows_added_while_paging_are_not_repeated(app, make_question):
+    questions = [make_question() for _ in range(4)]
+    first = keyset_paginate(Question.query, SORT, page_size=2)
+    make_question(created_at=datetime.utcnow() + timedelta(hours=1))  # a new row at the top
+
+    second = keyset_paginate(Question.query, SORT, cursor=first.next_cursor, page_size=2)
+    assert [q.id for q in second.items] == [questions[1].id, questions[0].id]
+    assert not second.has_next
+
+def test_page_size_is_clamped(app, make_question):
+    make_question()
+    assert keyset_paginate(Question.query, SORT, page_size=None).page_size == DEFAULT_PAGE_SIZE
+    assert keyset_paginate(Question.query, SORT, page_size=-5).page_size == 1
+    assert keyset_paginate(Question.query, SORT, page_size=10_000).page_size == MAX_PAGE_SIZE
+
+def test_filtered_question_pages_read_an_index_in_order(app):
+    for filters in [{'subject': 'Maths'}, {'class_level': '9'}, {'question_type': 'MCQ'},
+                    {'subject': 'Maths', 'class_level': '9'}]:
+        query = Question.query.filter_by(**filters).order_by(Question.created_at.desc(), Question.id.desc()).limit(51)
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        plan = explain(str(compiled), tuple(compiled.params[name] for name in compiled.positiontup))
+        assert not any(is_full_scan(line) for line in plan), (filters, plan)
+        # The index gives the order, so no sort of the matching rows
+        assert not any('TEMP B-TREE' in line for line in plan), (filters, plan)
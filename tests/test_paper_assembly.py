@@ -0,0 +1,101 @@
+import pytest
+
+from paper_assembly import AssemblyError, assemble_paper, parse_blueprint, question_marks, selected_marks
+
+def blueprint(**values):
+    data = {'subject': 'Science', 'class_level': '9', 'total_marks': 10, 'question_types': {'Short': 2}}
+    data.update(values)
+    return data
+
+def test_parse_blueprint_normalises_types(app):
+    parsed = parse_blueprint(blueprint(total_marks='12', question_types={'MCQ': '3', 'Long': 0},
+                                       chapter_weights={'2': '1.5'}))
+    assert parsed['total_marks'] == 12
+    assert parsed['question_types'] == {'MCQ': 3}
+    assert parsed['chapter_weights'] == {2: 1.5}
+
+@pytest.mark.parametrize('values, message', [
+    ({'total_marks': 0}, 'positive'),
+    ({'total_marks': 'many'}, 'numbers'),
+    ({'question_types': {}}, 'at least one question'),
+    ({'question_types': {'Essay': 1}}, 'Unknown question type'),
+    ({'chapter_weights': {'1': -1}}, 'negative'),
+    ({'chapter_weights': {'1': 0}}, 'positive weight'),
+    ({'seed': [1]}, 'Seed'),
+    ({'seed': {'a': 1}}, 'Seed'),
+    ({'seed': '7'}, 'Seed'),
+    ({'seed': 1.5}, 'Seed'),
+    ({'seed': True}, 'Seed'),
+])
+def test_parse_blueprint_rejects_bad_input(app, values, message):
+    with pytest.raises(AssemblyError, match=message):
+        parse_blueprint(blueprint(**values))
+
+def test_parse_blueprint_caps_marks_and_questions(app):
+    app.config['ASSEMBLY_MAX_MARKS'] = 100
+    app.config['ASSEMBLY_MAX_QUESTIONS'] = 10
+    with pytest.raises(AssemblyError, match='at most 100'):
+        parse_blueprint(blueprint(total_marks=10**9))
+    with pytest.raises(AssemblyError, match='at most 10 questions'):
+        parse_blueprint(blueprint(question_types={'MCQ': 10**8}))
+    with pytest.raises(AssemblyError, match='at most 10 questions'):
+        parse_blueprint(blueprint(question_types={'MCQ': 6, 'Short': 5}))
+    assert parse_blueprint(blueprint(total_marks=100, question_types={'MCQ': 5, 'Short': 5}))
+
+def test_question_marks_counts_both_parts():
+    assert question_marks(3, False, None, None) == 3
+    assert question_marks(3, True, 2, 4) == 6
+
+def test_assemble_paper_meets_counts_and_marks_exactly(app, make_question):
+    for marks in (1, 1, 2, 3, 5):
+        make_question(question_type='Short', marks=marks)
+    for marks in (1, 1, 1):
+        make_question(question_type='MCQ', marks=marks)
+
+    result = assemble_paper(parse_blueprint(blueprint(total_marks=9, question_types={'Short': 2, 'MCQ': 2},
+                                                      seed=7)))
+    assert result['total_marks'] == 9
+    assert sum(q['marks'] for q in result['questions']) == 9
+    assert [q['question_type'] for q in result['questions']].count('Short') == 2
+    assert len(set(result['question_ids'])) == 4
+
+def test_assemble_paper_respects_chapter_weights(app, make_question):
+    for chapter in (1, 2):
+        for _ in range(3):
+            make_question(chapter_number=chapter, marks=2)
+    result = assemble_paper(parse_blueprint(blueprint(total_marks=4, chapter_weights={'2': 1})))
+    assert {q['chapter_number'] for q in result['questions']} == {2}
+
+def test_assemble_paper_reports_impossible_totals(app, make_question):
+    for _ in range(3):
+        make_question(marks=2)
+    with pytest.raises(AssemblyError, match='exactly 5 marks'):
+        assemble_paper(parse_blueprint(blueprint(total_marks=5)))
+    with pytest.raises(AssemblyError, match='Only 3 Short'):
+        assemble_paper(parse_blueprint(blueprint(question_types={'Short': 4})))
+
+def test_assemble_route_rejects_a_bad_seed(app, make_user, make_question, client_for):
+    make_question()
+    client = client_for(make_user('teacher'))
+    for seed in [[1], {'a': 1}]:
+        response = client.post('/teacher/api/papers/assemble', json=blueprint(seed=seed))
+        assert response.status_code == 400
+        assert response.get_json() == {'error': 'Seed must be a whole number.'}
+    assert client.post('/teacher/api/papers/assemble', json=blueprint(total_marks=2, question_types={'Short': 1},
+                                                                        seed=None)).status_code == 200
+
+def test_preview_totals_marks_as_the_generated_paper_does(app, make_user, make_question, client_for, monkeypatch):
+    import teacher
+    questions = [make_question(marks=2), make_question(marks=None, has_parts=True, part_a_marks=2, part_b_marks=3)]
+    rendered = []
+
+    def render(paper, questions, logo=None):
+        rendered.append(paper)
+        return b'%PDF'
+    monkeypatch.setattr(teacher, 'render_paper_bytes', render)
+    client = client_for(make_user('teacher'))
+
+    response = client.post('/teacher/papers/preview', data={'questions': [str(q.id) for q in questions]})
+
+    assert response.status_code == 200
+    assert rendered[0].total_marks == selected_marks([q.id for q in questions]) == 7
@@ -0,0 +1,95 @@
+import os
+
+from app import db
+from models import Job, Paper
+from conftest import wait_for_jobs
+import pdf_generator
+
+def make_paper(teacher, questions, **values):
+    paper = Paper(title='Quiz', subject='Science', class_level='9', total_marks=sum(q.marks for q in questions),
+                  time_allowed=30, teacher_id=teacher.id, **values)
+    paper.set_question_ids([q.id for q in questions])
+    db.session.add(paper)
+    db.session.commit()
+    return paper
+
+def rendered_paper(teacher, questions):
+    paper = make_paper(teacher, questions)
+    pdf_generator.render_paper_job(paper.id)
+    db.session.refresh(paper)
+    assert paper.pdf_status == paper.answer_key_status == 'done'
+    return paper
+
+def test_missing_answer_key_renders_only_the_key(app, make_user, make_question, client_for):
+    teacher = make_user('teacher')
+    paper = rendered_paper(teacher, [make_question()])
+    # A paper from before answer keys existed
+    paper.answer_key_path = paper.answer_key_status = None
+    db.session.commit()
+
+    client = client_for(teacher)
+    response = client.get(f'/teacher/papers/answer-key/{paper.id}')
+    assert response.status_code == 302
+    db.session.refresh(paper)
+    assert paper.pdf_status == 'done'
+    assert [job.kind for job in Job.query.filter_by(status='queued')] in ([], ['render_answer_key'])
+
+    # The paper itself stays downloadable while the key renders
+    assert client.get(f'/teacher/papers/download/{paper.id}').status_code == 200
+
+    wait_for_jobs()
+    db.session.refresh(paper)
+    assert paper.answer_key_status == 'done'
+    assert client.get(f'/teacher/papers/answer-key/{paper.id}').status_code == 200
+    assert Job.query.filter_by(kind='render_paper').count() == 0
+
+def test_failed_renders_are_retried_a_limited_number_of_times(app, make_user, make_question, client_for):
+    app.config['PDF_RENDER_MAX_ATTEMPTS'] = 2
+    teacher = make_user('teacher')
+    paper = make_paper(teacher, [make_question()], pdf_status='failed', render_failures=2)
+    client = client_for(teacher)
+
+    for _ in range(3):
+        assert client.get(f'/teacher/papers/download/{paper.id}').status_code == 302
+    assert Job.query.count() == 0
+    db.session.refresh(paper)
+    assert paper.pdf_status == 'failed'
+
+    paper.render_failures = 1
+    db.session.commit()
+    assert not pdf_generator.pdf_available(paper)
+    assert paper.pdf_status == 'pending'
+    assert [job.kind for job in Job.query] == ['render_paper']
+
+def test_evicted_pdf_is_rendered_again(app, make_user, make_question, client_for):
+    teacher = make_user('teacher')
+    paper = rendered_paper(teacher, [make_question()])
+    os.remove(paper.pdf_path)
+
+    assert client_for(teacher).get(f'/teacher/papers/download/{paper.id}').status_code == 302
+    wait_for_jobs()
+    db.session.refresh(paper)
+    assert paper.pdf_status == 'done' and os.path.exists(paper.pdf_path)
+
+def test_a_failed_answer_key_leaves_the_paper_rendered(app, make_user, make_question, client_for, monkeypatch):
+    def broken(*args):
+        raise RuntimeError('key layout failed')
+    monkeypatch.setattr(pdf_generator, 'render_answer_key', broken)
+    teacher = make_user('teacher')
+    paper = make_paper(teacher, [make_question(question_text='A question only this paper has')])
+
+    pdf_generator.render_paper_job(paper.id)
+
+    db.session.refresh(paper)
+    assert paper.pdf_status == 'done' and os.path.exists(paper.pdf_path)
+    assert (paper.answer_key_status, paper.answer_key_path, paper.render_failures) == ('failed', None, 1)
+    client = client_for(teacher)
+    assert client.get(f'/teacher/papers/download/{paper.id}').status_code == 200
+
+    # Asking for the key again renders only the key
+    monkeypatch.undo()
+    assert client.get(f'/teacher/papers/answer-key/{paper.id}').status_code == 302
+    wait_for_jobs()
+    db.session.refresh(paper)
+    assert paper.answer_key_status == 'done'
+    assert [job.kind for job in Job.query] == ['render_answer_key']
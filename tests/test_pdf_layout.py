@@ -0,0 +1,39 @@
+from io import BytesIO
+from types import SimpleNamespace
+
+from PIL import Image as PILImage
+from reportlab import rl_config
+from reportlab.platypus import Image
+
+import pdf_layout
+
+PAPER = SimpleNamespace(subject='Science', class_level='9', time_allowed=30, total_marks=10,
+                        student_name=None, watermark=None)
+
+def png(path=None):
+    target = path or BytesIO()
+    PILImage.new('RGB', (300, 300), (200, 30, 30)).save(target, 'PNG')
+    if path is None:
+        target.seek(0)
+    return target
+
+def test_logo_is_centred(tmp_path):
+    context = pdf_layout.RenderContext()
+    logo_path = str(tmp_path / 'logo.png')
+    png(logo_path)
+
+    for story in (pdf_layout.header_story(context, PAPER, 'Academy', logo=png()),
+                  pdf_layout.header_story(context, PAPER, 'Academy', logo_path=logo_path)):
+        images = [flowable for flowable in story if isinstance(flowable, Image)]
+        assert [image.hAlign for image in images] == ['CENTER']
+
+def test_papers_are_written_without_ascii85_and_the_global_is_left_alone():
+    assert rl_config.useA85 == 1
+    buffer = BytesIO()
+    doc = pdf_layout.new_doc(buffer)
+    pdf_layout.build_doc(doc, pdf_layout.header_story(pdf_layout.render_context(), PAPER, 'Academy', logo=png()),
+                         'Academy')
+
+    assert b'ASCII85Decode' not in buffer.getvalue()
+    assert b'FlateDecode' in buffer.getvalue()
+    assert rl_config.useA85 == 1
@@ -0,0 +1,93 @@
+import os
+import threading
+
+import pytest
+from flask import g
+from jinja2 import ChoiceLoader, FileSystemLoader
+from sqlalchemy import event
+
+from app import db
+from models import Notification, User
+from benchmark import QUERY_BUDGETS
+from conftest import PASSWORD, login
+from test_paper_downloads import make_paper
+
+# The pages render stand-in templates (tests/templates) that read the same
+# relationships as the real ones, so a relationship loaded lazily from a
+# template costs a query per row here too.
+
+PAGES = {
+    'admin.dashboard': ('admin', '/admin/dashboard'),
+    'admin.manage_questions': ('admin', '/admin/questions'),
+    'admin.manage_teachers': ('admin', '/admin/teachers'),
+    'teacher.dashboard': ('teacher', '/teacher/dashboard'),
+    'student.dashboard': ('student', '/student/dashboard'),
+    'student.dashboard subject': ('student', '/student/dashboard?subject=Science'),
+}
+
+@pytest.fixture
+def templates(app):
+    loader = app.jinja_env.loader
+    app.jinja_env.loader = ChoiceLoader([
+        FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates')), loader])
+    app.jinja_env.cache.clear()
+    yield
+    app.jinja_env.loader = loader
+    app.jinja_env.cache.clear()
+
+def get(client, url):
+    # Requests share the test's app context, and with it the user
+    # Flask-Login cached in g for the previous client
+    g.pop('_login_user', None)
+    return client.get(url)
+
+def queries_for(client, url):
+    """Status and number of statements a request sends to the database"""
+    thread, count = threading.get_ident(), [0]
+
+    def counter(*args):
+        if threading.get_ident() == thread:
+            count[0] += 1
+    event.listen(db.engine, 'before_cursor_execute', counter)
+    try:
+        response = get(client, url)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', counter)
+    return response.status_code, count[0]
+
+def add_rows(make_user, make_question, teachers):
+    """Teachers, each with a question and a paper for class 9, and a notification"""
+    admin = User.query.filter_by(role='admin').first()
+    for _ in range(teachers):
+        teacher = make_user('teacher')
+        make_paper(teacher, [make_question(created_by=teacher.id)])
+        db.session.add(Notification(title='Exam week', message='Revise.', target_role='all', created_by=admin.id))
+    db.session.commit()
+
+def test_pages_stay_within_their_query_budgets(app, templates, make_user, make_question):
+    teacher, student = make_user('teacher'), make_user('student')
+    clients = {}
+    for role, email, password in [('admin', 'admin@brightstar.edu', 'admin123'),
+                                  ('teacher', teacher.email, PASSWORD), ('student', student.email, PASSWORD)]:
+        g.pop('_login_user', None)
+        clients[role] = login(app.test_client(), email, password)
+    make_paper(teacher, [make_question(created_by=teacher.id)])
+
+    def measure():
+        counts = {}
+        for name, (role, url) in PAGES.items():
+            get(clients[role], url)  # warm the per-process caches
+            status, queries = queries_for(clients[role], url)
+            assert status == 200, name
+            counts[name] = queries
+        return counts
+
+    add_rows(make_user, make_question, 2)
+    few = measure()
+    add_rows(make_user, make_question, 8)
+    many = measure()
+
+    for name in PAGES:
+        assert many[name] <= QUERY_BUDGETS[name], f'{name} made {many[name]} queries'
+        # More rows on the page must not mean more queries
+        assert many[name] == few[name], name
@@ -0,0 +1,24 @@
+from app import db
+from models import Notification, User
+from query_plans import capture_statements, check_query_plans
+from test_paper_downloads import make_paper
+from test_query_budgets import templates  # noqa: F401 (fixture)
+
+def test_captured_page_queries_use_an_index(app, templates, make_user, make_question):
+    teacher = make_user('teacher')
+    make_user('student')
+    admin = User.query.filter_by(role='admin').first()
+    make_paper(teacher, [make_question(created_by=teacher.id, subject='Science')])
+    db.session.add(Notification(title='Exam week', message='Revise.', target_role='all', created_by=admin.id))
+    db.session.commit()
+
+    statements = capture_statements()
+    names = {name for name, statement, parameters in statements}
+    assert '/admin/questions?subject=Science&class_level=9' in names
+    assert {'pdf_generator.get_paper_questions', 'class_sets.class_students', 'jobs.queued_job_ids'} <= names
+    # The filtered page sends the filter the view builds
+    assert any('question.subject = ?' in statement for name, statement, parameters in statements
+               if name.startswith('/admin/questions?'))
+
+    failures = check_query_plans(statements)
+    assert failures == [], [(name, plan) for name, statement, plan in failures]
@@ -0,0 +1,147 @@
+import csv
+import json
+
+import openpyxl
+import pytest
+
+from models import Question, User
+import question_import
+from question_import import ImportFileError, QuestionError, import_questions, read_rows, row_fields
+
+COLUMNS = ['subject', 'class_level', 'chapter_name', 'chapter_number', 'question_type', 'question_text', 'marks',
+           'has_parts', 'part_a_text', 'part_a_marks', 'part_b_text', 'part_b_marks', 'options', 'option_1',
+           'option_2']
+
+def question(**values):
+    row = dict(subject='Science', class_level='9', chapter_name='Matter', chapter_number='1',
+               question_type='Short', question_text='What is matter?', marks='2')
+    row.update(values)
+    return row
+
+@pytest.fixture
+def admin_id(app):
+    return User.query.filter_by(role='admin').first().id
+
+def write_csv(path, *rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+def test_options_come_from_a_list_separators_or_numbered_columns():
+    assert row_fields(question(options='["A", "B"]'))['options'] == ['A', 'B']
+    assert row_fields(question(options=' A | | B '))['options'] == ['A', 'B']
+    assert row_fields({'Option_2': 'B', 'option_1': 'A', 'option_10': 'J'})['options'] == ['A', 'B', 'J']
+    with pytest.raises(QuestionError):
+        row_fields(question(options='[not json'))
+
+def test_numbers_must_be_whole():
+    assert row_fields(question(chapter_number=3.0, marks=''))['chapter_number'] == 3
+    assert row_fields(question(marks=''))['marks'] is None
+    for value in ['2.5', 'two']:
+        with pytest.raises(QuestionError, match='marks must be a whole number'):
+            row_fields(question(marks=value))
+
+def test_rows_are_checked_and_duplicates_skipped(app, admin_id, tmp_path, make_question):
+    make_question(question_text='Define  an atom.')
+    path = write_csv(
+        tmp_path / 'questions.csv',
+        question(),
+        question(question_text='  WHAT is   matter? '),  # the same question, spaced and cased differently
+        question(question_text='define an atom.'),  # already in the bank
+        question(question_type='MCQ', question_text='Pick one', option_1='Solid', option_2='Gas'),
+        question(question_type='MCQ', question_text='Pick none'),
+        question(question_text='Two parts', has_parts='yes', part_a_text='A', part_a_marks='1',
+                 part_b_text='B', part_b_marks='3'),
+        question(question_text='', chapter_name=''),
+        question(chapter_number='x'),
+    )
+
+    report = import_questions(path, 'csv', admin_id)
+
+    assert (report['rows'], report['imported'], report['duplicates'], report['error_count']) == (8, 3, 2, 3)
+    assert report['errors'] == [
+        {'row': 6, 'error': 'MCQ questions must have options.'},
+        {'row': 8, 'error': 'All required fields must be filled.'},
+        {'row': 9, 'error': 'chapter_number must be a whole number.'},
+    ]
+    assert json.loads(Question.query.filter_by(question_text='Pick one').one().options) == ['Solid', 'Gas']
+    assert Question.query.filter_by(question_text='Two parts').one().marks == 4
+
+def test_json_lists_are_read_across_chunks(app, tmp_path, monkeypatch):
+    items = [question(question_text=f'Question {i} ' + 'x' * 50) for i in range(20)]
+    path = tmp_path / 'questions.json'
+    path.write_text(' \n' + json.dumps(items, indent=1))
+    read_json = question_import._read_json
+    monkeypatch.setitem(question_import._READERS, 'json', lambda p, position: read_json(p, position, chunk_size=16))
+
+    rows = list(read_rows(str(path), 'json'))
+    assert [number for number, _ in rows] == list(range(1, 21))
+    assert [row for _, row in rows] == items
+
+    path.write_text(json.dumps(items)[:-40])
+    with pytest.raises(ImportFileError, match='malformed after item 19'):
+        list(read_rows(str(path), 'json'))
+    path.write_text(json.dumps({'questions': items}))
+    with pytest.raises(ImportFileError, match='must contain a list'):
+        list(read_rows(str(path), 'json'))
+
+def test_bad_json_lines_are_reported_by_line(app, admin_id, tmp_path):
+    path = tmp_path / 'questions.jsonl'
+    path.write_text('\n'.join([json.dumps(question()), '', '{broken', '["a list"]', json.dumps(question(marks=3.5))]))
+
+    report = import_questions(str(path), 'jsonl', admin_id)
+
+    assert report['imported'] == 1
+    assert report['errors'] == [
+        {'row': 3, 'error': 'Row is not a JSON object.'},
+        {'row': 4, 'error': 'Row is not a JSON object.'},
+        {'row': 5, 'error': 'marks must be a whole number.'},
+    ]
+
+def test_xlsx_rows_are_imported_and_numbered_as_in_the_sheet(app, admin_id, tmp_path):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(['Subject', 'class_level', 'chapter_name', 'chapter_number', 'question_type', 'question_text',
+                  'marks', 'options'])
+    sheet.append(['Science', '9', 'Matter', 1, 'Short', 'What is matter?', 2, None])
+    sheet.append([None] * 8)
+    sheet.append(['Science', '9', 'Matter', 2.0, 'MCQ', 'Pick one', None, 'Solid|Gas'])
+    sheet.append(['Science', '9', 'Matter', 2.5, 'Short', 'Half a chapter?', 1, None])
+    path = str(tmp_path / 'questions.xlsx')
+    workbook.save(path)
+
+    assert [number for number, _ in read_rows(path, 'xlsx')] == [2, 4, 5]
+    report = import_questions(path, 'xlsx', admin_id)
+
+    assert (report['rows'], report['imported']) == (3, 2)
+    assert report['errors'] == [{'row': 5, 'error': 'chapter_number must be a whole number.'}]
+    mcq = Question.query.filter_by(question_text='Pick one').one()
+    assert (mcq.chapter_number, json.loads(mcq.options), mcq.marks) == (2, ['Solid', 'Gas'], 1)
+
+@pytest.mark.parametrize('file_format', ['csv', 'jsonl', 'json'])
+def test_import_job_reports_progress_and_errors_as_it_goes(app, admin_id, tmp_path, monkeypatch, file_format):
+    rows = [question(question_text=f'Question {i} ' + 'x' * 80) for i in range(400)]
+    rows[5]['marks'] = 'many'
+    path = tmp_path / f'questions.{file_format}'
+    if file_format == 'csv':
+        write_csv(path, *rows)
+    elif file_format == 'jsonl':
+        path.write_text('\n'.join(json.dumps(row) for row in rows))
+    else:
+        path.write_text(json.dumps(rows))
+    monkeypatch.setitem(app.config, 'IMPORT_BATCH_SIZE', 50)
+    percents, results = [], []
+    monkeypatch.setattr(question_import, 'set_progress', percents.append)
+    monkeypatch.setattr(question_import, 'set_result', lambda report: results.append(json.loads(json.dumps(report))))
+
+    report = question_import.import_questions_job(str(path), file_format, admin_id)
+
+    assert report['imported'] == 399
+    assert len(percents) == 8 and percents == sorted(percents)
+    assert percents[0] < percents[-1] and percents[-1] > 90
+    # Row errors are in the result from the first batch on
+    assert results[0]['errors'] == [{'row': 7 if file_format == 'csv' else 6, 'error': 'marks must be a whole number.'}]
+    assert [r['imported'] for r in results] == [50, 100, 150, 200, 250, 300, 350, 399]
+    assert not path.exists()
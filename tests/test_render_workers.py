@@ -0,0 +1,34 @@
+import zipfile
+from io import BytesIO
+
+from pypdf import PdfReader
+
+from test_paper_downloads import make_paper
+import class_sets
+import pdf_generator
+
+def test_sections_render_on_worker_processes(app, make_user, make_question, monkeypatch):
+    monkeypatch.setitem(app.config, 'PDF_RENDER_WORKERS', 2)
+    questions = [make_question(question_type=question_type, question_text=f'{question_type} question {i}?')
+                 for question_type in ('MCQ', 'Short', 'Long') for i in range(3)]
+    paper = make_paper(make_user('teacher'), questions)
+
+    buffer = BytesIO()
+    pdf_generator.render_sections(buffer, paper, questions, 'Bright Star Academy')
+
+    text = '\n'.join(page.extract_text() for page in PdfReader(buffer).pages)
+    assert 'Subject: Science' in text
+    assert 'Q9.' in text and 'Long question 2?' in text
+
+def test_class_set_copies_are_stamped_on_worker_processes(app, make_user, make_question, monkeypatch):
+    monkeypatch.setitem(app.config, 'CLASS_SET_WORKERS', 2)
+    students = [make_user('student', name=f'Pupil {i}', roll_no=str(i)) for i in range(3)]
+    paper = make_paper(make_user('teacher'), [make_question()], class_set='zip')
+
+    path, _ = class_sets.build_class_set(paper, students, 'zip')
+
+    with zipfile.ZipFile(path) as archive:
+        names = sorted(archive.namelist())
+        assert names == ['0_Pupil_0.pdf', '1_Pupil_1.pdf', '2_Pupil_2.pdf']
+        first_page = PdfReader(BytesIO(archive.read(names[1]))).pages[0].extract_text()
+    assert 'Student: Pupil 1' in first_page
@@ -0,0 +1,103 @@
+import csv
+import os
+import time
+
+import pytest
+from werkzeug.security import check_password_hash
+
+from app import db
+from models import Job, User
+from conftest import login, wait_for_jobs
+from jobs import enqueue
+import roster_import
+
+@pytest.fixture
+def roster(app, tmp_path):
+    app.config['PASSWORD_HASH_WORKERS'] = 1
+
+    def write(*rows):
+        path = tmp_path / 'roster.csv'
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['name', 'email', 'role', 'class_assigned', 'roll_no', 'subject', 'expiry_date'])
+            writer.writerows(rows)
+        return str(path)
+    return write
+
+def read_sheet(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+def test_rows_are_validated_and_logins_recorded(app, make_user, roster):
+    make_user('student', email='taken@example.com')
+    path = roster(
+        ['Ann', 'Ann@Example.com', '', '9', '1', '', ''],
+        ['Bob', 'bob@example.com', 'teacher', '', '', 'Maths', '2030-01-31'],
+        ['Cy', 'ann@example.com', 'student', '9', '2', '', ''],
+        ['Di', 'taken@example.com', 'student', '9', '3', '', ''],
+        ['Ed', 'ed@example.com', 'student', '9', '', '', ''],
+        ['Fay', 'fay@example.com', 'teacher', '', '', 'Maths', '31/01/2030'],
+        ['Gus', 'gus@example.com', 'parent', '', '', '', ''],
+    )
+
+    report = roster_import.import_roster(path, 'csv', 'student')
+
+    assert (report['rows'], report['created'], report['error_count']) == (7, 2, 5)
+    assert [error['row'] for error in report['errors']] == [4, 5, 6, 7, 8]
+    assert report['errors'][0]['error'] == 'Email already appears on row 2.'
+    assert report['errors'][1]['error'] == 'Email already exists.'
+
+    bob = User.query.filter_by(email='bob@example.com').one()
+    assert bob.role == 'teacher' and bob.expiry_date.isoformat() == '2030-01-31'
+    sheet = read_sheet(report['credentials_path'])
+    assert [row['email'] for row in sheet] == ['ann@example.com', 'bob@example.com']
+    assert check_password_hash(bob.password_hash, sheet[1]['password'])
+    assert os.stat(report['credentials_path']).st_mode & 0o077 == 0
+
+def test_failed_import_keeps_the_logins_of_created_accounts(app, roster, monkeypatch):
+    app.config['IMPORT_BATCH_SIZE'] = 2
+    path = roster(*[[f'S{i}', f's{i}@example.com', '', '9', str(i), '', ''] for i in range(5)])
+    bump_counters = roster_import.bump_counters
+    calls = []
+
+    def failing(connection, deltas):
+        calls.append(deltas)
+        if len(calls) == 2:
+            raise RuntimeError('database went away')
+        bump_counters(connection, deltas)
+    monkeypatch.setattr(roster_import, 'bump_counters', failing)
+
+    try:
+        job = enqueue('import_roster', path=path, file_format='csv', default_role='student')
+        wait_for_jobs()
+    finally:
+        app.config['IMPORT_BATCH_SIZE'] = 1000
+
+    job = db.session.get(Job, job.id)
+    result = job.get_result()
+    assert job.status == 'failed'
+    assert result['created'] == 2
+    assert [row['email'] for row in read_sheet(result['credentials_path'])] == ['s0@example.com', 's1@example.com']
+    assert User.query.filter(User.email.like('s%@example.com')).count() == 2
+
+def test_credentials_sheet_is_deleted_once_downloaded(app, roster):
+    job = enqueue('import_roster', path=roster(['Ann', 'ann@example.com', '', '9', '1', '', '']),
+                  file_format='csv', default_role='student')
+    wait_for_jobs()
+    job = db.session.get(Job, job.id)
+    sheet = job.get_result()['credentials_path']
+
+    client = login(app.test_client(), 'admin@brightstar.edu', 'admin123')
+    response = client.get(f'/admin/roster/credentials/{job.id}')
+    assert response.status_code == 200
+    assert b'ann@example.com' in response.data
+    assert not os.path.exists(sheet)
+    assert client.get(f'/admin/roster/credentials/{job.id}').status_code == 302
+
+def test_expired_credentials_sheets_are_removed(app, roster):
+    report = roster_import.import_roster(roster(['Ann', 'ann@example.com', '', '9', '1', '', '']), 'csv', 'student')
+    old = time.time() - app.config['ROSTER_CREDENTIALS_TTL'] - 1
+    os.utime(report['credentials_path'], (old, old))
+
+    assert roster_import.remove_expired_credentials() == 1
+    assert not os.path.exists(report['credentials_path'])
@@ -0,0 +1,12 @@
+import pytest
+
+@pytest.mark.parametrize('limit, expected', [('2', 2), ('0', 1), ('-1', 1), ('1000', 5), ('many', 5)])
+def test_search_limit_is_clamped(app, make_user, make_question, client_for, limit, expected):
+    for i in range(5):
+        make_question(question_text=f'How does energy change form in example {i}?')
+    client = client_for(make_user('teacher'))
+
+    response = client.get(f'/teacher/api/questions/search?q=energy&limit={limit}')
+    assert response.status_code == 200
+    assert len(response.get_json()['results']) == expected
+    assert response.get_json()['facets']['subject'] == {'Science': 5}
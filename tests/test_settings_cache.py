@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+from flask import g
+from sqlalchemy import event
+
+from app import db
+from models import Setting
+from conftest import login
+import settings_cache
+from settings_cache import VERSION_KEY, get_settings
+
+def statements_during(function):
+    """The result of function() and the number of statements it sends"""
+    thread, count = threading.get_ident(), [0]
+
+    def counter(*args):
+        if threading.get_ident() == thread:
+            count[0] += 1
+    event.listen(db.engine, 'before_cursor_execute', counter)
+    try:
+        return function(), count[0]
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', counter)
+
+def stamp():
+    db.session.expire_all()
+    return db.session.query(Setting.value).filter_by(key=VERSION_KEY).scalar()
+
+@pytest.fixture
+def check_interval(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'SETTINGS_CHECK_INTERVAL', 60)
+    name = db.session.query(Setting.value).filter_by(key='academy_name').scalar()
+    yield
+    # Settings are kept between tests, so put the name back
+    with db.engine.begin() as conn:
+        conn.execute(Setting.__table__.update().where(Setting.key == 'academy_name').values(value=name))
+
+def test_a_cache_hit_sends_no_query(app, check_interval):
+    settings, loading = statements_during(get_settings)
+    assert settings['academy_name'] and loading > 0
+
+    again, cached = statements_during(get_settings)
+    assert again is settings and cached == 0
+
+def test_saving_settings_bumps_the_version_stamp(app, check_interval):
+    get_settings()
+    before = stamp()
+    g.pop('_login_user', None)
+    client = login(app.test_client(), 'admin@brightstar.edu', 'admin123')
+
+    response = client.post('/admin/settings/update', data={'academy_name': 'Green Valley School'})
+
+    assert response.status_code == 302
+    assert stamp() not in (None, before)
+    assert get_settings()['academy_name'] == 'Green Valley School'
+
+def test_another_workers_save_is_picked_up_at_the_next_check(app, check_interval, monkeypatch):
+    assert get_settings()['academy_name'] != 'Green Valley School'
+    # Another worker saves through its own update_settings: new value, new
+    # stamp, and this worker's cache is left as it was
+    with db.engine.begin() as conn:
+        conn.execute(Setting.__table__.update().where(Setting.key == 'academy_name').values(value='Green Valley School'))
+        conn.execute(Setting.__table__.update().where(Setting.key == VERSION_KEY).values(value='another-worker'))
+    db.session.rollback()
+
+    # Until the check is due, the cached settings are served
+    settings, sent = statements_during(get_settings)
+    assert settings['academy_name'] != 'Green Valley School' and sent == 0
+
+    monkeypatch.setitem(app.config, 'SETTINGS_CHECK_INTERVAL', 0)
+    assert get_settings()['academy_name'] == 'Green Valley School'
+    assert settings_cache._cache['version'] == 'another-worker'
@@ -0,0 +1,63 @@
+from sqlalchemy import event
+
+from app import db
+from models import StatCounter
+from stats import dashboard_stats, reconcile_counters
+
+def counters():
+    return dict(db.session.query(StatCounter.key, StatCounter.value).all())
+
+def test_reconcile_repairs_drift_in_place(app, make_user, make_question):
+    make_user('student', class_assigned='7')
+    make_question(subject='History')
+    with db.engine.begin() as conn:
+        conn.execute(db.update(StatCounter).where(StatCounter.key == 'questions').values(value=99))
+        conn.execute(db.insert(StatCounter).values(key='questions:subject:Latin', value=4))
+
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        reconcile_counters()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+    assert not any(statement.lstrip().upper().startswith('DELETE') for statement in statements)
+    values = counters()
+    assert values['questions'] == 1
+    assert values['questions:subject:History'] == 1
+    assert values['questions:subject:Latin'] == 0
+    assert values['students:class:7'] == 1
+    assert 'Latin' not in dashboard_stats()['questions_by_subject']
+
+def test_orm_changes_to_users_move_the_counters(app, make_user):
+    before = counters()
+
+    def changes():
+        """Counters that differ from before, and by how much"""
+        now = counters()
+        return {key: now.get(key, 0) - before.get(key, 0) for key in set(now) | set(before)
+                if now.get(key, 0) != before.get(key, 0)}
+
+    user = make_user('student', class_assigned='7')
+    assert changes() == {'users:student': 1, 'students:class:7': 1}
+
+    # Set after the commit expired it, so the old value has to be loaded
+    user.class_assigned = '8'
+    db.session.commit()
+    assert changes() == {'users:student': 1, 'students:class:8': 1}
+
+    user.role = 'teacher'
+    db.session.commit()
+    assert changes() == {'users:teacher': 1}
+
+    user.name = 'Renamed'  # not a counted column
+    user.role = 'admin'
+    db.session.flush()
+    db.session.rollback()
+    assert changes() == {'users:teacher': 1}
+
+    db.session.delete(user)
+    db.session.commit()
+    assert changes() == {}
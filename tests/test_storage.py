@@ -0,0 +1,207 @@
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+from io import BytesIO
+
+import pytest
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from app import db
+from models import DownloadFile, Setting, StoredObject
+from conftest import wait_for_jobs
+from test_paper_downloads import make_paper
+import media
+import storage
+
+def image_upload(color=(10, 120, 200)):
+    buffer = BytesIO()
+    Image.new('RGB', (64, 48), color).save(buffer, 'PNG')
+    return FileStorage(BytesIO(buffer.getvalue()), filename='logo.png')
+
+def refcount(path):
+    row = db.session.get(StoredObject, storage.digest_of(path))
+    db.session.rollback()
+    return row and row.refcount
+
+def test_references_are_counted_and_unreferenced_files_collected(app, make_user, make_question):
+    path = media.save_image(image_upload())
+    kept = media.save_image(image_upload((0, 0, 0)))
+    wait_for_jobs()
+    assert refcount(path) == 0
+
+    paper = make_paper(make_user('teacher'), [make_question()], logo_path=path)
+    make_paper(paper.teacher, [make_question()], logo_path=kept)
+    assert refcount(path) == 1
+    assert storage.collect_garbage(grace=0) == 0
+
+    paper.logo_path = None
+    db.session.commit()
+    assert refcount(path) == 0
+
+    assert storage.collect_garbage(grace=0) == 1
+    assert not os.path.exists(os.path.dirname(path))
+    assert refcount(path) is None
+    assert os.path.exists(kept) and refcount(kept) == 1
+
+def test_upload_during_collection_stores_the_files_again(app, monkeypatch):
+    path = media.save_image(image_upload())
+    wait_for_jobs()
+    backend = storage.get_storage()
+    delete = backend.delete
+    uploads = []
+
+    def upload():
+        with app.app_context():
+            uploads.append(media.save_image(image_upload()))
+
+    def slow_delete(digest):
+        # The same image is uploaded again while its files are being deleted
+        thread = threading.Thread(target=upload)
+        thread.start()
+        time.sleep(0.3)
+        assert not uploads  # register() waits for the collection to finish
+        delete(digest)
+        slow_delete.thread = thread
+    monkeypatch.setattr(backend, 'delete', slow_delete)
+
+    assert storage.collect_garbage(grace=0) == 1
+    slow_delete.thread.join()
+    assert uploads == [path]
+    wait_for_jobs()
+    assert os.path.exists(path)
+    assert refcount(path) == 0
+
+def test_missing_variant_is_none(app):
+    path = media.save_image(image_upload())
+    wait_for_jobs()
+    shutil.rmtree(os.path.dirname(path))
+
+    assert media.ready_variant(path, 'pdf') is None
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def test_files_at_their_old_upload_paths_are_moved_into_storage(app, make_user, make_question):
+    logo = image_upload().read()
+    old_logo = write('uploads/logos/crest.png', logo)
+    old_paper_logo = write('uploads/logos/paper_1_crest.png', logo)
+    old_file = write('uploads/downloads/syllabus.pdf', b'%PDF-1.4 syllabus')
+    write('uploads/logos/notes.png', b'not an image')
+    setting = Setting.query.filter_by(key='academy_logo').one()
+    setting.value = old_logo
+    teacher = make_user('teacher')
+    paper = make_paper(teacher, [make_question()], logo_path=old_paper_logo)
+    bad = make_paper(teacher, [make_question()], logo_path='uploads/logos/notes.png')
+    gone = make_paper(teacher, [make_question()], logo_path='uploads/logos/deleted.png')
+    shared = DownloadFile(title='Syllabus', file_path=old_file, file_type='pdf', target_role='all',
+                          created_by=teacher.id)
+    db.session.add(shared)
+    db.session.commit()
+
+    assert media.adopt_uploads() == 3
+    wait_for_jobs()
+
+    db.session.expire_all()
+    # The same image twice is stored once
+    digest = hashlib.sha256(logo).hexdigest()
+    assert setting.value == paper.logo_path == storage.path_for(storage.object_key(digest, 'original.png'))
+    assert os.path.exists(media.ready_variant(paper.logo_path, 'pdf'))
+    assert refcount(setting.value) == 2
+    assert shared.file_path.endswith('/syllabus.pdf') and refcount(shared.file_path) == 1
+    with open(shared.file_path, 'rb') as f:
+        assert f.read() == b'%PDF-1.4 syllabus'
+    assert not any(os.path.exists(p) for p in (old_logo, old_paper_logo, old_file))
+    # Files that can't be moved stay referred to where they are
+    assert (bad.logo_path, gone.logo_path) == ('uploads/logos/notes.png', 'uploads/logos/deleted.png')
+    assert media.adopt_uploads() == 0
+
+    setting.value = ''
+    db.session.commit()
+
+class FakeS3:
+    """The parts of a boto3 S3 client S3Storage uses, over a dict"""
+
+    class exceptions:
+        class ClientError(Exception):
+            pass
+
+    def __init__(self, page_size=2):
+        self.objects = {}  # (bucket, key) -> bytes
+        self.page_size = page_size
+        self.deletes = []
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.ClientError('404')
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Bucket, Key] = Body
+
+    def download_file(self, bucket, key, path):
+        if (bucket, key) not in self.objects:
+            raise self.exceptions.ClientError('404')
+        with open(path, 'wb') as f:
+            f.write(self.objects[bucket, key])
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(k for b, k in self.objects if b == Bucket and k.startswith(Prefix))
+        for start in range(0, len(keys), self.page_size):
+            yield {'Contents': [{'Key': k} for k in keys[start:start + self.page_size]]}
+        if not keys:
+            yield {}
+
+    def delete_objects(self, Bucket, Delete):
+        self.deletes.append(len(Delete['Objects']))
+        for item in Delete['Objects']:
+            del self.objects[Bucket, item['Key']]
+
+def test_s3_storage_against_a_stand_in(tmp_path):
+    client = FakeS3()
+    backend = storage.S3Storage(str(tmp_path), 'school', prefix='media/', client=client)
+    digest = 'ab' + '0' * 62
+    keys = [storage.object_key(digest, name) for name in ('original.png', 'pdf.png', 'thumb.png', 'webp.webp')]
+
+    for key in keys:
+        backend.put(key, key.encode())
+    assert set(client.objects) == {('school', 'media/' + key) for key in keys}
+
+    # A file only in the bucket is fetched into a local copy
+    shutil.rmtree(tmp_path / 'ab')
+    assert backend.exists(keys[0])
+    path = backend.fetch(keys[0])
+    assert path == str(tmp_path / keys[0])
+    with open(path, 'rb') as f:
+        assert f.read() == keys[0].encode()
+    assert backend.fetch(storage.object_key(digest, 'missing.png')) is None
+    assert not backend.exists(storage.object_key(digest, 'missing.png'))
+    assert not any(name.endswith('.tmp') for name in os.listdir(os.path.dirname(path)))
+
+    # Deleting a digest removes every page of its objects, and the local copies
+    backend.put(storage.object_key('cd' + '0' * 62, 'original.png'), b'other')
+    backend.delete(digest)
+    assert client.deletes == [2, 2]
+    assert list(client.objects) == [('school', 'media/' + storage.object_key('cd' + '0' * 62, 'original.png'))]
+    assert not os.path.exists(tmp_path / 'ab' / digest)
+    backend.delete(digest)  # nothing left to list
+
+def test_s3_storage_needs_a_bucket_and_boto3(app, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'boto3', None)
+    with pytest.raises(storage.StorageError, match='boto3'):
+        storage.S3Storage(app.config['STORAGE_ROOT'], 'school')
+
+    monkeypatch.setattr(storage, '_backend', None)
+    monkeypatch.setitem(app.config, 'STORAGE_BACKEND', 's3')
+    monkeypatch.setitem(app.config, 'STORAGE_S3_BUCKET', '')
+    with pytest.raises(storage.StorageError, match='STORAGE_S3_BUCKET'):
+        storage.get_storage()
@@ -0,0 +1,80 @@
+import time
+
+import pytest
+from flask import g
+from werkzeug.security import check_password_hash
+
+from app import db
+from models import User
+from conftest import PASSWORD, login
+import user_cache
+from user_cache import load_user
+
+def cached(user_id):
+    """The cached column values for a user, or None"""
+    with user_cache._lock:
+        entry = user_cache._entries.get(user_id)
+    return entry and entry[1]
+
+@pytest.fixture
+def teacher(app, make_user):
+    """A teacher whose row is in the cache"""
+    teacher = make_user('teacher')
+    load_user(teacher.id)
+    assert cached(teacher.id)['name'] == teacher.name
+    return teacher
+
+def as_admin(app, url, **kwargs):
+    """Request an admin page, GET or (given data) POST, and expect a redirect"""
+    g.pop('_login_user', None)
+    client = login(app.test_client(), 'admin@brightstar.edu', 'admin123')
+    g.pop('_login_user', None)
+    method = client.post if 'data' in kwargs else client.get
+    response = method(url, **kwargs)
+    assert response.status_code == 302
+    db.session.expire_all()
+
+def test_editing_a_user_drops_them(app, teacher):
+    as_admin(app, f'/admin/teachers/edit/{teacher.id}', data={'name': 'Renamed Teacher'})
+    assert cached(teacher.id) is None
+    assert load_user(teacher.id).name == 'Renamed Teacher'
+
+def test_deactivating_a_user_drops_them(app, teacher):
+    as_admin(app, f'/admin/teachers/toggle/{teacher.id}')
+    assert cached(teacher.id) is None
+    assert load_user(teacher.id) is None
+
+def test_deleting_a_user_drops_them(app, teacher):
+    teacher_id = teacher.id
+    as_admin(app, f'/admin/teachers/delete/{teacher_id}')
+    assert cached(teacher_id) is None
+    assert load_user(teacher_id) is None
+
+def test_changing_a_password_drops_the_user(app, teacher, client_for):
+    client = client_for(teacher)
+    g.pop('_login_user', None)
+    response = client.post('/auth/change-password', data={
+        'current_password': PASSWORD, 'new_password': 'new-password', 'confirm_password': 'new-password'})
+    assert response.status_code == 302
+
+    assert cached(teacher.id) is None
+    db.session.expire_all()
+    assert check_password_hash(load_user(teacher.id).password_hash, 'new-password')
+
+def test_entries_expire_after_the_ttl(app, make_user, monkeypatch):
+    monkeypatch.setitem(app.config, 'USER_CACHE_TTL', 0.2)
+    teacher = make_user('teacher')
+    load_user(teacher.id)
+    # Another process deactivates the teacher; nothing here hears of it
+    with db.engine.begin() as conn:
+        conn.execute(User.__table__.update().where(User.id == teacher.id).values(is_active=False))
+    db.session.expire_all()
+
+    hits = user_cache.cache_stats()['hits']
+    assert load_user(teacher.id) is not None  # still served from memory
+    assert user_cache.cache_stats()['hits'] == hits + 1
+
+    time.sleep(0.25)
+    db.session.expire_all()  # as at the start of the next request
+    assert load_user(teacher.id) is None
+    assert not cached(teacher.id)['is_active']
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from app import db
+from models import User
+import threading
+import time
+
+# Flask-Login loads the current user on every authenticated request. Each
+# process keeps a small LRU of recently loaded users' column values for
+# USER_CACHE_TTL seconds and rebuilds the User from it without a query.
+# Changes made in this process drop the entry as soon as they are flushed and
+# again on commit; changes made by other processes show up once the entry
+# expires, so a deactivation takes effect within the TTL everywhere.
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # user id -> (expires at, column values)
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+_columns = [attr.key for attr in inspect(User).column_attrs]
+
+def _from_cache(user_id):
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(user_id)
+        if entry is None or entry[0] <= now:
+            _entries.pop(user_id, None)
+            _stats['misses'] += 1
+            return None
+        _entries.move_to_end(user_id)
+        _stats['hits'] += 1
+        return entry[1]
+
+def _store(user):
+    values = {key: getattr(user, key) for key in _columns}
+    expires_at = time.monotonic() + current_app.config['USER_CACHE_TTL']
+    with _lock:
+        _entries[user.id] = (expires_at, values)
+        _entries.move_to_end(user.id)
+        while len(_entries) > current_app.config['USER_CACHE_SIZE']:
+            _entries.popitem(last=False)
+
+def load_user(user_id):
+    """Return the User for user_id attached to the current session, or None"""
+    values = _from_cache(user_id)
+    if values is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        _store(user)
+    else:
+        # Rebuild a clean detached instance and attach it without a SELECT
+        user = User(**values)
+        make_transient_to_detached(user)
+        user = db.session.merge(user, load=False)
+
+    if not user.is_active:
+        return None
+    return user
+
+def invalidate_user(user_id):
+    """Drop a user from this process's cache"""
+    with _lock:
+        if _entries.pop(user_id, None) is not None:
+            _stats['invalidations'] += 1
+
+def cache_stats():
+    """Snapshot of the hit/miss counters for this process"""
+    with _lock:
+        stats = dict(_stats, size=len(_entries))
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    invalidate_user(target.id)
+    # Drop it again after commit in case another request re-cached the old row meanwhile
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_user_ids', set()).add(target.id)
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for user_id in session.info.pop('changed_user_ids', ()):
+        invalidate_user(user_id)
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('changed_user_ids', None)
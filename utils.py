@@ -1,33 +1,18 @@
-import os
+import media
 import secrets
 import string
-from werkzeug.utils import secure_filename
-from PIL import Image
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# Extensions of the formats media.py accepts (media.FORMATS)
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
 def allowed_file(filename):
     """Check if the file extension is allowed"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def save_picture(form_picture, folder, max_size=(800, 600)):
-    """Save and resize uploaded picture"""
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(folder, picture_fn)
-    
-    # Create directory if it doesn't exist
-    os.makedirs(folder, exist_ok=True)
-    
-    # Resize image
-    output_size = max_size
-    img = Image.open(form_picture)
-    img.thumbnail(output_size)
-    img.save(picture_path)
-    
-    return picture_path
+def save_picture(form_picture):
+    """Save an uploaded picture through the media pipeline and return its path"""
+    return media.save_image(form_picture)
 
 def generate_password(length=8):
     """Generate a random password"""
@@ -0,0 +1,23 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+# CPU-bound work (password hashing, paper layout, stamping class set copies)
+# is spread over process pools started from job threads. Forking a process
+# that runs threads can copy a lock another thread was holding at the time
+# (the database pool, logging, the job queue), so the pool's processes are
+# forked from a forkserver instead: a clean process, started once, which has
+# imported the modules in PRELOAD (a head start only: a worker imports what
+# a task needs when it unpickles it). Modules with worker functions must not
+# import app, and tasks and results are plain values (bytes, strings, dicts
+# and tuples), never ORM objects.
+#
+# Worker processes still run the main script again, as __mp_main__, so
+# main.py only imports the app when it isn't being run that way.
+
+PRELOAD = ['pdf_layout', 'werkzeug.security']
+
+def process_pool(max_workers):
+    """A process pool whose workers are forked from the forkserver"""
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(PRELOAD)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)